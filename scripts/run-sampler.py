@@ -12,6 +12,7 @@ from schwimmbad import choose_pool
 # Project
 from thejoker.data import RVData
 from thejoker.log import log as logger
+from thejoker.sampler.io import _file_lock
 
 def main(data_file, pool, tmp_prior_filename, n_samples=1, seed=42, hdf5_key=None,
          cache_filename=None, overwrite=False, continue_sampling=False,
@@ -139,30 +140,38 @@ def main(data_file, pool, tmp_prior_filename, n_samples=1, seed=42, hdf5_key=Non
     orbital_params = samples_to_orbital_params(good_samples_idx, tmp_prior_filename,
                                                data, pool, seed)
 
-    # save the orbital parameters out to a cache file
-    with h5py.File(output_filename, mode) as f:
-        f.attrs['rerun'] = rerun
-        if hyperpars['fixed_jitter'] is not None:
-            f.attrs['fixed_jitter'] = hyperpars['fixed_jitter']
-        else:
-            f.attrs['fixed_jitter'] = np.nan
-        f.attrs['P_min'] = hyperpars['P_min']
-        f.attrs['P_max'] = hyperpars['P_max']
+    # save the orbital parameters out to a cache file; hold the lock so that
+    # concurrent --continue runs do not interleave their resizes and writes
+    with _file_lock(output_filename):
+        with h5py.File(output_filename, mode) as f:
+            f.attrs['rerun'] = rerun
+            if hyperpars['fixed_jitter'] is not None:
+                f.attrs['fixed_jitter'] = hyperpars['fixed_jitter']
+            else:
+                f.attrs['fixed_jitter'] = np.nan
+            f.attrs['P_min'] = hyperpars['P_min']
+            f.attrs['P_max'] = hyperpars['P_max']
 
-        for i,(name,unit) in enumerate(OrbitalParams._name_to_unit.items()):
-            if name in f:
-                if overwrite: # delete old samples and overwrite
+            for i,(name,unit) in enumerate(OrbitalParams._name_to_unit.items()):
+                if name in f and overwrite: # delete old samples and overwrite
                     del f[name]
-                    f.create_dataset(name, data=orbital_params.T[i])
 
-                elif continue_sampling: # append to existing samples
-                    _data = f[name][:]
-                    del f[name]
-                    f[name] = np.concatenate((_data, orbital_params.T[i]))
-            else:
-                f.create_dataset(name, data=orbital_params.T[i])
+                if name not in f:
+                    f.create_dataset(name, data=orbital_params.T[i],
+                                     maxshape=(None,), chunks=True)
+
+                else: # append to existing samples, resizing in place
+                    if f[name].maxshape[0] is not None: # old, fixed-size cache
+                        _data = f[name][:]
+                        del f[name]
+                        f.create_dataset(name, data=_data, maxshape=(None,),
+                                         chunks=True)
+
+                    n = f[name].shape[0]
+                    f[name].resize(n + len(orbital_params), axis=0)
+                    f[name][n:] = orbital_params.T[i]
 
-            f[name].attrs['unit'] = str(unit)
+                f[name].attrs['unit'] = str(unit)
 
     pool.close()
 
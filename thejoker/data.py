@@ -5,6 +5,7 @@ import numpy as np
 
 # Project
 from .log import log as logger
+from .utils import _dataset_kwargs
 
 __all__ = ['RVData']
 
@@ -29,11 +30,17 @@ class RVData:
     t0 : numeric (optional) [day]
         A reference time. Default is to use the minimum time in barycentric MJD
         (days).
+    instrument : array_like (optional)
+        A label for the instrument (e.g., spectrograph) that took each RV
+        measurement. If the data come from more than one instrument, a
+        velocity offset for each instrument relative to the first (in sorted
+        order) instrument is included in the linear parameters. Default is to
+        assume all data come from the same instrument.
 
     """
     @u.quantity_input(rv=u.km/u.s)
     def __init__(self, t, rv, ivar=None, stddev=None,
-                 metadata=None, t0=None):
+                 metadata=None, t0=None, instrument=None):
 
         # For speed, many of the attributes are saved without units and only
         #   returned with units if asked for.
@@ -71,12 +78,24 @@ class RVData:
             self.ivar = 1 / stddev.to(self.rv.unit)**2
         self.ivar = np.atleast_1d(self.ivar)
 
+        if instrument is not None:
+            instrument = np.atleast_1d(instrument)
+            self._has_instrument = True
+        else:
+            instrument = np.zeros(self.rv.shape, dtype=int)
+            self._has_instrument = False
+
         # make sure shapes are consistent
         if self._t_bmjd.shape != self.rv.shape or self.rv.shape != self.ivar.shape:
             raise ValueError("Shape of input time, RV, and errors must be consistent! "
                              "({} vs {} vs {})".format(self._t_bmjd.shape,
                                                        self.rv.shape,
                                                        self.ivar.shape))
+
+        if instrument.shape != self.rv.shape:
+            raise ValueError("Shape of instrument labels must be consistent "
+                             "with the RV data! ({} vs {})"
+                             .format(instrument.shape, self.rv.shape))
         # filter out NAN or INF data points
         idx = np.isfinite(self._t_bmjd) & np.isfinite(self.rv)
 
@@ -89,12 +108,18 @@ class RVData:
         self._t_bmjd = self._t_bmjd[idx]
         self.rv = self.rv[idx]
         self.ivar = self.ivar[idx]
+        instrument = instrument[idx]
 
         # sort on times
         idx = self._t_bmjd.argsort()
         self._t_bmjd = self._t_bmjd[idx]
         self.rv = self.rv[idx]
         self.ivar = self.ivar[idx]
+        self.instrument = instrument[idx]
+
+        # integer index of the instrument for each data point
+        self._instruments, self._instrument_idx = np.unique(
+            self.instrument, return_inverse=True)
 
         # metadata can be anything
         self.metadata = metadata
@@ -147,6 +172,26 @@ class RVData:
             t0 = self.t0
         return ((self.t - t0) / P) % 1.
 
+    @property
+    def instruments(self):
+        """
+        The unique instrument labels, in sorted order. The velocity offsets
+        of the data are measured relative to the first instrument.
+
+        Returns
+        -------
+        instruments : `~numpy.ndarray`
+            The instrument labels, or ``None`` if no labels were specified.
+        """
+        if not self._has_instrument:
+            return None
+        return self._instruments
+
+    @property
+    def n_instruments(self):
+        """The number of instruments that took the data."""
+        return len(self._instruments)
+
     @property
     def stddev(self):
         """
@@ -233,28 +278,44 @@ class RVData:
 
     # copy methods
     def __copy__(self):
-        return self.__class__(t=self.t.copy(),
-                              rv=self.rv.copy(),
-                              ivar=self.ivar.copy())
+        return self[:]
 
     def copy(self):
         return self.__copy__()
 
     def __getitem__(self, slc):
+        if self._has_instrument:
+            instrument = self.instrument.copy()[slc]
+        else:
+            instrument = None
+
         return self.__class__(t=self.t.copy()[slc],
                               rv=self.rv.copy()[slc],
-                              ivar=self.ivar.copy()[slc])
+                              ivar=self.ivar.copy()[slc],
+                              instrument=instrument)
 
     def __len__(self):
         return len(self.rv.value)
 
-    def to_hdf5(self, file_or_path):
+    def to_hdf5(self, file_or_path, chunks=None, compression=None,
+                compression_opts=None, dtype=None):
         """
         Write data to an HDF5 file.
 
         Parameters
         ----------
         file_or_path : str, `h5py.File`, `h5py.Group`
+        chunks : int (optional)
+            The number of data points per chunk of each dataset.
+        compression : str (optional)
+            The compression filter, e.g., ``'gzip'`` or ``'lzf'``.
+        compression_opts : int (optional)
+            Options for the compression filter, e.g., the gzip level.
+        dtype : `numpy.dtype` (optional)
+            The data type to store the radial velocities and their
+            uncertainties as on disk. The times are always stored in double
+            precision, because single precision MJDs are only good to a few
+            minutes.
         """
 
         import h5py
@@ -266,16 +327,26 @@ class RVData:
             f = file_or_path
             close = False
 
-        d = f.create_dataset('mjd', data=self.t.tcb.mjd)
+        kwargs = _dataset_kwargs(self.rv.shape, chunks=chunks,
+                                 compression=compression,
+                                 compression_opts=compression_opts)
+
+        d = f.create_dataset('mjd', data=self.t.tcb.mjd, **kwargs)
         d.attrs['format'] = 'mjd'
         d.attrs['scale'] = 'tcb'
 
-        d = f.create_dataset('rv', data=self.rv.value)
+        d = f.create_dataset('rv', data=self.rv.value, dtype=dtype, **kwargs)
         d.attrs['unit'] = str(self.rv.unit)
 
-        d = f.create_dataset('rv_err', data=self.stddev.value)
+        d = f.create_dataset('rv_err', data=self.stddev.value, dtype=dtype,
+                             **kwargs)
         d.attrs['unit'] = str(self.stddev.unit)
 
+        if self.instruments is not None:
+            f.create_dataset('instrument',
+                             data=self.instrument.astype(str).astype('S'),
+                             **kwargs)
+
         if close:
             f.close()
 
@@ -298,11 +369,19 @@ class RVData:
             f = file_or_path
             close = False
 
-        t = f['mjd']
-        rv = f['rv'][:] * u.Unit(f['rv'].attrs['unit'])
-        stddev = f['rv_err'][:] * u.Unit(f['rv_err'].attrs['unit'])
+        # the values may be stored in single precision
+        t = f['mjd'][:]
+        rv = (f['rv'][:].astype(np.float64) *
+              u.Unit(f['rv'].attrs['unit']))
+        stddev = (f['rv_err'][:].astype(np.float64) *
+                  u.Unit(f['rv_err'].attrs['unit']))
+
+        if 'instrument' in f:
+            instrument = f['instrument'][:].astype(str)
+        else:
+            instrument = None
 
         if close:
             f.close()
 
-        return cls(t=t, rv=rv, stddev=stddev)
+        return cls(t=t, rv=rv, stddev=stddev, instrument=instrument)
@@ -72,10 +72,9 @@ def plot_rv_curves(samples, t_grid, n_plot=None, rv_unit=None, data=None,
     style.setdefault('rasterized', True)
 
     # plot orbits over the data
-    model_rv = np.zeros((n_plot, len(t_grid)))
-    for i in range(n_plot):
-        orbit = samples.get_orbit(i)
-        model_rv[i] = orbit.radial_velocity(t_grid).to(rv_unit).value
+    if len(samples.shape) > 0:
+        samples = samples[:n_plot]
+    model_rv = np.atleast_2d(samples.rv(t_grid).to(rv_unit).value)
 
     bmjd = t_grid.tcb.mjd
     if relative_to_t0:
@@ -5,3 +5,4 @@ from .samples import *
 from .multiproc_helpers import *
 from .params import *
 from .mcmc import *
+from .hmc import *
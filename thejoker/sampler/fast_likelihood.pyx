@@ -14,9 +14,14 @@ cimport cython
 cimport scipy.linalg.cython_lapack as lapack
 
 # from libc.stdio cimport printf
-from libc.math cimport pow, log, fabs
+from libc.math cimport (log, exp, sqrt, fabs, cos, sin, atan2, lgamma,
+                        INFINITY, NAN)
 
 cdef extern from "src/twobody.h":
+    double c_eccentric_anomaly_from_mean_anomaly_Newton1(double M, double e,
+                                                         double tol,
+                                                         int maxiter)
+    double c_true_anomaly_from_eccentric_anomaly(double E, double e)
     void c_rv_from_elements(double *t, double *rv, int N_t,
                             double P, double K, double e, double omega,
                             double phi0, double t0, double tol, int maxiter)
@@ -24,13 +29,83 @@ cdef extern from "src/twobody.h":
 # Log of 2π
 cdef double LN_2PI = 1.8378770664093453
 
+# 2π
+cdef double TWO_PI = 6.283185307179586
 
-cdef void design_matrix(double P, double phi0, double ecc, double omega,
-                        double[::1] t, double t0,
-                        double[:,::1] A_T,
-                        int n_trend,
-                        double anomaly_tol, int anomaly_maxiter):
-    """Construct the elements of the design matrix.
+# If the Schur complement of the trend block is smaller than this fraction of
+# the Keplerian block, recompute it from residuals (see KeplerBlock)
+cdef double REFINE_TOL = 1E-6
+
+# Half-width of the jitter grid in units of the prior standard deviation
+cdef double JITTER_GRID_NSIGMA = 5.
+
+# Maximum number of combinations of jitter grid values (jitter_grid to the
+# power of the number of jitter groups). The trend block stores the normal
+# equations for each combination.
+MAX_JITTER_CONFIGS = 2**16
+
+# Parameters of the Beta prior on eccentricity used in the MCMC (Kipping 2013)
+cdef double ECC_BETA_A = 0.867
+cdef double ECC_BETA_B = 3.03
+
+# Standard deviation of the wide Gaussian priors on K and v0 used in the MCMC
+cdef double LINEAR_PRIOR_STD = 100.
+
+
+def jitter_grid(joker_params, rv_unit):
+    """Return the quadrature grid used to marginalize over the jitter.
+
+    The grid consists of the midpoints of ``joker_params.jitter_grid``
+    equal-width cells in :math:`y = \log s^2` spanning :math:`\pm 5\sigma`
+    around the mean of the Gaussian jitter prior. The weight of each cell is
+    the prior density at the midpoint times the cell width, normalized so that
+    the weights sum to 1.
+
+    Parameters
+    ----------
+    joker_params : `~thejoker.sampler.params.JokerParams`
+        The specification of parameters to infer with The Joker.
+    rv_unit : `~astropy.units.UnitBase`
+        The radial velocity data unit.
+
+    Returns
+    -------
+    y : `numpy.ndarray`
+        The grid points in :math:`\log s^2`, with :math:`s` in units of
+        ``joker_params._jitter_unit``.
+    s : `numpy.ndarray`
+        The jitter values at the grid points in ``rv_unit``.
+    ln_w : `numpy.ndarray`
+        Log-weights of the grid points.
+    dy : float
+        The width of the grid cells.
+
+    """
+    mu, std = joker_params.jitter
+    n_grid = joker_params.jitter_grid
+
+    dy = 2 * JITTER_GRID_NSIGMA * std / n_grid
+    y = mu - JITTER_GRID_NSIGMA * std + dy * (np.arange(n_grid) + 0.5)
+
+    ln_w = -0.5 * ((y - mu) / std)**2
+    ln_w -= np.log(np.sum(np.exp(ln_w)))
+
+    s = np.sqrt(np.exp(y)) * joker_params._jitter_unit.to(rv_unit)
+
+    return y, s, ln_w, dy
+
+
+cdef void kepler_design_matrix(double P, double phi0, double ecc, double omega,
+                               double[::1] t, double t0,
+                               double[:,::1] K_T, int marginalize_omega,
+                               double anomaly_tol, int anomaly_maxiter):
+    """Construct the elements of the design matrix for the Keplerian part of
+    the velocity curve.
+
+    If ``marginalize_omega`` is set, the velocity curve is written as
+    ``K cos(omega) (cos(f) + e) - K sin(omega) sin(f)``, and the two rows
+    contain ``cos(f) + e`` and ``-sin(f)``, i.e. the linear parameters are
+    ``K cos(omega)`` and ``K sin(omega)``. The input ``omega`` is then ignored.
 
     Parameters
     ----------
@@ -46,8 +121,8 @@ cdef void design_matrix(double P, double phi0, double ecc, double omega,
         Data time array.
     t0 : double
         Reference time.
-    n_trend : int
-        Number of terms in the long-term velocity trend.
+    marginalize_omega : int
+        Treat the argument of pericenter as a linear parameter.
     anomaly_tol : double
         Tolerance passed to c_rv_from_elements.
     anomaly_maxiter : int
@@ -55,192 +130,661 @@ cdef void design_matrix(double P, double phi0, double ecc, double omega,
 
     Outputs
     -------
-    A_T : `numpy.ndarray`
-        The transpose of the design matrix, to be filled by this function.
-        Should have shape: (number of linear parameters, number of data points).
+    K_T : `numpy.ndarray`
+        The transpose of the Keplerian block of the design matrix, to be
+        filled by this function. Should have shape: (1 or 2, number of data
+        points).
 
     """
     cdef:
-        int i, j
+        int j
         int n_times = t.shape[0]
+        double M, E, f
 
-    c_rv_from_elements(&t[0], &A_T[0,0], n_times,
-                       P, 1., ecc, omega, phi0, t0,
-                       anomaly_tol, anomaly_maxiter)
-
-    for j in range(n_times):
-        A_T[1, j] = 1.
-
-    if n_trend > 1: # only needed if more than constant trend
-        for i in range(1, n_trend):
-            for j in range(n_times):
-                A_T[1+i, j] = pow(t[j], i)
+    if marginalize_omega:
+        for j in range(n_times):
+            M = TWO_PI * (t[j] - t0) / P - phi0
+            E = c_eccentric_anomaly_from_mean_anomaly_Newton1(
+                M, ecc, anomaly_tol, anomaly_maxiter)
+            f = c_true_anomaly_from_eccentric_anomaly(E, ecc)
+            K_T[0, j] = cos(f) + ecc
+            K_T[1, j] = -sin(f)
 
+    else:
+        c_rv_from_elements(&t[0], &K_T[0,0], n_times,
+                           P, 1., ecc, omega, phi0, t0,
+                           anomaly_tol, anomaly_maxiter)
 
-cdef void get_ivar(double[::1] ivar, double s, double[::1] new_ivar):
-    """Return new ivar values with the jitter incorporated.
 
-    This is safe for zero'd out inverse variances.
+cpdef batch_kepler_rv(double[:,::1] nonlinear_p, double[::1] t, double t0,
+                      double anomaly_tol=1E-10, int anomaly_maxiter=128):
+    """Compute unit-amplitude Keplerian radial velocity curves for a batch of
+    nonlinear parameter values.
 
     Parameters
     ----------
-    ivar : `numpy.ndarray`
-        Inverse-variance array.
-    s : numeric
-        Jitter in the same units as the RV data.
-    new_ivar : `numpy.ndarray`
-        The output array.
+    nonlinear_p : `numpy.ndarray`
+        A 2D array of nonlinear parameter values. The first four columns are
+        P (period, day), M0 (phase at pericenter, rad), ecc (eccentricity),
+        omega (argument of pericenter, rad); any other columns are ignored.
+    t : `numpy.ndarray`
+        Data time array.
+    t0 : double
+        Reference time.
+    anomaly_tol : double (optional)
+        Tolerance passed to c_rv_from_elements.
+    anomaly_maxiter : int (optional)
+        Max. number of iterations passed to c_rv_from_elements.
+
+    Returns
+    -------
+    rv : `numpy.ndarray`
+        The radial velocity curves, with shape ``(n_samples, n_times)``.
 
     """
     cdef:
-        int n = ivar.shape[0]
-        int i
+        int n
+        int n_samples = nonlinear_p.shape[0]
+        int n_times = t.shape[0]
+        double[:,::1] rv = np.zeros((n_samples, n_times))
 
-    for i in range(n):
-        new_ivar[i] = ivar[i] / (1 + s*s * ivar[i])
+    if n_times == 0:
+        return np.array(rv)
+
+    for n in range(n_samples):
+        c_rv_from_elements(&t[0], &rv[n, 0], n_times,
+                           nonlinear_p[n, 0], 1., nonlinear_p[n, 2],
+                           nonlinear_p[n, 3], nonlinear_p[n, 1], t0,
+                           anomaly_tol, anomaly_maxiter)
+
+    return np.array(rv)
 
 
-cdef double tensor_vector_scalar(double[:,::1] A_T, double[::1] ivar,
-                                 double[::1] y,
-                                 double[:,::1] ATCinvA, double[::1] p):
-    """Construct objects used to compute the marginal log-likelihood.
+cdef void trend_design_matrix(double[::1] t, double t0, int[::1] inst_idx,
+                              int n_trend, double[:,::1] F_T):
+    """Construct the elements of the design matrix for the polynomial velocity
+    trend, i.e. powers of ``t - t0``, and the velocity offsets of each
+    instrument relative to the first (reference) instrument.
 
     Parameters
     ----------
-    A_T : `numpy.ndarray`
-        Transpose of the design matrix.
-    ivar : `numpy.ndarray`
-        Inverse-variance matrix.
-    y : `numpy.ndarray`
-        Data (in this case, radial velocities).
+    t : `numpy.ndarray`
+        Data time array.
+    t0 : double
+        Reference time.
+    inst_idx : `numpy.ndarray`
+        Integer index of the instrument for each data point.
+    n_trend : int
+        Number of terms in the polynomial velocity trend.
 
     Outputs
     -------
-    ATCinvA : `numpy.ndarray`
-        Value of A^T C^-1 A -- inverse of the covariance matrix
-        of the linear parameters.
-    p : `numpy.ndarray`
-        Optimal values of linear parameters.
-
-    Returns
-    -------
-    chi2 : float
-        Chi-squared value.
+    F_T : `numpy.ndarray`
+        The transpose of the trend block of the design matrix, to be filled by
+        this function. Should have shape: (number of trend terms + number of
+        instruments - 1, number of data points).
 
     """
-
     cdef:
-        int i, j, k
-        int n_times = A_T.shape[1]
-        int n_pars = A_T.shape[0]
-        double[::1] ATCinvy = np.zeros(n_pars)
-
-        double[:,::1] _A = np.zeros((n_pars, n_pars))
-        double chi2 = 0. # chi-squared
-        double y2, dy
-
-        # Needed to LAPACK dsysv
-        char* uplo = 'U' # store the upper triangle
-        int nrhs = 1 # number of columns in b
-        int[:,::1] ipiv = np.zeros((n_pars, n_pars), dtype=np.int32) # ??
-        double[:,::1] work = np.zeros((n_pars, n_pars), dtype=np.float64) # ??
-        int[:,::1] lwork = np.ones((n_pars, n_pars), dtype=np.int32) # ??
-        int info = 0 # if 0, success, otherwise some whack shit hapnd
-
-    # first zero-out arrays
-    for i in range(n_pars):
-        p[i] = 0.
-        for j in range(n_pars):
-            ATCinvA[i,j] = 0.
-
-    for k in range(n_times):
-        for i in range(n_pars):
-            ATCinvy[i] += A_T[i,k] * ivar[k] * y[k]
-            for j in range(n_pars):
-                # implicit transpose of first A_T in the below
-                ATCinvA[i,j] += A_T[i,k] * ivar[k] * A_T[j,k]
-
-    _A[:,:] = ATCinvA
-    p[:] = ATCinvy
-
-    # p = np.linalg.solve(ATCinvA, ATCinv.dot(y))
-    lapack.dsysv(uplo, &n_pars, &nrhs,
-                 &_A[0,0], &n_pars, # lda = same as n
-                 &ipiv[0,0], &p[0], &n_pars, # ldb = same as n
-                 &work[0,0], &lwork[0,0],
-                 &info)
-
-    if info != 0:
-        raise ValueError("Failed to 'solve'.")
-
-    for k in range(n_times):
-        y2 = 0.
-        for i in range(n_pars):
-            y2 += A_T[i,k] * p[i]
+        int i, j
+        int n_offsets = F_T.shape[0] - n_trend
+        int n_times = t.shape[0]
 
-        # don't need log term for the jitter b.c. in likelihood func
-        dy = y2 - y[k]
-        chi2 += dy*dy * ivar[k]
+    for j in range(n_times):
+        F_T[0, j] = 1.
+        for i in range(1, n_trend):
+            F_T[i, j] = F_T[i-1, j] * (t[j] - t0)
 
-    return chi2
+        for i in range(n_offsets):
+            F_T[n_trend + i, j] = float(inst_idx[j] == i + 1)
 
 
-cdef double logdet(double[:,::1] A):
-    """Compute the log-determinant of the (assumed) square, symmetric matrix A.
+cdef int cholesky(double[:,::1] A, double[:,::1] L, double *log_det):
+    """Cholesky factorize the symmetric, positive-definite matrix A.
 
     Parameters
     ----------
     A : `numpy.ndarray`
         The input matrix.
 
+    Outputs
+    -------
+    L : `numpy.ndarray`
+        The Cholesky factor, to be passed to ``cho_solve()``.
+    log_det : double
+        Log-determinant of A.
+
     Returns
     -------
-    log_det : float
-        Log-determinant value.
+    info : int
+        0 on success, otherwise the LAPACK ``dpotrf`` error code.
 
     """
     cdef:
         int i
-        int n_pars = A.shape[0] # A is assumed symmetric
-        int info = 0 # if 0, success, otherwise some whack shit hapnd
-        int[:,::1] ipiv = np.ones((n_pars, n_pars), dtype=np.int32)
+        int n = A.shape[0]
+        int info = 0
+        char* uplo = 'L'
 
-        double log_det = 0.
-
-        double[:,::1] B = np.zeros((A.shape[0], A.shape[1]))
+    L[:,:] = A
+    lapack.dpotrf(uplo, &n, &L[0,0], &n, &info)
+    if info != 0:
+        return info
 
-    # Copy because factorization is done in place
-    B[:,:] = A
+    log_det[0] = 0.
+    for i in range(n):
+        log_det[0] += 2 * log(L[i,i])
 
-    # LU factorization of B
-    lapack.dgetrf(&n_pars, &n_pars, &B[0,0], &n_pars, &ipiv[0,0], &info)
+    return 0
 
-    # Compute determinant
-    for i in range(n_pars):
-        log_det += log(fabs(B[i,i]))
 
-    if info != 0:
-        raise ValueError("Log-determinant function failed.")
+cdef int cho_solve(double[:,::1] L, double *B, int nrhs):
+    """Solve A X = B in place, given the Cholesky factor of A from
+    ``cholesky()``. ``B`` is a C-contiguous array with shape ``(nrhs, n)``,
+    i.e. each row is a right-hand side.
+    """
+    cdef:
+        int n = L.shape[0]
+        int info = 0
+        char* uplo = 'L'
 
-    return log_det
+    lapack.dpotrs(uplo, &n, &nrhs, &L[0,0], &n, B, &n, &info)
+    return info
 
 
-cdef double logdet_term(double[:,::1] ATCinvA, double[::1] ivar):
-    """Compute the log-determinant term of the log-likelihood."""
+cdef double logsumexp(double[::1] x):
+    """Compute log(sum(exp(x))) for the input array."""
     cdef:
         int i
-        int n_pars = ATCinvA.shape[0] # symmetric
-        int n_times = ivar.shape[0]
-        double ld
+        int n = x.shape[0]
+        double max_x = -INFINITY
+        double tot = 0.
+
+    for i in range(n):
+        if x[i] > max_x:
+            max_x = x[i]
+
+    if max_x == -INFINITY:
+        return max_x
+
+    for i in range(n):
+        tot += exp(x[i] - max_x)
+
+    return max_x + log(tot)
+
+
+cdef class TrendBlock:
+    """The parts of the normal equations for the linear parameters that only
+    involve the velocity trend and instrument offsets, and so are the same for
+    all prior samples.
+
+    The data are split into groups that share a jitter value: either all of
+    the data, or the data from each instrument. The normal equations are
+    accumulated separately for each group and for one or more jitter values,
+    indexed by ``v`` (the "slot") below. The full system is then the sum over
+    groups for a given combination of slots, indexed by ``c`` (the
+    "configuration"). Changing the jitter of one group therefore only
+    requires recomputing the partial sums of that group.
+
+    Parameters
+    ----------
+    t : `numpy.ndarray`
+        Data time array.
+    t0 : double
+        Reference time.
+    inst_idx : `numpy.ndarray`
+        Integer index of the instrument for each data point.
+    n_trend : int
+        Number of terms in the polynomial velocity trend.
+    n_offsets : int
+        Number of instrument offsets (number of instruments - 1).
+    group_idx : `numpy.ndarray`
+        Integer index of the jitter group for each data point.
+    n_groups : int
+        Number of jitter groups.
+    n_slots : int
+        Number of jitter values to store partial sums for.
+    n_config : int
+        Number of combinations of jitter values to store.
+
+    """
+    cdef:
+        int n_fixed, n_times, n_groups
+        int[::1] group_idx
+        double[:,::1] F_T # transpose of the (scaled) trend design matrix
+        double[::1] scale # scale factor of each column of the design matrix
+        double[::1] y # the RV data
+        double[:,::1] ivar # inverse-variance, with jitter, for each slot
+
+        # partial sums for each group and slot
+        double[:,:,:,::1] FCF_p # F^T C^-1 F
+        double[:,:,::1] FCy_p # F^T C^-1 y
+        double[:,::1] yCy_p # y^T C^-1 y
+        double[:,::1] sum_ln_ivar_p # sum of log inverse-variances
+
+        # the full system for each configuration
+        int[:,::1] slots # the slot used for each group
+        double[:,:,::1] FCF # F^T C^-1 F
+        double[:,:,::1] L # Cholesky factor of F^T C^-1 F
+        double[:,::1] FCy # F^T C^-1 y
+        double[:,::1] Wb # (F^T C^-1 F)^-1 F^T C^-1 y
+        double[::1] chi2 # chi-squared of the best-fit trend
+        double[::1] ln_det # log-determinant of F^T C^-1 F
+        double[::1] sum_ln_ivar # sum of log inverse-variances
+        int[::1] status # 0 if the factorization succeeded
+
+    def __init__(self, double[::1] t, double t0, int[::1] inst_idx,
+                 int n_trend, int n_offsets, int[::1] group_idx, int n_groups,
+                 int n_slots, Py_ssize_t n_config):
+        cdef:
+            int i, k
+            int n_fixed = n_trend + n_offsets
+            double max_F
+
+        self.n_fixed = n_fixed
+        self.n_times = t.shape[0]
+        self.n_groups = n_groups
+        self.group_idx = group_idx
+
+        self.F_T = np.zeros((n_fixed, self.n_times))
+        trend_design_matrix(t, t0, inst_idx, n_trend, self.F_T)
+
+        # Powers of t - t0 span many orders of magnitude, which makes the
+        # normal equations badly conditioned, especially for long periods
+        # where the Keplerian part is itself close to a polynomial. The
+        # columns are therefore scaled to a maximum absolute value of 1: this
+        # changes the linear parameters and the log-determinant, which are
+        # corrected for below, but not the chi-squared.
+        self.scale = np.ones(n_fixed)
+        for i in range(n_fixed):
+            max_F = 0.
+            for k in range(self.n_times):
+                max_F = max(max_F, fabs(self.F_T[i, k]))
+
+            if max_F > 0:
+                self.scale[i] = 1 / max_F
+                for k in range(self.n_times):
+                    self.F_T[i, k] *= self.scale[i]
+
+        self.ivar = np.zeros((n_slots, self.n_times))
+        self.FCF_p = np.zeros((n_groups, n_slots, n_fixed, n_fixed))
+        self.FCy_p = np.zeros((n_groups, n_slots, n_fixed))
+        self.yCy_p = np.zeros((n_groups, n_slots))
+        self.sum_ln_ivar_p = np.zeros((n_groups, n_slots))
+
+        self.slots = np.zeros((n_config, n_groups), dtype=np.int32)
+        self.FCF = np.zeros((n_config, n_fixed, n_fixed))
+        self.L = np.zeros((n_config, n_fixed, n_fixed))
+        self.FCy = np.zeros((n_config, n_fixed))
+        self.Wb = np.zeros((n_config, n_fixed))
+        self.chi2 = np.zeros(n_config)
+        self.ln_det = np.zeros(n_config)
+        self.sum_ln_ivar = np.zeros(n_config)
+        self.status = np.ones(n_config, dtype=np.int32)
+
+    cdef void set_slot(self, int v, double[::1] ivar, double[::1] y,
+                       double[::1] s):
+        """Compute the partial sums for slot ``v``, with jitter ``s[q]`` (in
+        the same units as the RV data) for group ``q``.
+        """
+        cdef:
+            int i, j, k, q
+            double w
+
+        self.y = y
+        for q in range(self.n_groups):
+            self.yCy_p[q, v] = 0.
+            self.sum_ln_ivar_p[q, v] = 0.
+            for i in range(self.n_fixed):
+                self.FCy_p[q, v, i] = 0.
+                for j in range(self.n_fixed):
+                    self.FCF_p[q, v, i, j] = 0.
+
+        for k in range(self.n_times):
+            q = self.group_idx[k]
+            w = ivar[k] / (1 + s[q]*s[q] * ivar[k])
+            self.ivar[v, k] = w
+
+            self.yCy_p[q, v] += y[k] * w * y[k]
+            self.sum_ln_ivar_p[q, v] += log(w)
+            for i in range(self.n_fixed):
+                self.FCy_p[q, v, i] += self.F_T[i, k] * w * y[k]
+                for j in range(i + 1):
+                    self.FCF_p[q, v, i, j] += (self.F_T[i, k] * w *
+                                               self.F_T[j, k])
+
+        for q in range(self.n_groups):
+            for i in range(self.n_fixed):
+                for j in range(i):
+                    self.FCF_p[q, v, j, i] = self.FCF_p[q, v, i, j]
+
+    cdef void set_config(self, Py_ssize_t c):
+        """Sum the partial sums of each group, using the slots in
+        ``self.slots[c]``, and solve the trend-only system for configuration
+        ``c``.
+        """
+        cdef:
+            int i, j, q, v
+            double yCy = 0.
+
+        self.sum_ln_ivar[c] = 0.
+        for i in range(self.n_fixed):
+            self.FCy[c, i] = 0.
+            for j in range(self.n_fixed):
+                self.FCF[c, i, j] = 0.
+
+        for q in range(self.n_groups):
+            v = self.slots[c, q]
+            yCy += self.yCy_p[q, v]
+            self.sum_ln_ivar[c] += self.sum_ln_ivar_p[q, v]
+            for i in range(self.n_fixed):
+                self.FCy[c, i] += self.FCy_p[q, v, i]
+                for j in range(self.n_fixed):
+                    self.FCF[c, i, j] += self.FCF_p[q, v, i, j]
+
+        self.status[c] = cholesky(self.FCF[c], self.L[c], &self.ln_det[c])
+        if self.status[c] != 0:
+            return
+
+        # log-determinant for the unscaled design matrix
+        for i in range(self.n_fixed):
+            self.ln_det[c] -= 2 * log(self.scale[i])
+
+        self.Wb[c, :] = self.FCy[c]
+        cho_solve(self.L[c], &self.Wb[c, 0], 1)
+
+        self.chi2[c] = yCy
+        for i in range(self.n_fixed):
+            self.chi2[c] -= self.FCy[c, i] * self.Wb[c, i]
+
+    cdef Py_ssize_t grid_configs(self, int n_grid):
+        """Set up configurations for all combinations of the first
+        ``n_grid`` slots over the groups. Returns the number of
+        configurations, ``n_grid ** n_groups``.
+        """
+        cdef:
+            int q
+            Py_ssize_t c, tmp
+            Py_ssize_t n_config = 1
+
+        for q in range(self.n_groups):
+            n_config *= n_grid
+
+        for c in range(n_config):
+            tmp = c
+            for q in range(self.n_groups):
+                self.slots[c, q] = tmp % n_grid
+                tmp = tmp // n_grid
+            self.set_config(c)
+
+        return n_config
+
+
+cdef class KeplerBlock:
+    """The parts of the normal equations for the linear parameters that
+    involve the Keplerian part of the velocity curve, which change with each
+    prior sample. The full system is solved using the Schur complement of the
+    (precomputed) trend block, so the work per sample only scales with the
+    number of trend terms and instrument offsets, not its square.
+
+    As for `TrendBlock`, partial sums are stored for each jitter group and
+    slot, and are combined for each configuration.
+
+    Parameters
+    ----------
+    n_kepler : int
+        Number of linear parameters in the Keplerian part of the model.
+    n_fixed : int
+        Number of velocity trend terms and instrument offsets.
+    n_times : int
+        Number of data points.
+    n_groups : int
+        Number of jitter groups.
+    n_slots : int
+        Number of jitter values to store partial sums for.
+
+    """
+    cdef:
+        int n_kepler, n_fixed, n_times, n_groups
+        double[:,::1] K_T # transpose of the Keplerian design matrix
+
+        # partial sums for each group and slot
+        double[:,:,:,::1] kCk_p # K^T C^-1 K
+        double[:,:,:,::1] kCF_p # K^T C^-1 F
+        double[:,:,::1] kCy_p # K^T C^-1 y
+
+        # the full system for the last configuration used
+        double[:,::1] kCk
+        double[:,::1] kCF
+        double[::1] kCy
+        double[:,::1] X # (F^T C^-1 F)^-1 F^T C^-1 K, transposed
+        double[:,::1] S # Schur complement
+        double[:,::1] L # Cholesky factor of S
+        double[::1] bs # reduced right-hand side
+        double[::1] pk # best-fit Keplerian linear parameters
+        double[:,::1] R_T # Keplerian design matrix minus its projection
+                          # onto the trend, transposed
+
+    def __init__(self, int n_kepler, int n_fixed, int n_times, int n_groups,
+                 int n_slots):
+        self.n_kepler = n_kepler
+        self.n_fixed = n_fixed
+        self.n_times = n_times
+        self.n_groups = n_groups
+
+        self.K_T = np.zeros((n_kepler, n_times))
+        self.kCk_p = np.zeros((n_groups, n_slots, n_kepler, n_kepler))
+        self.kCF_p = np.zeros((n_groups, n_slots, n_kepler, n_fixed))
+        self.kCy_p = np.zeros((n_groups, n_slots, n_kepler))
+
+        self.kCk = np.zeros((n_kepler, n_kepler))
+        self.kCF = np.zeros((n_kepler, n_fixed))
+        self.kCy = np.zeros(n_kepler)
+        self.X = np.zeros((n_kepler, n_fixed))
+        self.S = np.zeros((n_kepler, n_kepler))
+        self.L = np.zeros((n_kepler, n_kepler))
+        self.bs = np.zeros(n_kepler)
+        self.pk = np.zeros(n_kepler)
+        self.R_T = np.zeros((n_kepler, n_times))
+
+    cdef void set_slot(self, TrendBlock trend, int v, double[::1] y):
+        """Compute the partial sums of the Keplerian rows of the normal
+        equations with the inverse-variance of slot ``v``.
+        """
+        cdef:
+            int a, b, i, k, q
+            double w
+
+        for q in range(self.n_groups):
+            for a in range(self.n_kepler):
+                self.kCy_p[q, v, a] = 0.
+                for b in range(self.n_kepler):
+                    self.kCk_p[q, v, a, b] = 0.
+                for i in range(self.n_fixed):
+                    self.kCF_p[q, v, a, i] = 0.
+
+        for k in range(self.n_times):
+            q = trend.group_idx[k]
+            w = trend.ivar[v, k]
+            for a in range(self.n_kepler):
+                self.kCy_p[q, v, a] += self.K_T[a, k] * w * y[k]
+                for b in range(self.n_kepler):
+                    self.kCk_p[q, v, a, b] += (self.K_T[a, k] * w *
+                                               self.K_T[b, k])
+                for i in range(self.n_fixed):
+                    self.kCF_p[q, v, a, i] += (self.K_T[a, k] * w *
+                                               trend.F_T[i, k])
+
+    cdef double ln_likelihood(self, TrendBlock trend, Py_ssize_t c):
+        """Compute the marginal log-likelihood for the current Keplerian
+        design matrix, ``K_T``, with jitter configuration ``c``. The partial
+        sums must have been computed for all slots used by the configuration.
+        """
+        cdef:
+            int a, b, i, q, v
+            double ln_det_S, chi2
+            int refine = 0
+
+        if trend.status[c] != 0:
+            return NAN
+
+        for a in range(self.n_kepler):
+            self.kCy[a] = 0.
+            for b in range(self.n_kepler):
+                self.kCk[a, b] = 0.
+            for i in range(self.n_fixed):
+                self.kCF[a, i] = 0.
+
+        for q in range(self.n_groups):
+            v = trend.slots[c, q]
+            for a in range(self.n_kepler):
+                self.kCy[a] += self.kCy_p[q, v, a]
+                for b in range(self.n_kepler):
+                    self.kCk[a, b] += self.kCk_p[q, v, a, b]
+                for i in range(self.n_fixed):
+                    self.kCF[a, i] += self.kCF_p[q, v, a, i]
+
+        self.X[:, :] = self.kCF
+        cho_solve(trend.L[c], &self.X[0, 0], self.n_kepler)
+
+        for a in range(self.n_kepler):
+            self.bs[a] = self.kCy[a]
+            for i in range(self.n_fixed):
+                self.bs[a] -= self.kCF[a, i] * trend.Wb[c, i]
+
+            for b in range(self.n_kepler):
+                self.S[a, b] = self.kCk[a, b]
+                for i in range(self.n_fixed):
+                    self.S[a, b] -= self.kCF[a, i] * self.X[b, i]
+
+            # For long periods, the Keplerian part of the model can be
+            # almost a polynomial in time, so that most digits cancel when
+            # the projection onto the trend is subtracted
+            if self.S[a, a] < REFINE_TOL * self.kCk[a, a]:
+                refine = 1
+
+        if refine:
+            self.refine_normal_equations(trend, c)
+
+        if cholesky(self.S, self.L, &ln_det_S) != 0:
+            return NAN
+
+        self.pk[:] = self.bs
+        cho_solve(self.L, &self.pk[0], 1)
+
+        if refine:
+            chi2 = self.residual_chi2(trend, c)
+
+        else:
+            chi2 = trend.chi2[c]
+            for a in range(self.n_kepler):
+                chi2 -= self.bs[a] * self.pk[a]
+
+        # log-determinant of the full A^T C^-1 A is the sum of the trend block
+        # and Schur complement log-determinants
+        return 0.5 * (trend.ln_det[c] + ln_det_S
+                      - (self.n_kepler + self.n_fixed) * LN_2PI
+                      + trend.sum_ln_ivar[c] - self.n_times * LN_2PI
+                      - chi2)
+
+    cdef void refine_normal_equations(self, TrendBlock trend, Py_ssize_t c):
+        """Recompute the Schur complement and reduced right-hand side from the
+        residuals of the Keplerian design matrix after projecting out the
+        trend, which avoids the cancellation in ``ln_likelihood()``.
+        """
+        cdef:
+            int a, b, i, k
+            double w
+
+        for a in range(self.n_kepler):
+            self.bs[a] = 0.
+            for b in range(self.n_kepler):
+                self.S[a, b] = 0.
+
+        for k in range(self.n_times):
+            for a in range(self.n_kepler):
+                self.R_T[a, k] = self.K_T[a, k]
+                for i in range(self.n_fixed):
+                    self.R_T[a, k] -= trend.F_T[i, k] * self.X[a, i]
+
+        for k in range(self.n_times):
+            w = trend.ivar[trend.slots[c, trend.group_idx[k]], k]
+            for a in range(self.n_kepler):
+                self.bs[a] += self.R_T[a, k] * w * trend.y[k]
+                for b in range(self.n_kepler):
+                    self.S[a, b] += self.R_T[a, k] * w * self.R_T[b, k]
+
+    cdef double residual_chi2(self, TrendBlock trend, Py_ssize_t c):
+        """Compute the chi-squared of the best-fit model directly from the
+        residuals, using the best-fit Keplerian linear parameters ``pk``.
+        """
+        cdef:
+            int a, i, k
+            double w, r
+            double chi2 = 0.
+
+        for k in range(self.n_times):
+            # the best-fit trend is Wb - X^T pk, so the model is R^T pk + F Wb
+            r = trend.y[k]
+            for a in range(self.n_kepler):
+                r -= self.R_T[a, k] * self.pk[a]
+            for i in range(self.n_fixed):
+                r -= trend.F_T[i, k] * trend.Wb[c, i]
+
+            w = trend.ivar[trend.slots[c, trend.group_idx[k]], k]
+            chi2 += r * w * r
+
+        return chi2
+
+    def sample_linear(self, TrendBlock trend, Py_ssize_t c, rnd):
+        """Draw the linear parameters from their conditional posterior, using
+        the normal equations from the last call to ``ln_likelihood()``.
+        """
+        n_k = self.n_kepler
+        n_pars = self.n_kepler + self.n_fixed
+
+        ATCinvA = np.zeros((n_pars, n_pars))
+        ATCinvA[:n_k, :n_k] = self.kCk
+        ATCinvA[:n_k, n_k:] = self.kCF
+        ATCinvA[n_k:, :n_k] = np.asarray(self.kCF).T
+        ATCinvA[n_k:, n_k:] = trend.FCF[c]
+        ATCinvy = np.concatenate((self.kCy, trend.FCy[c]))
+
+        p = np.linalg.solve(ATCinvA, ATCinvy)
+        cov = np.linalg.inv(ATCinvA)
 
-    ld = logdet(ATCinvA)
-    ld -= n_pars * LN_2PI
+        # undo the scaling of the trend design matrix
+        p = rnd.multivariate_normal(p, cov)
+        p[n_k:] *= trend.scale
+        return p
 
-    for i in range(n_times):
-        ld = ld + log(ivar[i])
-    ld = ld - n_times * LN_2PI
 
-    return ld
+def _jitter_groups(data, joker_params):
+    """Return the number of jitter groups and the group index of each data
+    point: each instrument has its own jitter if
+    ``joker_params.per_instrument_jitter`` is set.
+    """
+    if joker_params.per_instrument_jitter:
+        return (data.n_instruments,
+                np.ascontiguousarray(data._instrument_idx, dtype=np.int32))
+    else:
+        return 1, np.zeros(len(data), dtype=np.int32)
+
+
+def _n_jitter_configs(n_grid, n_groups):
+    """Return the number of combinations of jitter grid values,
+    ``n_grid ** n_groups``, or raise a ValueError if there are more than
+    ``MAX_JITTER_CONFIGS``.
+    """
+    n_config = int(n_grid) ** int(n_groups)
+    if n_config > MAX_JITTER_CONFIGS:
+        raise ValueError("A jitter grid of {0} points for each of {1} "
+                         "instruments has {2} combinations of jitter values, "
+                         "more than the maximum of {3}. Use a smaller "
+                         "jitter_grid."
+                         .format(n_grid, n_groups, n_config,
+                                 MAX_JITTER_CONFIGS))
+    return n_config
 
 
 cpdef batch_marginal_ln_likelihood(double[:,::1] chunk,
@@ -257,14 +801,19 @@ cpdef batch_marginal_ln_likelihood(double[:,::1] chunk,
     data : `~thejoker.data.RVData`
         The radial velocity data.
     joker_params : `~thejoker.sampler.params.JokerParams`
-        The specification of parameters to infer with The Joker.
+        The specification of parameters to infer with The Joker. If
+        ``joker_params.jitter_grid`` is set, the jitter values in the chunk
+        are ignored and the likelihood is marginalized over the jitter (of
+        each instrument, if ``joker_params.per_instrument_jitter`` is set).
     """
 
     cdef:
-        int n
+        int n, g
+        Py_ssize_t c
         int n_samples = chunk.shape[0]
         int n_times = len(data)
-        int n_pars = 2 # always have K, v0
+        int marginalize_omega = int(joker_params.marginalize_omega)
+        int n_trend = joker_params.poly_trend
 
         double anomaly_tol = 1E-10
         int anomaly_maxiter = 128
@@ -272,63 +821,99 @@ cpdef batch_marginal_ln_likelihood(double[:,::1] chunk,
         double[::1] t = np.ascontiguousarray(data._t_bmjd, dtype='f8')
         double[::1] rv = np.ascontiguousarray(data.rv.value, dtype='f8')
         double[::1] ivar = np.ascontiguousarray(data.ivar.value, dtype='f8')
-
-        # inverse variance array with jitter included
-        double[::1] jitter_ivar = np.zeros(data.ivar.value.shape)
-
-        # transpose of design matrix
-        double[:,::1] A_T = np.zeros((n_pars, n_times))
-        double[:,::1] ATCinvA = np.zeros((n_pars, n_pars))
-        double[::1] p = np.zeros(n_pars)
-        double logdet
+        int[::1] inst_idx = np.ascontiguousarray(data._instrument_idx,
+                                                 dtype=np.int32)
+        int n_offsets = data.n_instruments - 1
 
         # likelihoodz
         double[::1] ll = np.full(n_samples, np.nan)
 
         # lol
         double t0 = data._t0_bmjd
-        int _fixed_jitter
-        double jitter
-
-    # TODO: we need a test of this hack
-    if joker_params._fixed_jitter:
-        _fixed_jitter = 1
-        jitter = joker_params.jitter.to(data.rv.unit).value
+        int _fixed_jitter = int(joker_params._fixed_jitter)
+
+        # groups of data points that share a jitter value
+        int n_groups
+        int[::1] group_idx
+        double[::1] jitter
+
+        # jitter grid: values in RV units, and log-weights
+        int n_grid = 0
+        Py_ssize_t n_config = 1
+        double[::1] grid_s
+        double[::1] grid_ln_w
+        double[::1] config_ln_w
+        double[::1] config_ll
+
+        TrendBlock trend
+        KeplerBlock kepler
+
+    n_groups, group_idx = _jitter_groups(data, joker_params)
+    jitter = np.zeros(n_groups)
+
+    # the trend block only depends on the jitter, so we precompute it for
+    # the fixed jitter value or each combination of jitter values on the grid
+    if joker_params.jitter_grid is not None:
+        _, grid_s, grid_ln_w, _ = jitter_grid(joker_params, data.rv.unit)
+        n_grid = grid_s.shape[0]
+        n_config = _n_jitter_configs(n_grid, n_groups)
+
+        trend = TrendBlock(t, t0, inst_idx, n_trend, n_offsets,
+                           group_idx, n_groups, n_grid, n_config)
+        for g in range(n_grid):
+            jitter[:] = grid_s[g]
+            trend.set_slot(g, ivar, rv, jitter)
+        trend.grid_configs(n_grid)
+
+        config_ln_w = np.zeros(n_config)
+        for c in range(n_config):
+            for g in range(n_groups):
+                config_ln_w[c] += grid_ln_w[trend.slots[c, g]]
+        config_ll = np.zeros(n_config)
 
     else:
-        _fixed_jitter = 0
-
-    for n in range(n_samples):
-        if _fixed_jitter == 0:
-            jitter = chunk[n,4]
+        trend = TrendBlock(t, t0, inst_idx, n_trend, n_offsets,
+                           group_idx, n_groups, 1, 1)
+        if _fixed_jitter:
+            # jitter must be in same units as the data RV's / ivar!
+            jitter[:] = joker_params.jitter.to(data.rv.unit).value
+            trend.set_slot(0, ivar, rv, jitter)
+            trend.set_config(0)
 
-        try:
-            # TODO: hard set n_trend=1 (v0) because removing support for that
-            design_matrix(chunk[n,0], chunk[n,1], chunk[n,2], chunk[n,3],
-                          t, t0, A_T, 1, anomaly_tol, anomaly_maxiter)
+    kepler = KeplerBlock(1 + marginalize_omega, n_trend + n_offsets, n_times,
+                         n_groups, max(n_grid, 1))
 
-            # jitter must be in same units as the data RV's / ivar!
-            get_ivar(ivar, jitter, jitter_ivar)
+    for n in range(n_samples):
+        kepler_design_matrix(chunk[n,0], chunk[n,1], chunk[n,2], chunk[n,3],
+                             t, t0, kepler.K_T, marginalize_omega,
+                             anomaly_tol, anomaly_maxiter)
 
-            # compute things needed for the ln(likelihood)
-            # - ATCinvA, p are populated by the function
-            chi2 = tensor_vector_scalar(A_T, jitter_ivar, rv, ATCinvA, p)
+        if n_grid > 0:
+            # one pass over the data for each jitter value, then combine the
+            # partial sums for all combinations over the groups
+            for g in range(n_grid):
+                kepler.set_slot(trend, g, rv)
 
-            logdet = logdet_term(ATCinvA, jitter_ivar)
+            for c in range(n_config):
+                config_ll[c] = kepler.ln_likelihood(trend, c) + config_ln_w[c]
+            ll[n] = logsumexp(config_ll)
 
-        except Exception as e:
-            ll[n] = np.nan
-            # TODO: could output a log message here...
-            continue
+        else:
+            if not _fixed_jitter:
+                jitter[:] = chunk[n,4]
+                trend.set_slot(0, ivar, rv, jitter)
+                trend.set_config(0)
 
-        ll[n] = 0.5*logdet - 0.5*chi2
+            kepler.set_slot(trend, 0, rv)
+            ll[n] = kepler.ln_likelihood(trend, 0)
 
     return ll
 
 
 cpdef batch_get_posterior_samples(double[:,::1] chunk,
                                   data, joker_params, rnd, return_logprobs):
-    """TODO"
+    """Draw the linear parameters (and, if marginalized over, the jitter) for
+    a batch of prior samples.
 
     Parameters
     ----------
@@ -340,14 +925,28 @@ cpdef batch_get_posterior_samples(double[:,::1] chunk,
     data : `~thejoker.data.RVData`
         The radial velocity data.
     joker_params : `~thejoker.sampler.params.JokerParams`
-        The specification of parameters to infer with The Joker.
+        The specification of parameters to infer with The Joker. If
+        ``joker_params.jitter_grid`` is set, the jitter values in the chunk
+        are ignored and a jitter value is drawn from its (gridded) conditional
+        posterior for each sample.
+
+    Returns
+    -------
+    pars : `numpy.ndarray`
+        The nonlinear parameters, followed by K, the velocity trend terms, the
+        instrument offsets, the jitter of all but the first instrument (if
+        ``joker_params.per_instrument_jitter`` is set), and the
+        log-likelihood (if ``return_logprobs`` is set).
     """
 
     cdef:
-        int n
+        int n, g, i
+        Py_ssize_t c
         int n_samples = chunk.shape[0]
         int n_times = len(data)
-        int n_pars = 2 # always have K, v0
+        int marginalize_omega = int(joker_params.marginalize_omega)
+        int n_kepler = 1 + marginalize_omega
+        int n_trend = joker_params.poly_trend
 
         double anomaly_tol = 1E-10
         int anomaly_maxiter = 128
@@ -355,23 +954,78 @@ cpdef batch_get_posterior_samples(double[:,::1] chunk,
         double[::1] t = np.ascontiguousarray(data._t_bmjd, dtype='f8')
         double[::1] rv = np.ascontiguousarray(data.rv.value, dtype='f8')
         double[::1] ivar = np.ascontiguousarray(data.ivar.value, dtype='f8')
-
-        # inverse variance array with jitter included
-        double[::1] jitter_ivar = np.zeros(data.ivar.value.shape)
-
-        # transpose of design matrix
-        double[:,::1] A_T = np.zeros((n_pars, n_times))
-        double[:,::1] ATCinvA = np.zeros((n_pars, n_pars))
-        double[::1] p = np.zeros(n_pars)
-        double logdet
+        int[::1] inst_idx = np.ascontiguousarray(data._instrument_idx,
+                                                 dtype=np.int32)
+        int n_offsets = data.n_instruments - 1
+        int n_lin = 6 + n_trend + n_offsets # index after the linear params
 
         # lol
         double t0 = data._t0_bmjd
-        int _fixed_jitter
-        double jitter
+        int _fixed_jitter = int(joker_params._fixed_jitter)
+        double K, omega, ln_like
+        double[::1] linear_p
+
+        # groups of data points that share a jitter value
+        int n_groups
+        int[::1] group_idx
+        double[::1] jitter
+
+        # jitter grid: log(s^2) values, log-weights, and the cell width
+        int n_grid = 0
+        Py_ssize_t n_config = 1
+        double[::1] grid_y
+        double[::1] grid_s
+        double[::1] grid_ln_w
+        double[::1] config_ln_w
+        double[::1] config_ll
+        double grid_dy, jitter_fac, ln_norm
+
+        TrendBlock trend
+        KeplerBlock kepler
+
+        double[:,::1] pars
+
+    n_groups, group_idx = _jitter_groups(data, joker_params)
+    jitter = np.zeros(n_groups)
+
+    # one column for each instrument offset after the trend terms, then the
+    # jitter of the other instruments
+    pars = np.zeros((n_samples, joker_params.num_params + n_offsets +
+                     n_groups - 1 + int(return_logprobs)))
+
+    if joker_params.jitter_grid is not None:
+        grid_y, grid_s, grid_ln_w, grid_dy = jitter_grid(joker_params,
+                                                         data.rv.unit)
+        n_grid = grid_y.shape[0]
+        n_config = _n_jitter_configs(n_grid, n_groups)
+        jitter_fac = joker_params._jitter_unit.to(data.rv.unit)
+
+        # the last slot and configuration are for the jitter values drawn
+        # for each sample
+        trend = TrendBlock(t, t0, inst_idx, n_trend, n_offsets,
+                           group_idx, n_groups, n_grid + 1, n_config + 1)
+        for g in range(n_grid):
+            jitter[:] = grid_s[g]
+            trend.set_slot(g, ivar, rv, jitter)
+        trend.grid_configs(n_grid)
+        trend.slots[n_config, :] = n_grid
+
+        config_ln_w = np.zeros(n_config)
+        for c in range(n_config):
+            for g in range(n_groups):
+                config_ln_w[c] += grid_ln_w[trend.slots[c, g]]
+        config_ll = np.zeros(n_config)
+
+    else:
+        trend = TrendBlock(t, t0, inst_idx, n_trend, n_offsets,
+                           group_idx, n_groups, 1, 1)
+        if _fixed_jitter:
+            jitter[:] = joker_params.jitter.to(data.rv.unit).value
+            trend.set_slot(0, ivar, rv, jitter)
+            trend.set_config(0)
 
-        double[:,::1] pars = np.zeros((n_samples,
-            joker_params.num_params + int(return_logprobs)))
+    kepler = KeplerBlock(n_kepler, n_trend + n_offsets, n_times,
+                         n_groups, n_grid + 1)
 
     for n in range(n_samples):
         pars[n, 0] = chunk[n, 0] # P
@@ -380,32 +1034,387 @@ cpdef batch_get_posterior_samples(double[:,::1] chunk,
         pars[n, 3] = chunk[n, 3] # omega
         pars[n, 4] = chunk[n, 4] # jitter
 
-        # TODO: hard set n_trend=1 (v0) because removing support for that
-        design_matrix(chunk[n,0], chunk[n,1], chunk[n,2], chunk[n,3],
-                      t, t0, A_T, 1, anomaly_tol, anomaly_maxiter)
+        kepler_design_matrix(chunk[n,0], chunk[n,1], chunk[n,2], chunk[n,3],
+                             t, t0, kepler.K_T, marginalize_omega,
+                             anomaly_tol, anomaly_maxiter)
+
+        c = 0
+        if n_grid > 0:
+            # pick a grid cell from the conditional posterior of the jitter,
+            # then draw values of log(s^2) uniformly within that cell
+            for g in range(n_grid):
+                kepler.set_slot(trend, g, rv)
+
+            for c in range(n_config):
+                config_ll[c] = kepler.ln_likelihood(trend, c) + config_ln_w[c]
+
+            ln_norm = logsumexp(config_ll)
+            c = rnd.choice(n_config, p=np.exp(np.asarray(config_ll) - ln_norm))
+
+            for g in range(n_groups):
+                jitter[g] = sqrt(exp(grid_y[trend.slots[c, g]] +
+                                     grid_dy * (rnd.uniform() - 0.5)))
+                jitter[g] = jitter[g] * jitter_fac
+
+            c = n_config
+            trend.set_slot(n_grid, ivar, rv, jitter)
+            trend.set_config(c)
+            kepler.set_slot(trend, n_grid, rv)
+
+            pars[n, 4] = jitter[0]
+            for g in range(1, n_groups):
+                pars[n, n_lin + g - 1] = jitter[g]
+
+        else:
+            if not _fixed_jitter:
+                jitter[:] = pars[n, 4]
+                trend.set_slot(0, ivar, rv, jitter)
+                trend.set_config(0)
+            kepler.set_slot(trend, 0, rv)
+
+        ln_like = kepler.ln_likelihood(trend, c)
+        linear_p = kepler.sample_linear(trend, c, rnd)
+
+        if marginalize_omega:
+            # linear parameters are K cos(omega), K sin(omega)
+            K = sqrt(linear_p[0]*linear_p[0] + linear_p[1]*linear_p[1])
+            omega = atan2(linear_p[1], linear_p[0])
+            if omega < 0:
+                omega += TWO_PI
+            pars[n, 3] = omega
+
+        else:
+            K = linear_p[0]
+            if K < 0:
+                K = -K
+                pars[n, 3] += np.pi
+                pars[n, 3] = pars[n, 3] % (2*np.pi) # HACK: I think this is safe
 
-        # jitter must be in same units as the data RV's / ivar!
-        get_ivar(ivar, chunk[n,4], jitter_ivar)
+        pars[n, 5] = K
+        for i in range(n_trend + n_offsets):
+            pars[n, 6 + i] = linear_p[n_kepler + i] # v0, v1, ..., offsets
 
-        # compute things needed for the ln(likelihood)
-        # - ATCinvA, p are populated by the function
-        chi2 = tensor_vector_scalar(A_T, jitter_ivar, rv, ATCinvA, p)
-        logdet = logdet_term(ATCinvA, jitter_ivar)
+        if return_logprobs:
+            pars[n, n_lin + n_groups - 1] = ln_like
 
-        cov = np.linalg.inv(ATCinvA)
-        K, *v_terms = rnd.multivariate_normal(p, cov)
+    return np.array(pars)
 
-        if K < 0:
-            # log.warning("Swapping K")
-            K = np.abs(K)
-            pars[n, 3] += np.pi
-            pars[n, 3] = pars[n, 3] % (2*np.pi) # HACK: I think this is safe
 
-        pars[n, 5] = K
-        pars[n, 6] = v_terms[0] # HACK: we know it's just v0
+cdef inline double norm_logpdf(double x, double mu, double std):
+    return -0.5 * (((x - mu) / std)**2 + LN_2PI) - log(std)
 
-        if return_logprobs:
-            logdet = logdet_term(ATCinvA, jitter_ivar)
-            pars[n, 7] = 0.5*logdet - 0.5*chi2 # ln_likelihood
 
-    return np.array(pars)
+cdef class MCMCPosterior:
+    """The log-posterior used by `~thejoker.sampler.mcmc.TheJokerMCMCModel`,
+    as a function of the MCMC parameters, i.e. :math:`\ln P`,
+    :math:`\sqrt{K}\cos(M_0-\omega)`, :math:`\sqrt{K}\sin(M_0-\omega)`,
+    :math:`\sqrt{e}\cos\omega`, :math:`\sqrt{e}\sin\omega`,
+    :math:`\ln s^2` (if the jitter is not fixed), the velocity trend terms,
+    the instrument offsets, and :math:`\ln s^2` for each other instrument
+    (if ``joker_params.per_instrument_jitter`` is set).
+
+    The data arrays and the trend block of the design matrix are computed
+    once, and the (hard-coded) priors are evaluated inline, so evaluating the
+    posterior doesn't touch any Python objects.
+
+    Parameters
+    ----------
+    data : `~thejoker.data.RVData`
+        The radial velocity data.
+    joker_params : `~thejoker.sampler.params.JokerParams`
+        The specification of parameters to infer with The Joker.
+
+    """
+    cdef:
+        object data, joker_params
+        int n_times, n_lin, n_groups, i0, _n_dim
+        int fixed_jitter, anomaly_maxiter
+        double t0, anomaly_tol, P_min, P_max
+        double s_fixed, jitter_mu, jitter_std, ln_jitter_factor
+        double ln_beta_norm
+
+        double[::1] t
+        double[::1] rv
+        double[::1] ivar
+        double[::1] s # scratch: jitter of each group
+        double[::1] d_s2 # scratch: d(ln_like) / d(s^2) for each group
+        int[::1] group_idx
+        double[:,::1] F_T # transpose of the trend design matrix
+        double[:,::1] K_T # scratch: transpose of the Keplerian design matrix
+
+    def __init__(self, data, joker_params):
+        self.data = data
+        self.joker_params = joker_params
+
+        self.t = np.ascontiguousarray(data._t_bmjd, dtype='f8')
+        self.rv = np.ascontiguousarray(data.rv.value, dtype='f8')
+        self.ivar = np.ascontiguousarray(data.ivar.value, dtype='f8')
+        self.t0 = data._t0_bmjd
+        self.n_times = len(data)
+
+        n_offsets = data.n_instruments - 1
+        self.n_lin = joker_params.poly_trend + n_offsets
+        self.F_T = np.zeros((self.n_lin, self.n_times))
+        trend_design_matrix(self.t, self.t0,
+                            np.ascontiguousarray(data._instrument_idx,
+                                                 dtype=np.int32),
+                            joker_params.poly_trend, self.F_T)
+        self.K_T = np.zeros((1, self.n_times))
+
+        self.n_groups, self.group_idx = _jitter_groups(data, joker_params)
+        self.s = np.zeros(self.n_groups)
+        self.d_s2 = np.zeros(self.n_groups)
+
+        self.fixed_jitter = int(joker_params._fixed_jitter)
+        if self.fixed_jitter:
+            self.s_fixed = joker_params.jitter.to(data.rv.unit).value
+        else:
+            self.jitter_mu, self.jitter_std = joker_params.jitter
+            self.ln_jitter_factor = log(
+                data.rv.unit.to(joker_params._jitter_unit))
+
+        self.P_min = joker_params.P_min.to('day').value
+        self.P_max = joker_params.P_max.to('day').value
+        self.anomaly_tol = joker_params.anomaly_tol
+        self.anomaly_maxiter = joker_params.anomaly_maxiter
+
+        self.ln_beta_norm = (lgamma(ECC_BETA_A + ECC_BETA_B) -
+                             lgamma(ECC_BETA_A) - lgamma(ECC_BETA_B))
+
+        # index of the first velocity trend term
+        self.i0 = 5 + (1 - self.fixed_jitter)
+        self._n_dim = self.i0 + self.n_lin + self.n_groups - 1
+
+    def __reduce__(self):
+        return (MCMCPosterior, (self.data, self.joker_params))
+
+    @property
+    def n_dim(self):
+        return self._n_dim
+
+    cdef double _ln_posterior(self, double[::1] x):
+        cdef:
+            int i, k, q
+            double P, M0, ecc, omega, K, y
+            double w, dy, lnp, lnl = 0.
+
+        # transform from the MCMC parameters
+        P = exp(x[0])
+        if P < self.P_min or P > self.P_max:
+            return -INFINITY
+
+        ecc = x[3]*x[3] + x[4]*x[4]
+        if ecc > 1:
+            return -INFINITY
+
+        K = x[1]*x[1] + x[2]*x[2]
+        omega = atan2(x[4], x[3])
+        M0 = atan2(x[2], x[1]) + omega
+
+        # priors
+        lnp = (self.ln_beta_norm + (ECC_BETA_A - 1) * log(ecc) +
+               (ECC_BETA_B - 1) * log(1 - ecc))
+
+        if self.fixed_jitter:
+            self.s[:] = self.s_fixed
+
+        else:
+            # Gaussian prior in ln(s^2) in the units of the jitter prior, for
+            # the jitter of each group
+            for q in range(self.n_groups):
+                if q == 0:
+                    y = x[5]
+                else:
+                    y = x[self.i0 + self.n_lin + q - 1]
+                self.s[q] = sqrt(exp(y))
+                lnp += norm_logpdf(y + 2 * self.ln_jitter_factor,
+                                   self.jitter_mu, self.jitter_std)
+
+        lnp += norm_logpdf(K, 0, LINEAR_PRIOR_STD)
+        lnp += norm_logpdf(x[self.i0], 0, LINEAR_PRIOR_STD)
+
+        # likelihood
+        kepler_design_matrix(P, M0, ecc, omega, self.t, self.t0, self.K_T, 0,
+                             self.anomaly_tol, self.anomaly_maxiter)
+
+        for k in range(self.n_times):
+            dy = K * self.K_T[0, k] - self.rv[k]
+            for i in range(self.n_lin):
+                dy += self.F_T[i, k] * x[self.i0 + i]
+
+            q = self.group_idx[k]
+            w = self.ivar[k] / (1 + self.s[q]*self.s[q] * self.ivar[k])
+            lnl += -dy*dy * w - LN_2PI + log(w)
+
+        lnp += 0.5 * lnl
+        if lnp != lnp: # NaN
+            return -INFINITY
+
+        return lnp
+
+    cdef double _ln_posterior_and_grad(self, double[::1] x,
+                                       double[::1] grad):
+        """Compute the log-posterior and its gradient with respect to the MCMC
+        parameters. The derivatives of the Keplerian velocity curve are
+        computed analytically from the eccentric and true anomalies.
+        """
+        cdef:
+            int i, k, q
+            double P, M0, ecc, omega, K, y, phi_norm, e_norm
+            double w, dy, r, lnp, lnl = 0.
+            double dt, M, E, f, cos_f, sin_f, sin_wf, g, df_dM, df_de
+            double d_P = 0., d_M0 = 0., d_e = 0., d_omega = 0., d_K = 0.
+
+        for i in range(self._n_dim):
+            grad[i] = 0.
+
+        # transform from the MCMC parameters
+        P = exp(x[0])
+        if P < self.P_min or P > self.P_max:
+            return -INFINITY
+
+        ecc = x[3]*x[3] + x[4]*x[4]
+        if ecc > 1:
+            return -INFINITY
+
+        K = x[1]*x[1] + x[2]*x[2]
+        omega = atan2(x[4], x[3])
+        M0 = atan2(x[2], x[1]) + omega
+
+        # priors
+        lnp = (self.ln_beta_norm + (ECC_BETA_A - 1) * log(ecc) +
+               (ECC_BETA_B - 1) * log(1 - ecc))
+        d_e = (ECC_BETA_A - 1) / ecc - (ECC_BETA_B - 1) / (1 - ecc)
+
+        if self.fixed_jitter:
+            self.s[:] = self.s_fixed
+
+        else:
+            for q in range(self.n_groups):
+                if q == 0:
+                    i = 5
+                else:
+                    i = self.i0 + self.n_lin + q - 1
+                y = x[i] + 2 * self.ln_jitter_factor
+                self.s[q] = sqrt(exp(x[i]))
+                lnp += norm_logpdf(y, self.jitter_mu, self.jitter_std)
+                grad[i] = -(y - self.jitter_mu) / self.jitter_std**2
+
+        lnp += norm_logpdf(K, 0, LINEAR_PRIOR_STD)
+        d_K = -K / LINEAR_PRIOR_STD**2
+        lnp += norm_logpdf(x[self.i0], 0, LINEAR_PRIOR_STD)
+        grad[self.i0] = -x[self.i0] / LINEAR_PRIOR_STD**2
+
+        # likelihood
+        for q in range(self.n_groups):
+            self.d_s2[q] = 0.
+
+        for k in range(self.n_times):
+            dt = self.t[k] - self.t0
+            M = TWO_PI * dt / P - M0
+            E = c_eccentric_anomaly_from_mean_anomaly_Newton1(
+                M, ecc, self.anomaly_tol, self.anomaly_maxiter)
+            f = c_true_anomaly_from_eccentric_anomaly(E, ecc)
+            cos_f = cos(f)
+            sin_f = sin(f)
+            sin_wf = sin(omega + f)
+
+            # unit-amplitude velocity curve and derivatives of the true anomaly
+            g = cos(omega + f) + ecc * cos(omega)
+            df_dM = (1 + ecc*cos_f)**2 / (1 - ecc*ecc)**1.5
+            df_de = sin_f * (2 + ecc*cos_f) / (1 - ecc*ecc)
+
+            dy = K * g - self.rv[k]
+            for i in range(self.n_lin):
+                dy += self.F_T[i, k] * x[self.i0 + i]
+
+            q = self.group_idx[k]
+            w = self.ivar[k] / (1 + self.s[q]*self.s[q] * self.ivar[k])
+            lnl += -dy*dy * w - LN_2PI + log(w)
+
+            # d(ln_like) / d(model velocity)
+            r = -dy * w
+            d_K += r * g
+            d_P += r * K * sin_wf * df_dM * TWO_PI * dt / (P*P)
+            d_M0 += r * K * sin_wf * df_dM
+            d_e += r * K * (cos(omega) - sin_wf * df_de)
+            d_omega -= r * K * (sin_wf + ecc * sin(omega))
+            for i in range(self.n_lin):
+                grad[self.i0 + i] += r * self.F_T[i, k]
+            self.d_s2[q] += 0.5 * (dy*dy * w*w - w)
+
+        lnp += 0.5 * lnl
+        if lnp != lnp: # NaN
+            return -INFINITY
+
+        # chain rule to the MCMC parameters: M0 = phi + omega, where
+        # phi = atan2(x2, x1)
+        phi_norm = x[1]*x[1] + x[2]*x[2]
+        e_norm = x[3]*x[3] + x[4]*x[4]
+        grad[0] = d_P * P
+        grad[1] = 2 * x[1] * d_K - x[2] / phi_norm * d_M0
+        grad[2] = 2 * x[2] * d_K + x[1] / phi_norm * d_M0
+        grad[3] = 2 * x[3] * d_e - x[4] / e_norm * (d_omega + d_M0)
+        grad[4] = 2 * x[4] * d_e + x[3] / e_norm * (d_omega + d_M0)
+
+        if not self.fixed_jitter:
+            # d(s^2) / d(ln s^2) = s^2
+            for q in range(self.n_groups):
+                if q == 0:
+                    i = 5
+                else:
+                    i = self.i0 + self.n_lin + q - 1
+                grad[i] += self.d_s2[q] * self.s[q]*self.s[q]
+
+        return lnp
+
+    def ln_posterior_and_grad(self, double[::1] mcmc_p):
+        """Compute the log-posterior and its gradient for a single vector of
+        MCMC parameters.
+
+        Returns
+        -------
+        ln_post : float
+        grad : `numpy.ndarray`
+            The gradient of the log-posterior with respect to the MCMC
+            parameters. This is zero outside of the support of the prior.
+        """
+        cdef:
+            double ln_post
+            double[::1] grad = np.zeros(self._n_dim)
+
+        if mcmc_p.shape[0] != self._n_dim:
+            raise ValueError("Expected {0} parameters, got {1}."
+                             .format(self._n_dim, mcmc_p.shape[0]))
+
+        ln_post = self._ln_posterior_and_grad(mcmc_p, grad)
+        if ln_post == -INFINITY:
+            grad[:] = 0.
+
+        return ln_post, np.array(grad)
+
+    def ln_posterior(self, double[::1] mcmc_p):
+        """Compute the log-posterior for a single vector of MCMC parameters.
+        """
+        if mcmc_p.shape[0] != self._n_dim:
+            raise ValueError("Expected {0} parameters, got {1}."
+                             .format(self._n_dim, mcmc_p.shape[0]))
+        return self._ln_posterior(mcmc_p)
+
+    def batch_ln_posterior(self, double[:,::1] mcmc_p):
+        """Compute the log-posterior for a 2D array of MCMC parameter vectors
+        with shape ``(n_walkers, n_dim)``.
+        """
+        cdef:
+            int n
+            int n_walkers = mcmc_p.shape[0]
+            double[::1] ln_post = np.zeros(n_walkers)
+
+        if mcmc_p.shape[1] != self._n_dim:
+            raise ValueError("Expected {0} parameters, got {1}."
+                             .format(self._n_dim, mcmc_p.shape[1]))
+
+        for n in range(n_walkers):
+            ln_post[n] = self._ln_posterior(mcmc_p[n])
+
+        return np.array(ln_post)
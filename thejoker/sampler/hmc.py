@@ -0,0 +1,242 @@
+# Third-party
+import numpy as np
+
+# Project
+from ..log import log as logger
+
+__all__ = ['HMCSampler']
+
+
+class HMCSampler(object):
+    """A simple Hamiltonian Monte Carlo sampler.
+
+    The leapfrog step size and a diagonal mass matrix are tuned during
+    burn-in: the step size with dual averaging (Hoffman & Gelman 2014) to
+    reach a target mean acceptance probability, and the mass matrix from the
+    variance of the samples in a series of doubling windows, as in Stan. The
+    initial mass matrix is set from the curvature of the log-posterior at the
+    initial position, because the parameters can have very different
+    scales (e.g., the period and the systemic velocity). The
+    number of leapfrog steps is drawn uniformly around ``n_leapfrog`` for
+    each trajectory to avoid periodic orbits.
+
+    Parameters
+    ----------
+    ln_prob_and_grad : callable
+        A function that takes a parameter vector and returns the log-posterior
+        probability and its gradient.
+    n_dim : int
+        The number of parameters.
+    n_leapfrog : int (optional)
+        The mean number of leapfrog steps per trajectory.
+    target_accept : float (optional)
+        The target mean acceptance probability used to tune the step size.
+    random_state : `numpy.random.RandomState` (optional)
+
+    """
+    def __init__(self, ln_prob_and_grad, n_dim, n_leapfrog=16,
+                 target_accept=0.8, random_state=None):
+        self.ln_prob_and_grad = ln_prob_and_grad
+        self.n_dim = int(n_dim)
+        self.n_leapfrog = int(n_leapfrog)
+        self.target_accept = float(target_accept)
+
+        if random_state is None:
+            random_state = np.random.RandomState()
+        self.random_state = random_state
+
+        self.step_size = None
+        self.inv_mass = np.ones(self.n_dim)
+        self.reset()
+
+    def reset(self):
+        """Clear the stored samples."""
+        self.chain = np.zeros((0, self.n_dim))
+        self.lnprobability = np.zeros(0)
+        self._accept_prob = np.zeros(0)
+
+    @property
+    def acceptance_fraction(self):
+        """The mean acceptance probability of the stored samples."""
+        if len(self._accept_prob) == 0:
+            return np.nan
+        return np.mean(self._accept_prob)
+
+    def _leapfrog(self, x, r, grad, step_size, n_steps):
+        r = r + 0.5 * step_size * grad
+        for i in range(n_steps):
+            x = x + step_size * self.inv_mass * r
+            lnp, grad = self.ln_prob_and_grad(x)
+            if not np.isfinite(lnp):
+                return x, r, -np.inf, grad
+
+            if i < n_steps - 1:
+                r = r + step_size * grad
+        r = r + 0.5 * step_size * grad
+
+        return x, r, lnp, grad
+
+    def _step(self, x, lnp, grad, step_size):
+        """Take one HMC step, returning the new state and the acceptance
+        probability of the proposal."""
+        rnd = self.random_state
+
+        r0 = rnd.normal(size=self.n_dim) / np.sqrt(self.inv_mass)
+        n_steps = rnd.randint(max(1, self.n_leapfrog // 2),
+                              self.n_leapfrog + self.n_leapfrog // 2 + 1)
+        x1, r1, lnp1, grad1 = self._leapfrog(x, r0, grad, step_size, n_steps)
+
+        H0 = lnp - 0.5 * np.sum(self.inv_mass * r0**2)
+        H1 = lnp1 - 0.5 * np.sum(self.inv_mass * r1**2)
+        with np.errstate(over='ignore', invalid='ignore'):
+            accept_prob = min(1., np.exp(H1 - H0))
+        if np.isnan(accept_prob):
+            accept_prob = 0.
+
+        if rnd.uniform() < accept_prob:
+            return x1, lnp1, grad1, accept_prob
+
+        return x, lnp, grad, accept_prob
+
+    def _initial_step_size(self, x, lnp, grad):
+        """Double or halve the step size until the acceptance probability of
+        a single leapfrog step crosses 0.5."""
+        rnd = self.random_state
+        step_size = 1.
+
+        def accept_prob(step_size):
+            r0 = rnd.normal(size=self.n_dim) / np.sqrt(self.inv_mass)
+            _, r1, lnp1, _ = self._leapfrog(x, r0, grad, step_size, 1)
+            dH = (lnp1 - 0.5 * np.sum(self.inv_mass * r1**2) -
+                  lnp + 0.5 * np.sum(self.inv_mass * r0**2))
+            return np.exp(dH) if np.isfinite(dH) else 0.
+
+        direction = 1 if accept_prob(step_size) > 0.5 else -1
+        for i in range(100):
+            new_step_size = step_size * 2.**direction
+            if (accept_prob(new_step_size) > 0.5) != (direction == 1):
+                break
+            step_size = new_step_size
+
+        return step_size
+
+    def _initial_inv_mass(self, x, grad):
+        """Estimate the inverse mass matrix from the diagonal of the Hessian
+        of the log-posterior, computed by finite differences of the
+        gradient."""
+        inv_mass = np.ones(self.n_dim)
+        for i in range(self.n_dim):
+            h = 1E-6 * max(1., abs(x[i]))
+            x1 = x.copy()
+            x1[i] += h
+            lnp1, grad1 = self.ln_prob_and_grad(x1)
+            if not np.isfinite(lnp1):
+                continue
+
+            curv = -(grad1[i] - grad[i]) / h
+            if np.isfinite(curv) and curv > 0:
+                inv_mass[i] = 1 / curv
+
+        return inv_mass
+
+    @staticmethod
+    def _metric_windows(n_burn):
+        """Return the indices of the burn-in steps at which the mass matrix is
+        updated: the steps between an initial 15% and final 10% of the
+        burn-in are split into windows that double in size."""
+        start = int(0.15 * n_burn)
+        end = n_burn - int(0.1 * n_burn)
+
+        ends = []
+        size = 25
+        i = start
+        while i < end:
+            if i + 3 * size > end:
+                ends.append(end)
+                break
+
+            i += size
+            ends.append(i)
+            size *= 2
+
+        return start, ends
+
+    def run(self, p0, n_steps, n_burn=0):
+        """Run the sampler.
+
+        Parameters
+        ----------
+        p0 : array_like
+            The initial parameter vector.
+        n_steps : int
+            The number of steps to store after burn-in.
+        n_burn : int (optional)
+            The number of burn-in steps, used to tune the step size and mass
+            matrix. These samples are not stored.
+
+        Returns
+        -------
+        chain : `numpy.ndarray`
+            The samples, with shape ``(n_steps, n_dim)``.
+        """
+        x = np.array(p0, dtype=np.float64)
+        lnp, grad = self.ln_prob_and_grad(x)
+        if not np.isfinite(lnp):
+            raise ValueError("Initial position has a non-finite "
+                             "log-probability.")
+
+        if self.step_size is None:
+            self.inv_mass = self._initial_inv_mass(x, grad)
+            self.step_size = self._initial_step_size(x, lnp, grad)
+
+        # dual averaging parameters
+        gamma, t0, kappa = 0.05, 10., 0.75
+        mu = np.log(10 * self.step_size)
+        H_bar, ln_step_bar, m = 0., 0., 0
+
+        start, window_ends = self._metric_windows(n_burn)
+        window = []
+        for i in range(n_burn):
+            x, lnp, grad, acc = self._step(x, lnp, grad, self.step_size)
+
+            m += 1
+            H_bar = ((1 - 1. / (m + t0)) * H_bar +
+                     (self.target_accept - acc) / (m + t0))
+            ln_step = mu - np.sqrt(m) / gamma * H_bar
+            ln_step_bar = (m**-kappa * ln_step +
+                           (1 - m**-kappa) * ln_step_bar)
+            self.step_size = np.exp(ln_step)
+
+            if window_ends and start <= i < window_ends[-1]:
+                window.append(x)
+
+            if window_ends and i + 1 in window_ends:
+                # variance of the samples in this window
+                var = np.var(window, axis=0)
+                self.inv_mass = np.where(var > 0, var, self.inv_mass)
+                window = []
+
+                # restart the step size adaptation with the new metric
+                self.step_size = self._initial_step_size(x, lnp, grad)
+                mu = np.log(10 * self.step_size)
+                H_bar, ln_step_bar, m = 0., 0., 0
+
+        if n_burn > 0:
+            self.step_size = np.exp(ln_step_bar)
+            logger.debug('HMC step size after burn-in: {0:.3e}'
+                         .format(self.step_size))
+
+        chain = np.zeros((n_steps, self.n_dim))
+        lnprob = np.zeros(n_steps)
+        accept_prob = np.zeros(n_steps)
+        for i in range(n_steps):
+            x, lnp, grad, accept_prob[i] = self._step(x, lnp, grad,
+                                                      self.step_size)
+            chain[i] = x
+            lnprob[i] = lnp
+
+        self.chain = np.concatenate((self.chain, chain))
+        self.lnprobability = np.concatenate((self.lnprobability, lnprob))
+        self._accept_prob = np.concatenate((self._accept_prob, accept_prob))
+
+        return chain
@@ -1,11 +1,27 @@
 # Standard library
 from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
 
 # Third-party
+from astropy.time import Time
 import astropy.units as u
+import h5py
 import numpy as np
 
-__all__ = ['pack_prior_samples', 'save_prior_samples']
+# Project
+from ..utils import _dataset_kwargs
+from .samples import JokerSamples
+
+__all__ = ['pack_prior_samples', 'save_prior_samples', 'LikelihoodStore',
+           'MCMCChainStore', 'append_samples_to_hdf5', 'SamplesStore']
 
 # These units and the order are required for the likelihood code
 _name_to_unit = OrderedDict()
@@ -66,7 +82,8 @@ def pack_prior_samples(samples, rv_unit):
     return np.vstack(arrs).T, units
 
 
-def save_prior_samples(f, samples, rv_unit, ln_prior_probs=None):
+def save_prior_samples(f, samples, rv_unit, ln_prior_probs=None, chunks=None,
+                       compression=None, compression_opts=None, dtype=None):
     """
     Save a dictionary of Astropy Quantity prior samples to
     an HDF5 file in a format expected and used by
@@ -79,6 +96,11 @@ def save_prior_samples(f, samples, rv_unit, ln_prior_probs=None):
         - ``omega``, argument of periastron
         - ``jitter``, velocity jitter (optional)
 
+    If the jitter is the same for all samples (e.g., it is fixed, or not
+    passed in), the jitter column is not stored: its value is saved as the
+    ``'jitter'`` attribute of the samples dataset instead, and the column is
+    added back when the samples are read.
+
     Parameters
     ----------
     f : str, :class:`h5py.File`, :class:`h5py.Group`, :class:`h5py.DataSet`
@@ -88,6 +110,20 @@ def save_prior_samples(f, samples, rv_unit, ln_prior_probs=None):
         objects.
     rv_unit : `~astropy.units.UnitBase`
         The radial velocity data unit.
+    ln_prior_probs : `numpy.ndarray` (optional)
+        The log-prior probability of each sample.
+    chunks : int (optional)
+        The number of samples per chunk. Each chunk contains all parameters
+        of the samples, so that reading a range of samples only reads and
+        decompresses the chunks that contain them.
+    compression : str (optional)
+        The compression filter, e.g., ``'gzip'`` or ``'lzf'``.
+    compression_opts : int (optional)
+        Options for the compression filter, e.g., the gzip level.
+    dtype : `numpy.dtype` (optional)
+        The data type to store the samples as on disk, e.g., ``np.float32``.
+        The samples are always converted to double precision when they are
+        read to compute likelihoods.
 
     Returns
     -------
@@ -99,20 +135,849 @@ def save_prior_samples(f, samples, rv_unit, ln_prior_probs=None):
 
     packed_samples, units = pack_prior_samples(samples, rv_unit)
 
-    if isinstance(f, str):
-        import h5py
-        with h5py.File(f, 'a') as g:
-            g.attrs['units'] = np.array([str(x) for x in units]).astype('|S6')
-            g['samples'] = packed_samples
+    jitter = packed_samples[:, -1]
+    const_jitter = len(jitter) > 0 and np.all(jitter == jitter[0])
+    if const_jitter:
+        packed_samples = packed_samples[:, :-1]
 
-            if ln_prior_probs is not None:
-                g['ln_prior_probs'] = ln_prior_probs
+    def _save(g):
+        g.attrs['units'] = np.array([str(x) for x in units]).astype('|S6')
 
-    else:
-        f.attrs['units'] = np.array([str(x) for x in units]).astype('|S6')
-        f['samples'] = packed_samples
+        kwargs = _dataset_kwargs(packed_samples.shape, chunks=chunks,
+                                 compression=compression,
+                                 compression_opts=compression_opts,
+                                 dtype=dtype)
+        g.create_dataset('samples', data=packed_samples, **kwargs)
+        if const_jitter:
+            g['samples'].attrs['jitter'] = jitter[0]
 
         if ln_prior_probs is not None:
-            f['ln_prior_probs'] = ln_prior_probs
+            kwargs = _dataset_kwargs(np.shape(ln_prior_probs), chunks=chunks,
+                                     compression=compression,
+                                     compression_opts=compression_opts)
+            g.create_dataset('ln_prior_probs', data=ln_prior_probs, **kwargs)
+
+    if isinstance(f, str):
+        with h5py.File(f, 'a') as g:
+            _save(g)
+
+    else:
+        _save(f)
 
     return units
+
+
+def _pad_prior_samples(f, chunk):
+    """
+    Convert prior samples read from the ``'samples'`` dataset of a prior
+    cache file to a double precision array, adding back the jitter column if
+    it wasn't stored because it is constant (see `save_prior_samples`). This
+    is meant to be used internally.
+    """
+    chunk = np.asarray(chunk, dtype=np.float64)
+    if chunk.shape[-1] == len(_name_to_unit):
+        jitter = f['samples'].attrs.get('jitter', 0.)
+        chunk = np.concatenate(
+            (chunk, np.full(chunk.shape[:-1] + (1, ), jitter)), axis=-1)
+    return np.ascontiguousarray(chunk)
+
+
+@contextmanager
+def _file_lock(filename):
+    """Hold an exclusive lock on ``<filename>.lock`` (if file locking is
+    supported on this platform). This is meant to be used internally."""
+    if fcntl is None:
+        yield
+        return
+
+    with open(filename + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def append_samples_to_hdf5(filename, samples, path=None, chunk_size=4096,
+                           compression=None, compression_opts=None):
+    """Append posterior samples to an HDF5 file, e.g., from repeated runs of
+    The Joker on the same data.
+
+    Each parameter is stored in a chunked, resizable dataset, so appending
+    only writes the new samples. The number of valid samples is stored in
+    the ``'n_committed'`` attribute of the group, which is updated after the
+    new samples are written: if a write is interrupted, the partially written
+    samples are ignored by `~thejoker.JokerSamples.from_hdf5` and overwritten
+    by the next append. Writers take an exclusive lock on the file
+    ``<filename>.lock`` (on platforms that support ``fcntl``), so concurrent
+    runs wait for each other instead of corrupting the file.
+
+    Datasets written with `~thejoker.JokerSamples.to_hdf5` are converted to
+    resizable datasets the first time samples are appended.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 file. Created if it doesn't exist.
+    samples : `~thejoker.JokerSamples`
+        The samples to append. These must have the same parameters and
+        reference time as the samples already stored. The values are
+        converted to the units of the stored samples.
+    path : str (optional)
+        The name of the group in the HDF5 file to store the samples in.
+        Defaults to the root of the file. The group should not contain any
+        other datasets.
+    chunk_size : int (optional)
+        The chunk size of new datasets, in number of samples.
+    compression : str (optional)
+        The compression filter of new datasets, passed to `h5py`.
+    compression_opts : int (optional)
+        Options for the compression filter, e.g., the gzip level.
+
+    Returns
+    -------
+    n_samples : int
+        The total number of samples stored.
+    """
+    keys = list(samples.keys())
+    n_new = samples.size
+
+    with _file_lock(filename), h5py.File(filename, 'a') as f:
+        if path is None:
+            g = f
+        else:
+            g = f.require_group(path)
+
+        stored_keys = [k for k in g.keys() if isinstance(g[k], h5py.Dataset)]
+        if len(stored_keys) == 0:
+            for key in keys:
+                ds = g.create_dataset(key, shape=(0, ), maxshape=(None, ),
+                                      chunks=(chunk_size, ), dtype=np.float64,
+                                      compression=compression,
+                                      compression_opts=compression_opts)
+                ds.attrs['unit'] = str(samples[key].unit)
+
+            if samples.t0 is not None:
+                g.attrs['t0_bmjd'] = samples.t0.tcb.mjd
+
+            n_old = 0
+
+        else:
+            if set(stored_keys) != set(keys):
+                raise ValueError("The samples to append must have the same "
+                                 "parameters as the stored samples.")
+
+            t0 = g.attrs.get('t0_bmjd', None)
+            if ((t0 is None) != (samples.t0 is None) or
+                    (t0 is not None and t0 != samples.t0.tcb.mjd)):
+                raise ValueError("The samples to append must have the same "
+                                 "reference time t0 as the stored samples.")
+
+            n_old = g.attrs.get('n_committed', None)
+            if n_old is None: # written by JokerSamples.to_hdf5()
+                n_old = len(g[keys[0]])
+            n_old = int(n_old)
+
+            for key in keys:
+                if g[key].maxshape[0] is None:
+                    continue
+
+                # convert a fixed-size dataset to a resizable one
+                vals = g[key][:n_old]
+                attrs = dict(g[key].attrs)
+                del g[key]
+                ds = g.create_dataset(key, data=vals, maxshape=(None, ),
+                                      chunks=(chunk_size, ), dtype=np.float64,
+                                      compression=compression,
+                                      compression_opts=compression_opts)
+                for name, val in attrs.items():
+                    ds.attrs[name] = val
+
+        for key in keys:
+            ds = g[key]
+            unit = u.Unit(ds.attrs.get('unit', ''))
+            ds.resize(n_old + n_new, axis=0)
+            ds[n_old:] = np.ravel(samples[key].to_value(unit))
+
+        # mark the new samples as valid only once they are all written
+        g.attrs['n_committed'] = n_old + n_new
+
+    return n_old + n_new
+
+
+class LikelihoodStore(object):
+    """An on-disk store of marginal likelihood values computed for prior samples
+    from a prior cache file.
+
+    The marginal likelihood values only depend on the data, the prior samples,
+    and the settings that enter the likelihood (e.g., a fixed jitter value),
+    not on the prior itself. Storing them makes it possible to re-do the
+    rejection step under a different prior (see
+    `~thejoker.sampler.TheJoker.reweight`) without re-computing the
+    likelihood. Values are stored in compressed datasets in an HDF5 file,
+    grouped by a fingerprint of the data, and then by a fingerprint of the
+    prior samples and parameter specification.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 file to store likelihood values in. Created if it
+        doesn't exist.
+    compression : str (optional)
+        The compression filter passed to `h5py`.
+    compression_opts : int (optional)
+        Options for the compression filter, e.g., the gzip level.
+    """
+
+    def __init__(self, filename, compression='gzip', compression_opts=4):
+        self.filename = filename
+        self.compression = compression
+        self.compression_opts = compression_opts
+
+    def key(self, data, prior_cache_file, n_prior_samples, start_idx,
+            joker_params):
+        """Return the key that identifies a set of marginal likelihood values.
+
+        Parameters
+        ----------
+        data : `~thejoker.data.RVData`
+            The radial velocity data.
+        prior_cache_file : str
+            Path to the HDF5 file containing the prior samples.
+        n_prior_samples : int
+            The number of prior samples.
+        start_idx : int
+            Index of the first prior sample in the prior cache file.
+        joker_params : `~thejoker.sampler.params.JokerParams`
+            The specification of parameters to infer with The Joker.
+
+        Returns
+        -------
+        key : str
+        """
+        from .multiproc_helpers import (_data_fingerprint,
+                                        _prior_cache_fingerprint,
+                                        _likelihood_params_fingerprint)
+
+        cache_fp = _prior_cache_fingerprint(prior_cache_file, n_prior_samples,
+                                            start_idx)
+        params_fp = _likelihood_params_fingerprint(joker_params)
+        return '{0}/{1}-{2}'.format(_data_fingerprint(data), cache_fp,
+                                    params_fp)
+
+    def __contains__(self, key):
+        if not os.path.exists(self.filename):
+            return False
+
+        with h5py.File(self.filename, 'r') as f:
+            return key in f
+
+    def save(self, key, marg_ll):
+        """Store an array of marginal likelihood values, replacing any values
+        already stored with the same key.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `~thejoker.sampler.io.LikelihoodStore.key`.
+        marg_ll : array_like
+            The marginal log-likelihood values.
+        """
+        marg_ll = np.asarray(marg_ll, dtype=np.float64)
+
+        with h5py.File(self.filename, 'a') as f:
+            if key in f:
+                del f[key]
+
+            g = f.create_group(key)
+            g.create_dataset('marg_ll', data=marg_ll, chunks=True,
+                             shuffle=True, compression=self.compression,
+                             compression_opts=self.compression_opts)
+            g.attrs['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def load(self, key, i1=None, i2=None):
+        """Read stored marginal likelihood values.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by `~thejoker.sampler.io.LikelihoodStore.key`.
+        i1 : int (optional)
+            Index of the first value to read.
+        i2 : int (optional)
+            Index after the last value to read.
+
+        Returns
+        -------
+        marg_ll : `numpy.ndarray`
+        """
+        with h5py.File(self.filename, 'r') as f:
+            return f[key]['marg_ll'][i1:i2]
+
+
+class MCMCChainStore(object):
+    """An on-disk store of MCMC chains that is written to as the sampler runs,
+    so that an interrupted run can be resumed.
+
+    Every ``save_interval`` steps, the current walker positions and step
+    counts are saved, and every ``thin``-th step of the chains (after
+    burn-in) is appended to resizable, chunked datasets in an HDF5 file. The
+    file is closed between writes, so at most ``save_interval`` steps are lost
+    if the process is killed. See `~thejoker.sampler.TheJoker.mcmc_sample`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 file. Created if it doesn't exist.
+    path : str (optional)
+        The name of the group in the HDF5 file to store the chains in.
+    thin : int (optional)
+        Store only every ``thin``-th step of the chains.
+    save_interval : int (optional)
+        The number of steps between writes to the file.
+    compression : str (optional)
+        The compression filter passed to `h5py`.
+    compression_opts : int (optional)
+        Options for the compression filter, e.g., the gzip level.
+    """
+
+    def __init__(self, filename, path='mcmc', thin=1, save_interval=256,
+                 compression='gzip', compression_opts=4):
+        self.filename = filename
+        self.path = path
+
+        self.thin = int(thin)
+        self.save_interval = int(save_interval)
+        if self.thin < 1 or self.save_interval < 1:
+            raise ValueError("thin and save_interval must be positive "
+                             "integers.")
+
+        self.compression = compression
+        self.compression_opts = compression_opts
+
+    def initialize(self, n_walkers, n_dim, key=''):
+        """Create empty chain datasets, replacing anything already stored.
+
+        Parameters
+        ----------
+        n_walkers : int
+            The number of walkers.
+        n_dim : int
+            The number of MCMC parameters.
+        key : str (optional)
+            A string that identifies the data and model, checked when resuming
+            a run.
+        """
+        n_walkers = int(n_walkers)
+        n_dim = int(n_dim)
+        chunk_len = max(1, min(self.save_interval // self.thin, 1024))
+
+        with h5py.File(self.filename, 'a') as f:
+            if self.path in f:
+                del f[self.path]
+
+            g = f.create_group(self.path)
+            g.create_dataset('chain', shape=(0, n_walkers, n_dim),
+                             maxshape=(None, n_walkers, n_dim),
+                             chunks=(chunk_len, n_walkers, n_dim),
+                             dtype=np.float64, shuffle=True,
+                             compression=self.compression,
+                             compression_opts=self.compression_opts)
+            g.create_dataset('ln_prob', shape=(0, n_walkers),
+                             maxshape=(None, n_walkers),
+                             chunks=(chunk_len, n_walkers),
+                             dtype=np.float64)
+            g.attrs['thin'] = self.thin
+            g.attrs['key'] = key
+            g.attrs['n_burn'] = 0
+            g.attrs['n_steps'] = 0
+            g.attrs['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def load_state(self):
+        """Read the last saved state of a run.
+
+        Returns
+        -------
+        state : dict, None
+            The walker positions (``'position'``), their log-posterior values
+            (``'ln_prob'``), the numbers of burn-in and sampling steps done
+            (``'n_burn'``, ``'n_steps'``), and the ``'key'`` the store was
+            initialized with. None if nothing is stored.
+        """
+        if not os.path.exists(self.filename):
+            return None
+
+        with h5py.File(self.filename, 'r') as f:
+            if self.path not in f or 'position' not in f[self.path]:
+                return None
+
+            g = f[self.path]
+            if g.attrs['thin'] != self.thin:
+                raise ValueError("Stored chains were thinned by {0}, not {1}."
+                                 .format(g.attrs['thin'], self.thin))
+
+            state = dict()
+            state['position'] = g['position'][:]
+            state['ln_prob'] = g['position_ln_prob'][:]
+            state['n_burn'] = int(g.attrs['n_burn'])
+            state['n_steps'] = int(g.attrs['n_steps'])
+            state['key'] = g.attrs['key']
+            if isinstance(state['key'], bytes):
+                state['key'] = state['key'].decode()
+
+        return state
+
+    def update(self, position, ln_prob, n_burn, n_steps, chain=None,
+               chain_ln_prob=None):
+        """Save the current state of a run, and append new steps of the
+        chains.
+
+        Parameters
+        ----------
+        position : array_like
+            The current walker positions, with shape ``(n_walkers, n_dim)``.
+        ln_prob : array_like
+            The log-posterior values at the current walker positions.
+        n_burn : int
+            The total number of burn-in steps done.
+        n_steps : int
+            The total number of sampling steps done, including the new steps.
+        chain : array_like (optional)
+            The new steps of the chains, with shape ``(n_walkers, n, n_dim)``,
+            i.e. sampling steps ``n_steps-n`` to ``n_steps``. Only every
+            ``thin``-th step is stored.
+        chain_ln_prob : array_like (optional)
+            The log-posterior values for the new steps, with shape
+            ``(n_walkers, n)``.
+        """
+        with h5py.File(self.filename, 'a') as f:
+            g = f[self.path]
+
+            if chain is not None:
+                chain = np.asarray(chain)
+                n = chain.shape[1]
+
+                # global indices of the new steps that are kept after thinning
+                idx = np.arange(n_steps - n, n_steps)
+                keep = (idx + 1) % self.thin == 0
+
+                # any steps stored beyond the last saved state (e.g., from an
+                # interrupted write) are overwritten
+                i1 = (n_steps - n) // self.thin
+                i2 = n_steps // self.thin
+                g['chain'].resize(i2, axis=0)
+                g['ln_prob'].resize(i2, axis=0)
+                g['chain'][i1:i2] = np.swapaxes(chain[:, keep], 0, 1)
+                if chain_ln_prob is not None:
+                    g['ln_prob'][i1:i2] = np.asarray(chain_ln_prob)[:, keep].T
+
+            for name, val in [('position', position),
+                              ('position_ln_prob', ln_prob)]:
+                val = np.asarray(val, dtype=np.float64)
+                if name not in g:
+                    g.create_dataset(name, data=val)
+                else:
+                    g[name][...] = val
+
+            g.attrs['n_burn'] = int(n_burn)
+            g.attrs['n_steps'] = int(n_steps)
+
+    def read_chain(self):
+        """Read the stored (thinned) chains.
+
+        Returns
+        -------
+        chain : `numpy.ndarray`
+            The chains, with shape ``(n_walkers, n, n_dim)``.
+        ln_prob : `numpy.ndarray`
+            The log-posterior values, with shape ``(n_walkers, n)``.
+        """
+        with h5py.File(self.filename, 'r') as f:
+            g = f[self.path]
+            n = int(g.attrs['n_steps']) // self.thin
+            chain = np.swapaxes(g['chain'][:n], 0, 1)
+            ln_prob = g['ln_prob'][:n].T
+
+        return chain, ln_prob
+
+
+def _decode(x):
+    """Return a string read from an HDF5 file as `str`. This is meant to be
+    used internally."""
+    if isinstance(x, bytes):
+        return x.decode()
+    return str(x)
+
+
+def _json_default(obj):
+    """Convert numpy values in sample metadata to something that can be
+    serialized to JSON. This is meant to be used internally."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+class SamplesStore(object):
+    """An on-disk store of posterior samples for many stars, e.g., all stars
+    in a catalog.
+
+    The samples of all stars are stored one after another in a single
+    chunked, resizable dataset per parameter (in the group ``'samples'``),
+    instead of in one group per star: opening many small groups is slow,
+    especially on parallel file systems. The ``'index'`` dataset is a table
+    with one row per star, with the star ID (``'star_id'``), the position and
+    number of its samples (``'offset'``, ``'n_samples'``), the reference time
+    of the samples (``'t0_bmjd'``, NaN if not set), the time the samples were
+    saved (``'created'``), and the metadata of the samples as a JSON string
+    (``'meta'``). The star IDs are read once and cached (until the file
+    changes), so finding the samples of a star takes constant time.
+
+    Writers take an exclusive lock on the file ``<filename>.lock``, like
+    `~thejoker.sampler.io.append_samples_to_hdf5`. New samples are written
+    before the index rows that point to them, so an interrupted write never
+    exposes partially written samples. Saving samples for a star that is
+    already stored appends the new samples and points the star's index row
+    to them; the space used by the old samples is not reclaimed.
+
+    All stars must have the same parameters. The samples are stored in the
+    units of the first samples saved.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 file. Created if it doesn't exist.
+    chunk_size : int (optional)
+        The number of samples per chunk of the sample datasets.
+    compression : str (optional)
+        The compression filter passed to `h5py`.
+    compression_opts : int (optional)
+        Options for the compression filter, e.g., the gzip level.
+    dtype : `numpy.dtype` (optional)
+        The data type to store the samples as on disk, e.g., ``np.float32``.
+        The samples are converted to double precision when read.
+    """
+
+    _str_dtype = h5py.special_dtype(vlen=str)
+    _index_dtype = np.dtype([('star_id', _str_dtype),
+                             ('offset', np.int64),
+                             ('n_samples', np.int64),
+                             ('t0_bmjd', np.float64),
+                             ('created', _str_dtype),
+                             ('meta', _str_dtype)])
+
+    def __init__(self, filename, chunk_size=4096, compression='gzip',
+                 compression_opts=4, dtype=np.float64):
+        self.filename = filename
+        self.chunk_size = int(chunk_size)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.dtype = dtype
+
+        # (file status, {star_id: index row}), see _lookup()
+        self._cache = None
+
+    def _file_status(self):
+        st = os.stat(self.filename)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _lookup(self, f=None):
+        """Return a dictionary that maps star IDs to rows of the index. This is
+        only re-read if the file has changed."""
+        if not os.path.exists(self.filename):
+            return dict()
+
+        status = self._file_status()
+        if self._cache is not None and self._cache[0] == status:
+            return self._cache[1]
+
+        if f is None:
+            with h5py.File(self.filename, 'r') as f:
+                return self._lookup(f)
+
+        if 'index' not in f:
+            rows = dict()
+
+        else:
+            n_stars = int(f['index'].attrs['n_stars'])
+            ids = f['index'][:n_stars, 'star_id']
+            rows = dict((_decode(x), i) for i, x in enumerate(ids))
+
+        self._cache = (status, rows)
+        return rows
+
+    def __contains__(self, star_id):
+        return str(star_id) in self._lookup()
+
+    def __len__(self):
+        return len(self._lookup())
+
+    @property
+    def star_ids(self):
+        """The IDs of all stored stars, in the order they were first saved."""
+        rows = self._lookup()
+        return np.array(sorted(rows, key=rows.get), dtype=str)
+
+    @property
+    def names(self):
+        """The names of the stored parameters."""
+        if not os.path.exists(self.filename):
+            return []
+
+        with h5py.File(self.filename, 'r') as f:
+            if 'samples' not in f:
+                return []
+            return [_decode(x) for x in f['samples'].attrs['names']]
+
+    def _read_index(self, f, rows=None):
+        n_stars = int(f['index'].attrs['n_stars'])
+        if rows is None:
+            index = f['index'][:n_stars]
+        else:
+            # h5py only supports increasing, unique indices
+            idx, inv = np.unique(np.asarray(rows, dtype=int),
+                                 return_inverse=True)
+            index = f['index'][idx][inv]
+
+        table = np.zeros(len(index), dtype=self._table_dtype())
+        for name in table.dtype.names:
+            if table.dtype[name].kind == 'O':
+                table[name] = [_decode(x) for x in index[name]]
+            else:
+                table[name] = index[name]
+        return table
+
+    def _table_dtype(self):
+        # strings are returned as str objects rather than bytes
+        return np.dtype([(name, self._index_dtype[name].str)
+                         for name in self._index_dtype.names])
+
+    @property
+    def index(self):
+        """The index table, as a `numpy` structured array with one row per
+        star."""
+        if not os.path.exists(self.filename):
+            return np.zeros(0, dtype=self._table_dtype())
+
+        with h5py.File(self.filename, 'r') as f:
+            if 'index' not in f:
+                return np.zeros(0, dtype=self._table_dtype())
+            return self._read_index(f)
+
+    def _create(self, f, samples):
+        g = f.create_group('samples')
+        names = list(samples.keys())
+        for key in names:
+            ds = g.create_dataset(key, shape=(0, ), maxshape=(None, ),
+                                  chunks=(self.chunk_size, ),
+                                  dtype=self.dtype, shuffle=True,
+                                  compression=self.compression,
+                                  compression_opts=self.compression_opts)
+            ds.attrs['unit'] = str(samples[key].unit)
+        g.attrs['names'] = np.array(names, dtype='S')
+        g.attrs['n_committed'] = 0
+
+        ds = f.create_dataset('index', shape=(0, ), maxshape=(None, ),
+                              chunks=(1024, ), dtype=self._index_dtype)
+        ds.attrs['n_stars'] = 0
+
+    def save(self, star_id, samples):
+        """Store the samples of one star. See
+        `~thejoker.sampler.io.SamplesStore.save_many`.
+
+        Parameters
+        ----------
+        star_id : str
+            The ID of the star.
+        samples : `~thejoker.JokerSamples`
+            The samples.
+        """
+        self.save_many([star_id], [samples])
+
+    def save_many(self, star_ids, samples_list):
+        """Store the samples of many stars in a single write, which is much
+        faster than saving them one at a time.
+
+        Parameters
+        ----------
+        star_ids : iterable
+            The IDs of the stars.
+        samples_list : iterable
+            A `~thejoker.JokerSamples` instance for each star.
+        """
+        star_ids = [str(x) for x in star_ids]
+        samples_list = [s.load() for s in samples_list]
+        if len(star_ids) != len(samples_list):
+            raise ValueError("The number of star IDs ({0}) must match the "
+                             "number of samples objects ({1})."
+                             .format(len(star_ids), len(samples_list)))
+
+        if len(set(star_ids)) != len(star_ids):
+            raise ValueError("Star IDs must be unique.")
+
+        if len(star_ids) == 0:
+            return
+
+        created = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with _file_lock(self.filename):
+            with h5py.File(self.filename, 'a') as f:
+                if 'samples' not in f:
+                    self._create(f, samples_list[0])
+
+                g = f['samples']
+                names = [_decode(x) for x in g.attrs['names']]
+                for samples in samples_list:
+                    if set(samples.keys()) != set(names):
+                        raise ValueError("The samples of all stars must have "
+                                         "the same parameters, {0}"
+                                         .format(names))
+
+                rows = self._lookup(f)
+
+                # write the samples after any committed samples
+                sizes = np.array([s.size for s in samples_list], dtype=int)
+                n_old = int(g.attrs['n_committed'])
+                n_new = sizes.sum()
+                for key in names:
+                    unit = u.Unit(g[key].attrs['unit'])
+                    vals = [np.ravel(s[key].to_value(unit))
+                            for s in samples_list]
+                    g[key].resize(n_old + n_new, axis=0)
+                    g[key][n_old:] = np.concatenate(vals)
+                g.attrs['n_committed'] = n_old + n_new
+
+                new_rows = np.zeros(len(star_ids), dtype=self._index_dtype)
+                new_rows['star_id'] = star_ids
+                new_rows['offset'] = n_old + np.cumsum(sizes) - sizes
+                new_rows['n_samples'] = sizes
+                new_rows['t0_bmjd'] = [np.nan if s.t0 is None
+                                       else s.t0.tcb.mjd
+                                       for s in samples_list]
+                new_rows['created'] = created
+                new_rows['meta'] = [json.dumps(s.meta, default=_json_default)
+                                    for s in samples_list]
+
+                # replace the index rows of stars that are already stored,
+                # then append the rest
+                index = f['index']
+                n_stars = int(index.attrs['n_stars'])
+                is_new = np.array([x not in rows for x in star_ids])
+                for i in np.flatnonzero(~is_new):
+                    index[rows[star_ids[i]]] = new_rows[i]
+
+                n_added = is_new.sum()
+                index.resize(n_stars + n_added, axis=0)
+                if n_added > 0:
+                    index[n_stars:] = new_rows[is_new]
+                index.attrs['n_stars'] = n_stars + n_added
+
+            rows = dict(rows)
+            for i, star_id in enumerate(np.array(star_ids)[is_new]):
+                rows[star_id] = n_stars + i
+            self._cache = (self._file_status(), rows)
+
+    def load(self, star_id):
+        """Read the samples of one star.
+
+        Parameters
+        ----------
+        star_id : str
+            The ID of the star.
+
+        Returns
+        -------
+        samples : `~thejoker.JokerSamples`
+            The samples. The metadata are the metadata of the samples when
+            they were saved, plus the time they were saved (``'created'``).
+        """
+        star_id = str(star_id)
+        with h5py.File(self.filename, 'r') as f:
+            rows = self._lookup(f)
+            if star_id not in rows:
+                raise KeyError("No samples stored for star '{0}'."
+                               .format(star_id))
+
+            row = self._read_index(f, [rows[star_id]])[0]
+            i1 = int(row['offset'])
+            i2 = i1 + int(row['n_samples'])
+
+            g = f['samples']
+            names = [_decode(x) for x in g.attrs['names']]
+            units = [u.Unit(g[key].attrs['unit']) for key in names]
+            arr = np.stack([np.asarray(g[key][i1:i2], dtype=np.float64)
+                            for key in names], axis=-1)
+
+        if np.isnan(row['t0_bmjd']):
+            t0 = None
+        else:
+            t0 = Time(row['t0_bmjd'], format='mjd', scale='tcb')
+
+        meta = json.loads(row['meta'])
+        meta['created'] = row['created']
+        return JokerSamples.from_array(arr, names, units, t0=t0, meta=meta)
+
+    def load_all(self, star_ids=None, names=None):
+        """Read the samples of many (or all) stars at once, e.g., for
+        population analyses.
+
+        Samples of stars that are stored next to each other are read
+        together, so reading all stars (or all stars saved together) only
+        needs one read per parameter.
+
+        Parameters
+        ----------
+        star_ids : iterable (optional)
+            The IDs of the stars to read. Defaults to all stars.
+        names : iterable (optional)
+            The names of the parameters to read. Defaults to all parameters.
+
+        Returns
+        -------
+        samples : `~thejoker.JokerSamples`
+            The samples of all of the stars, one star after another. The
+            reference time is not set, because it can differ between stars:
+            the mean anomaly ``M0`` of each star is relative to its
+            ``t0_bmjd`` in the index.
+        index : `numpy.ndarray`
+            The rows of the index table for the stars, in the same order as the
+            samples. The ``'offset'`` column is the index of the first sample
+            of each star in the returned samples.
+        """
+        with h5py.File(self.filename, 'r') as f:
+            if star_ids is None:
+                table = self._read_index(f)
+
+            else:
+                rows = self._lookup(f)
+                missing = [x for x in star_ids if str(x) not in rows]
+                if missing:
+                    raise KeyError("No samples stored for stars: {0}"
+                                   .format(missing))
+                table = self._read_index(f, [rows[str(x)] for x in star_ids])
+
+            g = f['samples']
+            if names is None:
+                names = [_decode(x) for x in g.attrs['names']]
+            names = list(names)
+            units = [u.Unit(g[key].attrs['unit']) for key in names]
+
+            # merge the samples of consecutive stars into contiguous blocks
+            starts = table['offset']
+            stops = starts + table['n_samples']
+            blocks = []
+            if len(table) > 0:
+                breaks = np.flatnonzero(starts[1:] != stops[:-1]) + 1
+                blocks = list(zip(starts[np.concatenate(([0], breaks))],
+                                  stops[np.concatenate((breaks - 1, [-1]))]))
+
+            # (the zero-length array also converts the values to float64)
+            cols = []
+            for key in names:
+                vals = [g[key][i1:i2] for i1, i2 in blocks]
+                cols.append(np.concatenate([np.zeros(0)] + vals))
+
+        table['offset'] = np.cumsum(table['n_samples']) - table['n_samples']
+        samples = JokerSamples.from_array(np.stack(cols, axis=-1), names,
+                                          units)
+        return samples, table
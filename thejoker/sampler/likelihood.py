@@ -5,7 +5,7 @@ from twobody.wrap import cy_rv_from_elements
 # Package
 from ..log import log as logger
 
-__all__ = ['get_ivar', 'design_matrix',
+__all__ = ['get_ivar', 'design_matrix', 'trend_design_matrix',
            'tensor_vector_scalar', 'marginal_ln_likelihood']
 
 
@@ -42,24 +42,67 @@ def design_matrix(nonlinear_p, data, joker_params):
     Returns
     -------
     A : `numpy.ndarray`
-        The design matrix with shape ``(n_times, n_params)``.
+        The design matrix with shape ``(n_times, n_params)``. The columns
+        are for the Keplerian part of the velocity curve, followed by the
+        ``joker_params.poly_trend`` terms of the velocity trend, and the
+        velocity offsets of all but the first instrument.
 
     """
     P, M0, ecc, omega = nonlinear_p[:4] # we don't need the jitter here
 
     t = data._t_bmjd
     t0 = data._t0_bmjd
-    zdot = cy_rv_from_elements(t, P, 1., ecc, omega, M0, t0,
-                               joker_params.anomaly_tol,
-                               joker_params.anomaly_maxiter)
 
-    # TODO: right now, we only support a constant N=1 velocity trend!
-    A1 = np.vander(t, N=1, increasing=True)
-    A = np.hstack((zdot[:, None], A1))
+    if joker_params.marginalize_omega:
+        # columns are cos(f) + e and -sin(f): the RV curve for omega=0 and
+        # omega=pi/2, with linear parameters K cos(omega) and K sin(omega)
+        zdot = np.stack([cy_rv_from_elements(t, P, 1., ecc, om, M0, t0,
+                                             joker_params.anomaly_tol,
+                                             joker_params.anomaly_maxiter)
+                         for om in [0., np.pi/2]], axis=1)
+
+    else:
+        zdot = cy_rv_from_elements(t, P, 1., ecc, omega, M0, t0,
+                                   joker_params.anomaly_tol,
+                                   joker_params.anomaly_maxiter)[:, None]
+
+    A = np.hstack((zdot, trend_design_matrix(data, joker_params)))
 
     return A
 
 
+def trend_design_matrix(data, joker_params):
+    """The columns of the design matrix for the long-term velocity trend and
+    the instrument offsets, which don't depend on the nonlinear parameters.
+
+    Parameters
+    ----------
+    data : `~thejoker.data.RVData`
+        The observations.
+    joker_params : `~thejoker.sampler.params.JokerParams`
+        The specification of parameters to infer with The Joker.
+
+    Returns
+    -------
+    A : `numpy.ndarray`
+        The design matrix with shape ``(n_times, n_params)``: the
+        ``joker_params.poly_trend`` terms of the velocity trend, followed by
+        the velocity offsets of all but the first instrument.
+
+    """
+    t = data._t_bmjd
+    t0 = data._t0_bmjd
+
+    # polynomial velocity trend, in powers of (t - t0)
+    A1 = np.vander(t - t0, N=joker_params.poly_trend, increasing=True)
+
+    # velocity offsets of each instrument relative to the first instrument
+    A2 = (data._instrument_idx[:, None] ==
+          np.arange(1, data.n_instruments)[None]).astype(np.float64)
+
+    return np.hstack((A1, A2))
+
+
 def tensor_vector_scalar(A, ivar, y):
     """
     Internal function used to construct linear algebra objects
@@ -3,13 +3,16 @@ import astropy.units as u
 import numpy as np
 
 # Project
+from .fast_likelihood import (MCMCPosterior, batch_marginal_ln_likelihood,
+                              batch_get_posterior_samples)
+from .io import pack_prior_samples
 from .likelihood import get_ivar, design_matrix
 from .params import JokerParams
 from .samples import JokerSamples
 from ..data import RVData
 from ..stats import beta_logpdf, norm_logpdf
 
-__all__ = ['TheJokerMCMCModel']
+__all__ = ['TheJokerMCMCModel', 'TheJokerMarginalMCMCModel']
 
 log_2pi = np.log(2 * np.pi)
 
@@ -42,10 +45,30 @@ class TheJokerMCMCModel:
         self._rv_unit = self.data.rv.unit
         self._jitter_factor = self._rv_unit.to(self.params._jitter_unit)
 
+        # names of the instrument offset parameters, which come after the
+        # velocity trend terms
+        if self.data.instruments is not None:
+            self._offset_names = ['dv0_{0}'.format(name)
+                                  for name in self.data.instruments[1:]]
+        else:
+            self._offset_names = []
+        self._n_linear_trend = self.params.poly_trend + len(self._offset_names)
+
+        # names of the jitter parameters of the other instruments, which come
+        # after the instrument offsets
+        if self.params.per_instrument_jitter and self._offset_names:
+            self._jitter_names = ['jitter_{0}'.format(name)
+                                  for name in self.data.instruments[1:]]
+        else:
+            self._jitter_names = []
+
         if self.params._fixed_jitter:
             self._s_jitter = self.params.jitter.to(self._rv_unit).value
             self._y_jitter = 2 * np.log(self._s_jitter)
 
+        # compiled implementation of ln_posterior()
+        self._ln_posterior = MCMCPosterior(self.data, self.params)
+
     @classmethod
     def to_mcmc_params(cls, p):
         r"""MCMC internal function.
@@ -130,9 +153,14 @@ class TheJokerMCMCModel:
                np.asarray(samples['e']),
                samples['omega'].to(u.radian).value,
                jitter,
-               samples['K'].to(self._rv_unit).value,
-               samples['v0'].to(self._rv_unit).value]
-        # TODO: assumes only constant velocity offset
+               samples['K'].to(self._rv_unit).value]
+
+        for i in range(self.params.poly_trend):
+            arr.append(samples['v{0}'.format(i)].to(
+                self._rv_unit / u.day**i).value)
+
+        for name in self._offset_names + self._jitter_names:
+            arr.append(samples[name].to(self._rv_unit).value)
 
         return np.array(arr).T
 
@@ -154,6 +182,11 @@ class TheJokerMCMCModel:
         samples_vec = self.pack_samples(samples)
         samples_mcmc = self.to_mcmc_params(samples_vec.T)
 
+        # the jitter of the other instruments is also sampled in ln(s^2)
+        n_jitter = len(self._jitter_names)
+        if n_jitter > 0:
+            samples_mcmc[-n_jitter:] = 2 * np.log(samples_mcmc[-n_jitter:])
+
         if self.params._fixed_jitter:
             samples_mcmc = np.delete(samples_mcmc, 5, axis=0)
 
@@ -180,7 +213,9 @@ class TheJokerMCMCModel:
         samples['e'] = samples_arr.T[2] * u.one
         samples['omega'] = samples_arr.T[3] * u.radian
 
-        if not self.params._fixed_jitter or samples_arr.shape[1] > 6:
+        n_trend = self.params.poly_trend
+        n_lin = self._n_linear_trend
+        if not self.params._fixed_jitter or samples_arr.shape[1] > 5 + n_lin:
             samples['jitter'] = samples_arr.T[4] * self._rv_unit
             shift = 1
         else:
@@ -189,8 +224,15 @@ class TheJokerMCMCModel:
 
         samples['K'] = samples_arr.T[4+shift] * self._rv_unit
 
-        # TODO: assumes only constant velocity offset
-        samples['v0'] = samples_arr.T[5+shift] * self._rv_unit
+        for i in range(n_trend):
+            samples['v{0}'.format(i)] = (samples_arr.T[5+shift+i] *
+                                         self._rv_unit / u.day**i)
+
+        for i, name in enumerate(self._offset_names):
+            samples[name] = samples_arr.T[5+shift+n_trend+i] * self._rv_unit
+
+        for i, name in enumerate(self._jitter_names):
+            samples[name] = samples_arr.T[5+shift+n_lin+i] * self._rv_unit
 
         return samples
 
@@ -212,20 +254,57 @@ class TheJokerMCMCModel:
         arr = samples_arr
 
         # HACK:
-        if self.params._fixed_jitter and samples_arr.shape[1] == 6:
+        if (self.params._fixed_jitter and
+                samples_arr.shape[1] == 5 + self._n_linear_trend):
             s_arr = np.zeros(samples_arr.shape[0]) + self._y_jitter
             arr = np.insert(arr, 5, s_arr, axis=1)
 
         new_samples_arr = self.from_mcmc_params(arr.T).T
+
+        n_jitter = len(self._jitter_names)
+        if n_jitter > 0:
+            new_samples_arr[:, -n_jitter:] = np.sqrt(
+                np.exp(new_samples_arr[:, -n_jitter:]))
+
         return self.unpack_samples(new_samples_arr)
 
-    def ln_likelihood(self, p):
+    def _unpack_p(self, p):
+        """Split a parameter vector into the orbital parameters, the velocity
+        trend terms and instrument offsets, and the jitter values.
+
+        Returns
+        -------
+        orbit_p : list
+            P, M0, e, omega, K.
+        v_terms : list
+            The velocity trend terms followed by the instrument offsets.
+        s : float, `numpy.ndarray`
+            The jitter of the first instrument, followed by the jitter of the
+            other instruments if each instrument has its own jitter.
+        """
         P, M0, ecc, omega, s, K, *v_terms = p
 
+        n_jitter = len(self._jitter_names)
+        if n_jitter > 0:
+            s = np.array([s] + v_terms[-n_jitter:])
+            v_terms = v_terms[:-n_jitter]
+
+        return [P, M0, ecc, omega, K], v_terms, s
+
+    def ln_likelihood(self, p):
+        (P, M0, ecc, omega, K), v_terms, s = self._unpack_p(p)
+
         # a little repeated code here...
 
         A = design_matrix([P, M0, ecc, omega], self.data, self.params)
-        p2 = np.array([K] + v_terms)
+        if self.params.marginalize_omega:
+            p2 = np.array([K*np.cos(omega), K*np.sin(omega)] + v_terms)
+        else:
+            p2 = np.array([K] + v_terms)
+
+        if len(self._jitter_names) > 0:
+            # jitter of the instrument of each data point
+            s = s[self.data._instrument_idx]
         ivar = get_ivar(self.data, s)
         dy = A.dot(p2) - self._rv
 
@@ -234,7 +313,7 @@ class TheJokerMCMCModel:
     def ln_prior(self, p):
         # TODO: hard-coded priors
 
-        P, M0, ecc, omega, s, K, *v_terms = p
+        (P, M0, ecc, omega, K), v_terms, s = self._unpack_p(p)
 
         lnp = 0.
 
@@ -253,10 +332,11 @@ class TheJokerMCMCModel:
         if not self.params._fixed_jitter:
             # Gaussian prior in ln(s^2) - don't need Jacobian because we are
             # actually sampling in y = ln(s^2)
+            # (the same prior is used for the jitter of each instrument)
             s_scaled = s * self._jitter_factor
             y = 2 * np.log(s_scaled)
-            lnp += norm_logpdf(y, self.params.jitter[0],
-                               self.params.jitter[1])
+            lnp += np.sum(norm_logpdf(y, self.params.jitter[0],
+                                      self.params.jitter[1]))
 
         # Wide, Gaussian priors on K, v0
         # TODO: units here?
@@ -266,23 +346,281 @@ class TheJokerMCMCModel:
         return lnp
 
     def ln_posterior(self, mcmc_p):
+        """Compute the log-posterior for a single walker position.
+
+        Parameters
+        ----------
+        mcmc_p : array_like
+            A vector of parameter values in the MCMC parametrization.
+        """
+        mcmc_p = np.ascontiguousarray(mcmc_p, dtype=np.float64).reshape(-1)
+        return self._ln_posterior.ln_posterior(mcmc_p)
+
+    def ln_posterior_and_grad(self, mcmc_p):
+        """Compute the log-posterior and its gradient with respect to the
+        MCMC parameters for a single walker position. The derivatives of the
+        velocity curve with respect to the orbital elements are computed
+        analytically from the eccentric and true anomalies.
+
+        Parameters
+        ----------
+        mcmc_p : array_like
+            A vector of parameter values in the MCMC parametrization.
+
+        Returns
+        -------
+        ln_post : float
+        grad : `numpy.ndarray`
+        """
+        mcmc_p = np.ascontiguousarray(mcmc_p, dtype=np.float64).reshape(-1)
+        return self._ln_posterior.ln_posterior_and_grad(mcmc_p)
+
+    def batch_ln_posterior(self, mcmc_p):
+        """Compute the log-posterior for a batch of walker positions at once,
+        e.g., for use with ``emcee``'s ``vectorize`` option.
+
+        Parameters
+        ----------
+        mcmc_p : `numpy.ndarray`
+            A 2D array of walker positions in the MCMC parametrization, with
+            shape ``(n_walkers, n_dim)``.
+
+        Returns
+        -------
+        ln_post : `numpy.ndarray`
+            The log-posterior values, with shape ``(n_walkers,)``.
+        """
+        mcmc_p = np.ascontiguousarray(mcmc_p, dtype=np.float64)
+        return self._ln_posterior.batch_ln_posterior(mcmc_p)
+
+    def __call__(self, mcmc_p):
+        return self.ln_posterior(mcmc_p)
+
+
+class TheJokerMarginalMCMCModel:
+
+    def __init__(self, joker_params, data):
+        r"""An MCMC model for the posterior over the nonlinear parameters only,
+        with the linear parameters (``K``, the velocity trend terms, and any
+        instrument offsets) marginalized over analytically using the same
+        marginal likelihood as the rejection sampler. The target is therefore
+        the same as The Joker's posterior, but in at most five dimensions:
+
+        .. math::
+
+            \ln P \\
+            \sqrt{e}\,\cos\omega, \sqrt{e}\,\sin\omega \\
+            M_0 \\
+            \ln s^2
+
+        The jitter is only included if it is neither fixed nor marginalized
+        over on a grid (``joker_params.jitter_grid``), and :math:`\ln s^2`
+        is in the units of the jitter prior. The linear parameters are drawn
+        from their conditional posterior for each stored sample with
+        `~thejoker.sampler.TheJokerMarginalMCMCModel.sample_linear`.
+
+        Parameters
+        ----------
+        joker_params : `~thejoker.sampler.params.JokerParams`
+            The specification of parameters to infer with The Joker.
+        data : `~thejoker.data.RVData`
+            The radial velocity data.
+        """
+
+        # check if a JokerParams instance was passed in to specify the state
+        if not isinstance(joker_params, JokerParams):
+            raise TypeError("Parameter specification must be a JokerParams "
+                            "instance, not a '{0}'".format(type(joker_params)))
+        self.params = joker_params
+
+        if not isinstance(data, RVData):
+            raise TypeError("Data must be a valid RVData object.")
+        self.data = data
+
+        # various cached things:
+        self._ln_P_min = np.log(self.params.P_min.to(u.day).value)
+        self._ln_P_max = np.log(self.params.P_max.to(u.day).value)
+        self._rv_unit = self.data.rv.unit
+
+        # units of the columns of the packed nonlinear parameters, as used by
+        # the likelihood functions
+        self.prior_units = [u.day, u.radian, u.one, u.radian, self._rv_unit]
+
+        self._sample_jitter = (not self.params._fixed_jitter and
+                               self.params.jitter_grid is None)
+        self._jitter_factor = self._rv_unit.to(self.params._jitter_unit)
+
         if self.params._fixed_jitter:
-            mcmc_p = list(mcmc_p)
-            mcmc_p.insert(5, self._y_jitter) # whoa, major hackage!
+            self._s_jitter = self.params.jitter.to(self._rv_unit).value
+        else:
+            # the jitter is either sampled or drawn with the linear parameters
+            self._s_jitter = 0.
 
-        p = self.from_mcmc_params(mcmc_p).reshape(len(mcmc_p))
+        self.n_dim = 4 + int(self._sample_jitter)
 
-        lnp = self.ln_prior(p)
-        if np.isinf(lnp):
-            return lnp
+    def to_mcmc_params(self, chunk):
+        """Transform from packed nonlinear parameter values to the variables
+        used for MCMC sampling.
 
-        lnl = self.ln_likelihood(p)
-        lnprob = lnp + lnl.sum()
+        Parameters
+        ----------
+        chunk : `numpy.ndarray`
+            A 2D array of nonlinear parameter values with shape ``(n, 5)``,
+            as returned by `~thejoker.sampler.pack_prior_samples`.
 
-        if np.isnan(lnprob):
-            return -np.inf
+        Returns
+        -------
+        mcmc_p : `numpy.ndarray`
+            A 2D array with shape ``(n, n_dim)``.
+        """
+        P, M0, e, omega, s = np.atleast_2d(chunk).T
+        arr = [np.log(P),
+               np.sqrt(e) * np.cos(omega),
+               np.sqrt(e) * np.sin(omega),
+               M0]
+
+        if self._sample_jitter:
+            arr.append(2 * np.log(s * self._jitter_factor))
+
+        return np.stack(arr, axis=1)
+
+    def from_mcmc_params(self, mcmc_p):
+        """Transform from the variables used for MCMC sampling to packed
+        nonlinear parameter values, as expected by the likelihood functions.
+
+        Parameters
+        ----------
+        mcmc_p : `numpy.ndarray`
+            A 2D array with shape ``(n, n_dim)``.
+
+        Returns
+        -------
+        chunk : `numpy.ndarray`
+            A 2D array of nonlinear parameter values with shape ``(n, 5)``.
+        """
+        mcmc_p = np.atleast_2d(mcmc_p)
+
+        chunk = np.zeros((len(mcmc_p), 5))
+        chunk[:, 0] = np.exp(mcmc_p[:, 0])
+        chunk[:, 1] = mcmc_p[:, 3] % (2*np.pi)
+        chunk[:, 2] = mcmc_p[:, 1]**2 + mcmc_p[:, 2]**2
+        chunk[:, 3] = np.arctan2(mcmc_p[:, 2], mcmc_p[:, 1]) % (2*np.pi)
+
+        if self._sample_jitter:
+            chunk[:, 4] = np.sqrt(np.exp(mcmc_p[:, 4])) / self._jitter_factor
+        else:
+            chunk[:, 4] = self._s_jitter
+
+        return chunk
+
+    def pack_samples_mcmc(self, samples):
+        """Pack a dictionary of samples as Quantity objects into a 2D array,
+        transformed to the parametrization used by the MCMC functions.
+
+        Parameters
+        ----------
+        samples : dict
+            Dictionary of `~astropy.units.Quantity` objects for period,
+            M0, etc.
+
+        Returns
+        -------
+        arr : `numpy.ndarray`
+            A 2D numpy array with shape `(nsamples, ndim)`.
+        """
+        chunk, _ = pack_prior_samples(samples, self._rv_unit)
+        return self.to_mcmc_params(chunk)
+
+    def batch_ln_prior(self, mcmc_p):
+        r"""Compute the log-prior for a batch of walker positions.
+
+        The prior is the same as that used for the prior samples: uniform in
+        :math:`\ln P`, :math:`M_0`, and :math:`\omega`, and a Beta
+        distribution in eccentricity. A uniform density in
+        :math:`(\sqrt{e}\cos\omega, \sqrt{e}\sin\omega)` corresponds to
+        a uniform density in :math:`e` and :math:`\omega`, so no Jacobian is
+        needed.
+
+        Parameters
+        ----------
+        mcmc_p : `numpy.ndarray`
+            A 2D array of walker positions with shape ``(n_walkers, n_dim)``.
+
+        Returns
+        -------
+        ln_prior : `numpy.ndarray`
+        """
+        mcmc_p = np.atleast_2d(mcmc_p)
+
+        ln_P = mcmc_p[:, 0]
+        e = mcmc_p[:, 1]**2 + mcmc_p[:, 2]**2
+
+        lnp = np.full(len(mcmc_p), -np.inf)
+        ok = (ln_P > self._ln_P_min) & (ln_P < self._ln_P_max) & (e < 1)
+
+        lnp[ok] = beta_logpdf(e[ok], 0.867, 3.03) # Kipping et al. 2013
+
+        if self._sample_jitter:
+            # Gaussian prior in ln(s^2)
+            lnp[ok] += norm_logpdf(mcmc_p[ok, 4], self.params.jitter[0],
+                                   self.params.jitter[1])
+
+        return lnp
+
+    def batch_ln_posterior(self, mcmc_p):
+        """Compute the log-posterior for a batch of walker positions, e.g.,
+        for use with ``emcee``'s ``vectorize`` option.
+
+        Parameters
+        ----------
+        mcmc_p : `numpy.ndarray`
+            A 2D array of walker positions with shape ``(n_walkers, n_dim)``.
+
+        Returns
+        -------
+        ln_post : `numpy.ndarray`
+        """
+        mcmc_p = np.atleast_2d(mcmc_p)
+
+        lnp = self.batch_ln_prior(mcmc_p)
+        ok = np.isfinite(lnp)
+        if np.any(ok):
+            chunk = self.from_mcmc_params(mcmc_p[ok])
+            lnp[ok] += np.asarray(batch_marginal_ln_likelihood(
+                chunk, self.data, self.params))
+
+        lnp[np.isnan(lnp)] = -np.inf
+        return lnp
+
+    def ln_posterior(self, mcmc_p):
+        """Compute the log-posterior for a single walker position."""
+        mcmc_p = np.asarray(mcmc_p, dtype=np.float64).reshape(1, -1)
+        return self.batch_ln_posterior(mcmc_p)[0]
+
+    def sample_linear(self, mcmc_p, random_state=None):
+        """Draw the linear parameters (and the jitter, if it is marginalized
+        over on a grid) from their conditional posterior for each walker
+        position.
+
+        Parameters
+        ----------
+        mcmc_p : `numpy.ndarray`
+            A 2D array of walker positions with shape ``(n, n_dim)``.
+        random_state : `numpy.random.RandomState` (optional)
+
+        Returns
+        -------
+        pars : `numpy.ndarray`
+            The full parameter vectors, in the same format as the output of
+            the rejection sampler.
+        """
+        if random_state is None:
+            random_state = np.random.RandomState()
 
-        return lnprob
+        chunk = self.from_mcmc_params(mcmc_p)
+        return np.array(batch_get_posterior_samples(chunk, self.data,
+                                                    self.params, random_state,
+                                                    False))
 
     def __call__(self, mcmc_p):
         return self.ln_posterior(mcmc_p)
@@ -1,16 +1,21 @@
+# Standard library
+import hashlib
+
 # Third-party
 import h5py
 import numpy as np
 
 # Project
 from ..log import log
+from ..stats import norm_logpdf
 from .likelihood import (get_ivar, design_matrix, tensor_vector_scalar,
                          marginal_ln_likelihood)
 from .fast_likelihood import (batch_marginal_ln_likelihood,
                               batch_get_posterior_samples)
+from .io import _pad_prior_samples
 
 __all__ = ['compute_likelihoods', 'get_good_sample_indices',
-           'sample_indices_to_full_samples']
+           'reservoir_sample_indices', 'sample_indices_to_full_samples']
 
 
 def chunk_tasks(n_tasks, n_batches, arr=None, args=None, start_idx=0):
@@ -89,17 +94,139 @@ def _marginal_ll_worker(task):
 
     # read a chunk of the prior samples
     with h5py.File(prior_cache_file, 'r') as f:
-        chunk = np.array(f['samples'][start_stop[0]:start_stop[1]])
-
-    chunk = chunk.astype(np.float64)
+        chunk = _pad_prior_samples(
+            f, f['samples'][start_stop[0]:start_stop[1]])
 
     # memoryview is returned
     ll = batch_marginal_ln_likelihood(chunk, data, jparams)
     return np.array(ll)
 
 
+def _data_fingerprint(data):
+    """Return a hash of the data arrays, used to identify a dataset when caching
+    likelihood values. This is meant to be used internally.
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(data._t_bmjd, dtype='f8').tobytes())
+    h.update(np.ascontiguousarray(data.rv.value, dtype='f8').tobytes())
+    h.update(np.ascontiguousarray(data.ivar.value, dtype='f8').tobytes())
+    h.update(str(data.rv.unit).encode())
+    h.update(repr(float(data._t0_bmjd)).encode())
+    if data.instruments is not None:
+        h.update(np.ascontiguousarray(data._instrument_idx,
+                                      dtype='i8').tobytes())
+        h.update(repr([str(x) for x in data.instruments]).encode())
+    return h.hexdigest()
+
+
+def _prior_cache_fingerprint(prior_cache_file, n_prior_samples, start_idx):
+    """Return a hash of the prior samples used from a prior cache file. Only the
+    first and last rows are read, so this is cheap even for very large caches.
+    This is meant to be used internally.
+    """
+    n_rows = 1024
+    h = hashlib.sha1()
+    h.update('{0}-{1}'.format(n_prior_samples, start_idx).encode())
+    with h5py.File(prior_cache_file, 'r') as f:
+        i1 = start_idx
+        i2 = start_idx + n_prior_samples
+        samples = f['samples']
+        h.update(np.array(samples[i1:min(i1 + n_rows, i2)]).tobytes())
+        h.update(np.array(samples[max(i2 - n_rows, i1):i2]).tobytes())
+    return h.hexdigest()
+
+
+def _likelihood_fingerprint(prior_cache_file, n_prior_samples, start_idx, data,
+                            joker_params):
+    """Return a hash identifying a likelihood computation from the prior
+    samples, data, and parameter specification. This is meant to be used
+    internally.
+    """
+    h = hashlib.sha1()
+    h.update(_prior_cache_fingerprint(prior_cache_file, n_prior_samples,
+                                      start_idx).encode())
+    h.update(_data_fingerprint(data).encode())
+    h.update(repr(sorted(vars(joker_params).items())).encode())
+    return h.hexdigest()
+
+
+def _likelihood_params_fingerprint(joker_params):
+    """Return a hash of the parameter specification that only includes the
+    settings that affect the value of the marginal likelihood, not those
+    (like the period range or the jitter prior) that only change the prior.
+    This is meant to be used internally.
+    """
+    attrs = dict(vars(joker_params))
+    for name in ['P_min', 'P_max']:
+        attrs.pop(name, None)
+
+    if not joker_params._fixed_jitter and joker_params.jitter_grid is None:
+        attrs.pop('jitter', None)
+
+    return hashlib.sha1(repr(sorted(attrs.items())).encode()).hexdigest()
+
+
+def _compute_likelihoods_checkpointed(n_prior_samples, prior_cache_file,
+                                      start_idx, data, joker_params, pool,
+                                      n_batches, checkpoint_file):
+    """Compute likelihood values for batches of prior samples, saving the
+    results for each batch to a checkpoint file as they are computed. Batches
+    that are already completed in the checkpoint file are skipped. This is
+    meant to be used internally: see `compute_likelihoods`.
+    """
+    fingerprint = _likelihood_fingerprint(prior_cache_file, n_prior_samples,
+                                          start_idx, data, joker_params)
+
+    with h5py.File(checkpoint_file, 'a') as f:
+        if 'marg_ll' in f:
+            if str(f.attrs['fingerprint']) != fingerprint:
+                raise ValueError("Checkpoint file '{0}' was created for a "
+                                 "different set of prior samples, data, or "
+                                 "parameters. Delete it or use a different "
+                                 "checkpoint file.".format(checkpoint_file))
+
+            # always use the batches the checkpoint file was created with
+            n_batches = int(f.attrs['n_batches'])
+            done = f['done'][:]
+
+        else:
+            n_tasks = len(chunk_tasks(n_prior_samples, n_batches=n_batches))
+            f.attrs['fingerprint'] = fingerprint
+            f.attrs['n_batches'] = n_batches
+            f.create_dataset('marg_ll', shape=(n_prior_samples, ),
+                             dtype='f8', fillvalue=np.nan)
+            f.create_dataset('done', shape=(n_tasks, ), dtype=bool)
+            done = np.zeros(n_tasks, dtype=bool)
+
+    args = [prior_cache_file, data, joker_params]
+    tasks = chunk_tasks(n_prior_samples, n_batches=n_batches, args=args,
+                        start_idx=start_idx)
+    todo = [i for i in range(len(tasks)) if not done[i]]
+    log.debug("{0} of {1} likelihood batches already completed in checkpoint "
+              "file".format(len(tasks) - len(todo), len(tasks)))
+
+    # send out one batch per worker at a time, and save the results after each
+    wave_size = max(pool.size, 1)
+    for i in range(0, len(todo), wave_size):
+        wave = todo[i:i+wave_size]
+        results = [r for r in pool.map(_marginal_ll_worker,
+                                       [tasks[j] for j in wave])]
+
+        with h5py.File(checkpoint_file, 'a') as f:
+            for j, ll in zip(wave, results):
+                i1, i2 = tasks[j][0]
+                f['marg_ll'][i1-start_idx:i2-start_idx] = ll
+                f['done'][j] = True
+
+    with h5py.File(checkpoint_file, 'r') as f:
+        marg_ll = f['marg_ll'][:]
+
+    return marg_ll
+
+
 def compute_likelihoods(n_prior_samples, prior_cache_file, start_idx, data,
-                        joker_params, pool, n_batches=None):
+                        joker_params, pool, n_batches=None,
+                        checkpoint_file=None):
     """
     Return the indices of 'good' samples by computing the log-likelihood
     for ``n_prior_samples`` prior samples and doing rejection sampling.
@@ -125,13 +252,21 @@ def compute_likelihoods(n_prior_samples, prior_cache_file, start_idx, data,
     pool : `~schwimmbad.pool.BasePool` or subclass
         An instance of a processing pool - must have a ``.map()`` method.
     n_batches : int (optional)
-        How many batches to divide the work into. Defaults to ``pool.size``.
+        How many batches to divide the work into. Defaults to ``pool.size``,
+        or ``16*pool.size`` if ``checkpoint_file`` is specified.
+    checkpoint_file : str (optional)
+        Path to an HDF5 file to save the likelihood values to as each batch
+        is completed. If the file already exists, batches that were completed
+        by a previous call (e.g., one that was interrupted) with the same
+        prior samples, data, and parameters are not re-computed, and the
+        batches are always those the file was created with. The checkpoint is
+        written after every ``pool.size`` batches, so ``n_batches`` sets how
+        often progress is saved.
 
     Returns
     -------
-    samples_idx : `numpy.ndarray`
-        An array of integers for the prior samples that pass
-        rejection sampling.
+    marg_ll : `numpy.ndarray`
+        An array of marginal log-likelihood values for the prior samples.
 
     TODO
     ----
@@ -141,6 +276,14 @@ def compute_likelihoods(n_prior_samples, prior_cache_file, start_idx, data,
         the likelihood values instead?
 
     """
+    if checkpoint_file is not None:
+        if n_batches is None:
+            n_batches = 16 * max(pool.size, 1)
+
+        return _compute_likelihoods_checkpointed(
+            n_prior_samples, prior_cache_file, start_idx, data, joker_params,
+            pool, n_batches, checkpoint_file)
+
     args = [prior_cache_file, data, joker_params]
     if n_batches is None:
         n_batches = pool.size
@@ -186,6 +329,217 @@ def get_good_sample_indices(marg_ll, seed=None):
     return good_samples_idx
 
 
+class RejectionState(object):
+    """Running state for rejection sampling over batches of likelihood values.
+
+    Rather than re-doing the rejection step over all likelihood values
+    computed so far every time a new batch comes in, this keeps the running
+    maximum log-likelihood and the set of accepted indices. When a new batch
+    raises the maximum, the already-accepted samples are thinned: a sample
+    accepted with probability ``exp(ll - old_max)`` is kept with probability
+    ``exp(old_max - new_max)``, which leaves it accepted with the correct
+    probability ``exp(ll - new_max)``. The result is a valid rejection sample
+    over all batches seen so far, at a cost linear in the batch size.
+
+    Parameters
+    ----------
+    seed : int (optional)
+        Random number seed for the uniform samples used in rejection sampling.
+    """
+
+    def __init__(self, seed=None):
+        self.random_state = np.random.RandomState(seed)
+        self.max_ll = -np.inf
+        self.n_processed = 0
+        self.good_samples_idx = np.array([], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.good_samples_idx)
+
+    def update(self, marg_ll, start_idx):
+        """Rejection sample a new batch of marginal log-likelihood values.
+
+        Parameters
+        ----------
+        marg_ll : array_like
+            Array of marginal log-likelihood values for the new batch.
+        start_idx : int
+            Index of the first sample of the batch in the prior cache file.
+
+        Returns
+        -------
+        n_good : int
+            The total number of accepted samples after this batch.
+        """
+        marg_ll = np.asarray(marg_ll)
+        rnd = self.random_state
+
+        finite = np.isfinite(marg_ll)
+        if finite.any():
+            batch_max = marg_ll[finite].max()
+
+            if batch_max > self.max_ll:
+                if len(self.good_samples_idx) > 0:
+                    p_keep = np.exp(self.max_ll - batch_max)
+                    uu = rnd.uniform(size=len(self.good_samples_idx))
+                    self.good_samples_idx = self.good_samples_idx[uu < p_keep]
+                self.max_ll = batch_max
+
+            uu = rnd.uniform(size=len(marg_ll))
+            good = np.zeros(len(marg_ll), dtype=bool)
+            good[finite] = uu[finite] < np.exp(marg_ll[finite] - self.max_ll)
+            good_idx, = np.where(good)
+
+            self.good_samples_idx = np.concatenate(
+                (self.good_samples_idx, good_idx.astype(np.int64) + start_idx))
+
+        self.n_processed += len(marg_ll)
+        return len(self.good_samples_idx)
+
+
+def _reservoir_worker(task):
+    """
+    Compute the marginal log-likelihood for a chunk of prior samples and keep
+    a weighted reservoir of the ``n_samples`` samples with the largest
+    exponential keys. This is meant to be ``map``ped using a processing pool
+    within the functions below and is not supposed to be in the public API.
+
+    Parameters
+    ----------
+    task : iterable
+        An array containing the indices of samples to be operated on, the
+        filename containing the prior samples, the data, the parameter
+        specification, the size of the reservoir, and the global random
+        number seed.
+
+    Returns
+    -------
+    keys : `numpy.ndarray`
+        The reservoir keys.
+    idx : `numpy.ndarray`
+        Indices of the reservoir samples in the prior cache file.
+    ll_sums : tuple
+        The maximum log-likelihood in the chunk and the sums of the
+        likelihood and likelihood squared (relative to the maximum), used to
+        estimate the effective sample size.
+
+    """
+    (start_stop, chunk_index, prior_cache_file, data, jparams, n_samples,
+     global_seed) = task
+
+    if global_seed is not None:
+        rnd = np.random.RandomState(global_seed + chunk_index)
+    else:
+        rnd = np.random.RandomState()
+
+    ll = _marginal_ll_worker([start_stop, chunk_index, prior_cache_file,
+                              data, jparams])
+    ll[~np.isfinite(ll)] = -np.inf
+
+    # Gumbel-max trick: the samples with the n largest values of
+    # ln(weight) + Gumbel noise are a weighted sample without replacement
+    keys = ll + rnd.gumbel(size=len(ll))
+    idx = np.arange(start_stop[0], start_stop[1])
+
+    if len(keys) > n_samples:
+        top = np.argpartition(keys, -n_samples)[-n_samples:]
+        keys = keys[top]
+        idx = idx[top]
+
+    max_ll = ll.max()
+    if np.isfinite(max_ll):
+        w = np.exp(ll - max_ll)
+        ll_sums = (max_ll, w.sum(), (w**2).sum())
+    else:
+        ll_sums = (max_ll, 0., 0.)
+
+    return keys, idx, ll_sums
+
+
+def reservoir_sample_indices(n_samples, n_prior_samples, prior_cache_file,
+                             start_idx, data, joker_params, pool,
+                             global_seed=None, n_batches=None):
+    """
+    Return the indices of exactly ``n_samples`` prior samples drawn with
+    probability proportional to their marginal likelihood, in a single pass
+    over the prior samples.
+
+    Each worker keeps a reservoir of at most ``n_samples`` samples for its
+    chunk of the prior samples, so memory use is independent of the number of
+    prior samples. The reservoirs are then merged by keeping the samples with
+    the largest keys over all chunks. The samples are drawn *without*
+    replacement, so when the effective number of prior samples (the Kish
+    effective sample size of the likelihood weights) is not much larger than
+    ``n_samples``, the returned samples will over-represent low-likelihood
+    regions of parameter space. A warning is emitted in this case.
+
+    Parameters
+    ----------
+    n_samples : int
+        The number of samples to return.
+    n_prior_samples : int
+        The number of prior samples to use.
+    prior_cache_file : str
+        Path to an HDF5 file containing the prior samples.
+    start_idx : int
+        Index to start reading prior samples from in the prior cache file.
+    data : `~thejoker.data.RVData`
+        An instance of ``RVData`` with the data we're modeling.
+    joker_params : `~thejoker.sampler.params.JokerParams`
+        A specification of the parameters to use.
+    pool : `~schwimmbad.pool.BasePool` or subclass
+        An instance of a processing pool - must have a ``.map()`` method.
+    global_seed : int (optional)
+        The global level random number seed.
+    n_batches : int (optional)
+        How many batches to divide the work into. Defaults to ``pool.size``.
+
+    Returns
+    -------
+    samples_idx : `numpy.ndarray`
+        A sorted array of ``n_samples`` integer indices into the prior samples.
+    n_eff : float
+        The effective sample size of the likelihood weights.
+
+    """
+    if n_samples > n_prior_samples:
+        raise ValueError("Number of requested samples ({0}) is larger than "
+                         "the number of prior samples ({1})."
+                         .format(n_samples, n_prior_samples))
+
+    args = [prior_cache_file, data, joker_params, n_samples, global_seed]
+    if n_batches is None:
+        n_batches = pool.size
+    tasks = chunk_tasks(n_prior_samples, n_batches=n_batches, args=args,
+                        start_idx=start_idx)
+
+    results = [r for r in pool.map(_reservoir_worker, tasks)]
+    keys = np.concatenate([r[0] for r in results])
+    idx = np.concatenate([r[1] for r in results])
+
+    # merge the reservoirs
+    top = np.argpartition(keys, -n_samples)[-n_samples:]
+    if not np.all(np.isfinite(keys[top])):
+        raise RuntimeError("Fewer than {0} prior samples have a finite "
+                           "likelihood value.".format(n_samples))
+    samples_idx = np.sort(idx[top])
+
+    # combine the per-chunk sums to get the effective sample size
+    max_ll, w_sum, w2_sum = np.array([r[2] for r in results]).T
+    global_max = max_ll.max()
+    scale = np.exp(max_ll - global_max)
+    n_eff = (w_sum * scale).sum()**2 / (w2_sum * scale**2).sum()
+
+    if n_eff < n_samples:
+        log.warning("Effective number of prior samples ({0:.1f}) is smaller "
+                    "than the number of requested samples ({1}): the "
+                    "returned samples are not representative of the "
+                    "posterior. Use more prior samples."
+                    .format(n_eff, n_samples))
+
+    return samples_idx, n_eff
+
+
 def _sample_vector_worker(task):
     """
     This is meant to be
@@ -209,16 +563,27 @@ def _sample_vector_worker(task):
     with h5py.File(prior_cache_file, 'r') as f:
         tmp = np.zeros(len(f['samples']), dtype=bool)
         tmp[idx] = True
-        chunk = np.array(f['samples'][tmp, :])
+        chunk = _pad_prior_samples(f, f['samples'][tmp, :])
 
         if return_logprobs:
             ln_prior = np.array(f['ln_prior_probs'][tmp])
 
-    chunk = chunk.astype(np.float64)
-
     pars = batch_get_posterior_samples(chunk, data, joker_params, rnd,
                                        return_logprobs)
     if return_logprobs:
+        if joker_params.jitter_grid is not None:
+            # the jitter is drawn above, so its prior is not in the cache. The
+            # jitter of the other instruments (if any) is just before ln_like
+            s = pars[:, 4:5]
+            if joker_params.per_instrument_jitter:
+                n_extra = data.n_instruments - 1
+                s = np.hstack((s, pars[:, -1-n_extra:-1]))
+
+            s = (s * data.rv.unit).to(joker_params._jitter_unit).value
+            ln_prior = ln_prior + np.sum(norm_logpdf(np.log(s**2),
+                                                     *joker_params.jitter) +
+                                         np.log(2 / s), axis=1) # Jacobian
+
         pars = np.hstack((pars[:, :-1], ln_prior[:, None], pars[:, -1:]))
     return pars
 
@@ -31,6 +31,11 @@ class JokerParams(object):
         If sampling over the jitter as an extra non-linear parameter,
         you must also specify the units of the jitter prior. See note
         above about the ``jitter`` argument.
+    poly_trend : int (optional)
+        The number of terms in the polynomial long-term velocity trend,
+        in powers of the time since the reference time of the data. The
+        default, 1, is a constant velocity offset, ``v0``. For example,
+        to also include a constant acceleration, ``v1``, set this to 2.
     anomaly_tol : float (optional)
         Convergence tolerance passed to
         :func:`twobody.eccentric_anomaly_from_mean_anomaly`.
@@ -39,6 +44,37 @@ class JokerParams(object):
         Maximum number of iterations passed to
         :func:`twobody.eccentric_anomaly_from_mean_anomaly`.
         Arbitrarily set to 128 by default.
+    marginalize_omega : bool (optional)
+        Marginalize over the argument of pericenter analytically. At fixed
+        period, phase, and eccentricity, the radial velocity is linear in
+        :math:`K\cos\omega` and :math:`K\sin\omega`, so these are added
+        to the linear parameters and the prior samples only have to cover
+        period, phase, and eccentricity (and possibly jitter). The values of
+        :math:`K` and :math:`\omega` are recovered for samples that pass the
+        rejection step. Note that, as for the other linear parameters, the
+        (improper) prior is uniform in :math:`K\cos\omega` and
+        :math:`K\sin\omega`: this is uniform in :math:`\omega`, but
+        proportional to :math:`K` instead of uniform in :math:`K`.
+    jitter_grid : int (optional)
+        If sampling over the jitter, marginalize over the jitter numerically
+        instead of including it as a non-linear parameter in the prior
+        samples. The marginal likelihood is evaluated on a uniform grid of
+        this many points in :math:`\log s^2` that spans :math:`\pm 5\sigma`
+        around the mean of the jitter prior, and is integrated against the
+        prior. Values of the jitter are only drawn for samples that pass the
+        rejection step. Ignored (must be ``None``) if the jitter is fixed.
+    per_instrument_jitter : bool (optional)
+        If the data come from more than one instrument, give each instrument
+        its own jitter, each with the same prior as specified with the
+        ``jitter`` argument. This requires ``jitter_grid``: the marginal
+        likelihood is integrated over the grid for each instrument. The
+        normal equations are accumulated separately for each instrument, so
+        that this only requires one pass over the data per prior sample and
+        grid point. The jitter of the first instrument is stored as
+        ``jitter``, and that of each other instrument as ``jitter_<label>``.
+        The likelihood is evaluated for every combination of grid values,
+        so ``jitter_grid`` to the power of the number of instruments may
+        not exceed 65536 (e.g., 16 grid points for 4 instruments).
 
     Examples
     --------
@@ -52,16 +88,27 @@ class JokerParams(object):
     """
     @u.quantity_input(P_min=u.day, P_max=u.day)
     def __init__(self, P_min, P_max,
-                 jitter=None, jitter_unit=None,
-                 anomaly_tol=1E-10, anomaly_maxiter=128):
+                 jitter=None, jitter_unit=None, poly_trend=1,
+                 anomaly_tol=1E-10, anomaly_maxiter=128,
+                 marginalize_omega=False, jitter_grid=None,
+                 per_instrument_jitter=False):
+
+        # validate the polynomial trend specification
+        poly_trend = int(poly_trend)
+        if poly_trend < 1:
+            raise ValueError("The velocity trend must have at least one "
+                             "(constant) term.")
+        self.poly_trend = poly_trend
 
         # the names of the default parameters
-        self.default_params = ['P', 'M0', 'e', 'omega', 'jitter', 'K', 'v0']
+        self.default_params = ['P', 'M0', 'e', 'omega', 'jitter', 'K']
+        self.default_params += ['v{0}'.format(i) for i in range(poly_trend)]
 
         self.P_min = P_min
         self.P_max = P_max
         self.anomaly_tol = float(anomaly_tol)
         self.anomaly_maxiter = int(anomaly_maxiter)
+        self.marginalize_omega = bool(marginalize_omega)
 
         # validate the input jitter specification
         if jitter is None:
@@ -89,6 +136,24 @@ class JokerParams(object):
             self._jitter_unit = jitter.unit
             self.jitter = jitter
 
+        if jitter_grid is not None:
+            if self._fixed_jitter:
+                raise ValueError("A jitter grid can only be used if the jitter "
+                                 "is sampled over, but the jitter is fixed.")
+
+            jitter_grid = int(jitter_grid)
+            if jitter_grid < 2:
+                raise ValueError("The jitter grid must have at least 2 points.")
+
+        self.jitter_grid = jitter_grid
+
+        per_instrument_jitter = bool(per_instrument_jitter)
+        if per_instrument_jitter and jitter_grid is None:
+            raise ValueError("A jitter for each instrument is only supported "
+                             "when marginalizing over the jitter on a grid: "
+                             "you must also specify jitter_grid.")
+        self.per_instrument_jitter = per_instrument_jitter
+
     @property
     def num_params(self):
         n = len(self.default_params)
@@ -7,20 +7,109 @@ import time
 import astropy.units as u
 import h5py
 import numpy as np
+from scipy.optimize import minimize
 from scipy.stats import scoreatpercentile
 
 # Project
 from ..log import log as logger
 from ..data import RVData
-from ..stats import beta_logpdf, norm_logpdf
+from ..stats import beta_logpdf, norm_logpdf, autocorr_time, gelman_rubin
 from .params import JokerParams
 from .multiproc_helpers import (get_good_sample_indices, compute_likelihoods,
-                                sample_indices_to_full_samples)
-from .io import save_prior_samples
+                                sample_indices_to_full_samples,
+                                reservoir_sample_indices, RejectionState,
+                                _data_fingerprint,
+                                _likelihood_params_fingerprint)
+from .io import save_prior_samples, _pad_prior_samples
 from .samples import JokerSamples
-from .mcmc import TheJokerMCMCModel
+from .mcmc import TheJokerMCMCModel, TheJokerMarginalMCMCModel
+from .hmc import HMCSampler
 
-__all__ = ['TheJoker']
+__all__ = ['TheJoker', 'is_P_unimodal']
+
+
+def _ln_prior_nonlinear(params, P, e, jitter):
+    """Compute the log-prior probability of the nonlinear parameters. This is
+    meant to be used internally.
+
+    Parameters
+    ----------
+    params : `~thejoker.sampler.params.JokerParams`
+        The parameter specification that defines the prior.
+    P : `numpy.ndarray`
+        Period in days.
+    e : `numpy.ndarray`
+        Eccentricity.
+    jitter : `numpy.ndarray`
+        Jitter in units of ``params._jitter_unit``. Ignored if the jitter is
+        fixed or marginalized over on a grid.
+
+    Returns
+    -------
+    ln_prior : `numpy.ndarray`
+        The log-prior values. These are not checked against the period range.
+    """
+    a, b = (np.log(params.P_min.to(u.day).value),
+            np.log(params.P_max.to(u.day).value))
+
+    # P
+    ln_prior_val = -np.log(b - a) - np.log(P)
+
+    # M0
+    ln_prior_val += -np.log(2 * np.pi)
+
+    # e - MAGIC NUMBERS below: Kipping et al. 2013 (MNRAS 434 L51)
+    ln_prior_val += beta_logpdf(e, 0.867, 3.03)
+
+    # omega
+    if not params.marginalize_omega:
+        ln_prior_val += -np.log(2 * np.pi)
+
+    if not params._fixed_jitter and params.jitter_grid is None:
+        # Gaussian prior in log(s^2)
+        log_s2 = np.log(jitter**2)
+        Jac = np.log(2 / jitter)  # Jacobian
+        ln_prior_val += norm_logpdf(log_s2,
+                                    params.jitter[0],
+                                    params.jitter[1]) + Jac
+
+    return ln_prior_val
+
+
+def is_P_unimodal(samples, data):
+    r"""Check whether a set of posterior samples is unimodal in period.
+
+    The samples are considered unimodal if the standard deviation of the
+    period is smaller than the separation between neighboring period modes
+    allowed by the data,
+
+    .. math::
+
+        \Delta = \frac{4\,P^2}{2\pi\,T}
+
+    where :math:`P` is the median period and :math:`T` is the time baseline of
+    the data. A single sample is always considered unimodal.
+
+    Parameters
+    ----------
+    samples : `~thejoker.JokerSamples`
+        The posterior samples.
+    data : `~thejoker.RVData`
+        The radial velocity data.
+
+    Returns
+    -------
+    unimodal : bool
+    """
+    P = np.atleast_1d(samples['P'].to(u.day).value)
+    if len(P) == 1:
+        return True
+
+    T = np.ptp(data._t_bmjd)
+    P_med = np.median(P)
+    Delta = 4 * P_med**2 / (2 * np.pi * T)
+
+    return bool(np.std(P) < Delta)
 
 
 class TheJoker(object):
@@ -117,47 +206,39 @@ class TheJoker(object):
         # MAGIC NUMBERS below: Kipping et al. 2013 (MNRAS 434 L51)
         samples['e'] = rnd.beta(a=0.867, b=3.03, size=size) * u.one
 
-        samples['omega'] = rnd.uniform(0, 2 * np.pi, size=size) * u.radian
-
-        # Store the value of the prior at each prior sample
-        # TODO: should we store the value for each parameter independently?
-        if return_logprobs:
-            ln_prior_val = np.zeros(size)
-
-            # P
-            ln_prior_val += -np.log(b - a) - np.log(samples['P'].value)
-
-            # M0
-            ln_prior_val += -np.log(2 * np.pi)
-
-            # e - MAGIC NUMBERS below: Kipping et al. 2013 (MNRAS 434 L51)
-            ln_prior_val += beta_logpdf(samples['e'].value, 0.867, 3.03)
+        if self.params.marginalize_omega:
+            # omega is a linear parameter: it is set by the likelihood step
+            samples['omega'] = np.zeros(size) * u.radian
+        else:
+            samples['omega'] = rnd.uniform(0, 2 * np.pi, size=size) * u.radian
 
-            # omega
-            ln_prior_val += -np.log(2 * np.pi)
+        if self.params.jitter_grid is not None:
+            # the jitter is marginalized over when computing the likelihood
+            samples['jitter'] = np.zeros(size) * self.params._jitter_unit
 
-        if not self.params._fixed_jitter:
+        elif not self.params._fixed_jitter:
             # Gaussian prior in log(s^2)
             log_s2 = rnd.normal(*self.params.jitter, size=size)
             samples['jitter'] = np.sqrt(
                 np.exp(log_s2)) * self.params._jitter_unit
 
-            if return_logprobs:
-                Jac = np.log(2 / samples['jitter'].value)  # Jacobian
-                ln_prior_val += norm_logpdf(log_s2,
-                                            self.params.jitter[0],
-                                            self.params.jitter[1]) + Jac
-
         else:
             samples['jitter'] = np.ones(size) * self.params.jitter
 
+        # Store the value of the prior at each prior sample
+        # TODO: should we store the value for each parameter independently?
         if return_logprobs:
+            ln_prior_val = _ln_prior_nonlinear(
+                self.params, samples['P'].to(u.day).value,
+                samples['e'].value,
+                samples['jitter'].to(self.params._jitter_unit).value)
             return samples, ln_prior_val
+
         else:
             return samples
 
     def _unpack_full_samples(self, result, prior_units, return_logprobs,
-                             t0=None):
+                             t0=None, instruments=None):
         """Unpack an array of The Joker samples into a dictionary-like object of
         Astropy Quantity objects (with units). This is meant to be used
         internally.
@@ -175,6 +256,10 @@ class TheJoker(object):
             Are we also returning the log prior values?
         t0 : `~astropy.time.Time` (optional)
             Passed to `thejoker.JokerSamples`.
+        instruments : iterable (optional)
+            The instrument labels of the data, if any. The samples contain a
+            velocity offset (and, if ``per_instrument_jitter`` is set, a
+            jitter) for each instrument except the first.
 
         Returns
         -------
@@ -188,17 +273,31 @@ class TheJoker(object):
         else:
             samples_arr = result
 
-        n, n_params = samples_arr.shape
-
-        samples = JokerSamples(t0=t0)
-
         # TODO: need to keep track of this elsewhere...
-        nonlin_params = ['P', 'M0', 'e', 'omega', 'jitter']
-        for k, key in enumerate(nonlin_params):
-            samples[key] = samples_arr[:, k] * prior_units[k]
-
-        samples['K'] = samples_arr[:, k + 1] * prior_units[-1]  # jitter unit
-        samples['v0'] = samples_arr[:, k + 2] * prior_units[-1]  # jitter unit
+        names = ['P', 'M0', 'e', 'omega', 'jitter', 'K']
+        units = list(prior_units[:5]) + [prior_units[-1]]  # jitter unit
+
+        # velocity trend terms: v0, v1, ...
+        for i in range(self.params.poly_trend):
+            names.append('v{0}'.format(i))
+            units.append(prior_units[-1] / u.day**i)
+
+        # instrument offsets relative to the first instrument
+        if instruments is not None:
+            for name in instruments[1:]:
+                names.append('dv0_{0}'.format(name))
+                units.append(prior_units[-1])
+
+            # jitter of the other instruments, if each has its own jitter
+            if self.params.per_instrument_jitter:
+                for name in instruments[1:]:
+                    names.append('jitter_{0}'.format(name))
+                    units.append(prior_units[-1])
+
+        # the columns of the samples array are in the same order, so the
+        # samples object can be created without copying each column
+        samples = JokerSamples.from_array(samples_arr[:, :len(names)], names,
+                                          units, t0=t0)
 
         if return_logprobs:
             return samples, ln_prior
@@ -207,21 +306,54 @@ class TheJoker(object):
             return samples
 
     def _rejection_sample_from_cache(self, data, n_prior_samples, cache_file,
-                                     start_idx, seed, return_logprobs=False):
+                                     start_idx, seed, return_logprobs=False,
+                                     time_budget=None, time0=None,
+                                     checkpoint_file=None,
+                                     likelihood_store=None):
         """Perform The Joker's rejection sampling on a cache file containing
         prior samples. This is meant to be used internally.
+
+        If ``time_budget`` is specified, the likelihood is computed over
+        successive batches of the prior samples until the time since
+        ``time0`` exceeds the budget, and the rejection step is done on the
+        batches processed so far. If ``checkpoint_file`` is specified, the
+        likelihood values are saved to (and resumed from) this file. If
+        ``likelihood_store`` is specified, likelihood values are read from the
+        store if present, and saved to it otherwise.
         """
 
-        # Get indices of good samples from the cache file
-        # TODO: I have some implementation questions about whether this should
-        #   return a boolean array (in which case I need to process all
-        #   likelihood values) or an array of integers...Right now,
-        #   _marginal_ll_worker has to return the values because we then compare
-        #   with the maximum value of the likelihood
-        marg_lls = compute_likelihoods(n_prior_samples, cache_file, start_idx,
-                                       data, self.params, pool=self.pool,
-                                       n_batches=self.n_batches)
-        good_samples_idx = get_good_sample_indices(marg_lls, seed=seed)
+        if time_budget is None:
+            # Get indices of good samples from the cache file
+            # TODO: I have some implementation questions about whether this
+            #   should return a boolean array (in which case I need to process
+            #   all likelihood values) or an array of integers...Right now,
+            #   _marginal_ll_worker has to return the values because we then
+            #   compare with the maximum value of the likelihood
+            marg_lls = None
+            if likelihood_store is not None:
+                key = likelihood_store.key(data, cache_file, n_prior_samples,
+                                           start_idx, self.params)
+                if key in likelihood_store:
+                    logger.debug("Reading likelihood values from store")
+                    marg_lls = likelihood_store.load(key)
+
+            if marg_lls is None:
+                marg_lls = compute_likelihoods(n_prior_samples, cache_file,
+                                               start_idx, data, self.params,
+                                               pool=self.pool,
+                                               n_batches=self.n_batches,
+                                               checkpoint_file=checkpoint_file)
+
+                if likelihood_store is not None:
+                    likelihood_store.save(key, marg_lls)
+
+            good_samples_idx = get_good_sample_indices(marg_lls, seed=seed)
+            n_processed = n_prior_samples
+
+        else:
+            good_samples_idx, n_processed = self._budgeted_rejection(
+                data, n_prior_samples, cache_file, start_idx, seed,
+                time_budget, time0)
 
         if len(good_samples_idx) == 0:
             logger.error("Failed to find any good samples!")
@@ -239,7 +371,52 @@ class TheJoker(object):
             good_samples_idx, cache_file, data, self.params,
             pool=self.pool, global_seed=seed, return_logprobs=return_logprobs)
 
-        return result
+        return result, n_processed
+
+    def _budgeted_rejection(self, data, n_prior_samples, cache_file,
+                            start_idx, seed, time_budget, time0):
+        """Rejection sample batches of prior samples until the time budget
+        runs out. The budget is checked between batches, and each batch after
+        the first is sized to use half of the remaining time. This is meant
+        to be used internally.
+        """
+        if self.n_batches is None:
+            n_batches = self.pool.size
+        else:
+            n_batches = self.n_batches
+
+        # The first batch is small and used to measure the throughput. After
+        # that, each batch is sized to use half of the remaining time.
+        n_batch = min(n_prior_samples, 1024 * max(n_batches, 1))
+
+        state = RejectionState(seed=seed)
+        while state.n_processed < n_prior_samples:
+            marg_lls = compute_likelihoods(n_batch, cache_file,
+                                           start_idx + state.n_processed,
+                                           data, self.params, pool=self.pool,
+                                           n_batches=n_batches)
+            state.update(marg_lls, start_idx + state.n_processed)
+
+            elapsed = time.time() - time0
+            remaining = time_budget - elapsed
+            if remaining <= 0:
+                break
+
+            # a batch can't be stopped partway, so stop here if there isn't
+            # time left for at least one sample per worker
+            rate = state.n_processed / elapsed
+            n_batch = int(0.5 * rate * remaining)
+            if n_batch < max(n_batches, 1):
+                break
+            n_batch = min(n_batch, n_prior_samples - state.n_processed)
+
+        if state.n_processed < n_prior_samples:
+            logger.info("Time budget of {0} seconds exhausted after {1} of "
+                        "{2} prior samples".format(time_budget,
+                                                   state.n_processed,
+                                                   n_prior_samples))
+
+        return state.good_samples_idx, state.n_processed
 
     def _validate_prior_cache(self, n_prior_samples, prior_cache_file):
         """Internal method used to either validate the prior cache file, or
@@ -268,7 +445,9 @@ class TheJoker(object):
 
     def rejection_sample(self, data, n_prior_samples=None,
                          prior_cache_file=None, return_logprobs=False,
-                         start_idx=0):
+                         start_idx=0, time_budget=None,
+                         max_likelihood_evals=None, checkpoint_file=None,
+                         likelihood_store=None):
         """Run The Joker's rejection sampling on prior samples to get posterior
         samples for the input data.
 
@@ -276,6 +455,15 @@ class TheJoker(object):
         use for rejection sampling, ``n_prior_samples``, or the path to a file
         containing prior samples, ``prior_cache_file``.
 
+        The number of prior samples that were actually processed is stored in
+        the ``meta`` dictionary of the returned samples object, along with the
+        number of prior samples available and the time spent. This is useful
+        when ``time_budget`` or ``max_likelihood_evals`` are specified: the
+        samples returned are then a posterior sampling given only the prior
+        samples that were processed. Without a ``prior_cache_file``, only as
+        many prior samples as can be evaluated are generated, so the number
+        available is at most ``max_likelihood_evals``.
+
         Parameters
         ----------
         data : `~thejoker.data.RVData`
@@ -292,14 +480,49 @@ class TheJoker(object):
             Also return the log-probabilities.
         start_idx : int (optional)
             Index to start reading from in the prior cache file.
+        time_budget : numeric (optional)
+            A wall-clock time limit in seconds. If specified, the prior samples
+            are processed in batches until the time budget is used, and the
+            posterior samples are generated from the batches processed so far.
+            The budget is only checked between batches: a batch is never
+            stopped partway through. The first batch has 1024 prior samples
+            per worker and is used to measure the throughput. Each later batch
+            is sized to use half of the remaining time, and the pass stops
+            when there is no time left for another batch. The total run time
+            can therefore only exceed the budget by the time of the first
+            batch, or if the throughput drops.
+        max_likelihood_evals : int (optional)
+            The maximum number of prior samples to compute the likelihood for.
+        checkpoint_file : str (optional)
+            Path to an HDF5 file to save the likelihood values to as they are
+            computed. If the run is interrupted, re-running with the same
+            prior cache file, data, parameters, and random state skips the
+            batches of prior samples that were already completed. See
+            `~thejoker.sampler.multiproc_helpers.compute_likelihoods` for more
+            information. Note that if ``prior_cache_file`` is not specified,
+            the prior samples are regenerated on each run, so the random state
+            must be seeded for the checkpoint to be re-used. Cannot be
+            combined with ``time_budget``.
+        likelihood_store : `~thejoker.sampler.io.LikelihoodStore` (optional)
+            A store to save the marginal likelihood values to, or to read them
+            from if they were already computed for this data and these prior
+            samples. Stored likelihood values can be used with
+            `~thejoker.sampler.TheJoker.reweight` to change the prior without
+            re-computing the likelihood. Not used with ``time_budget``.
 
         """
 
+        time0 = time.time()
+
         # validate input data
         if not isinstance(data, RVData):
             raise TypeError("Input data must be an RVData instance, not '{0}'"
                             .format(type(data)))
 
+        if checkpoint_file is not None and time_budget is not None:
+            raise ValueError("A checkpoint file can't be used with a time "
+                             "budget.")
+
         # compute full parameter vectors for all good samples
         if self._rnd_passed:
             seed = self.random_state.randint(np.random.randint(2**16))
@@ -308,16 +531,25 @@ class TheJoker(object):
 
         n_prior_samples, cache_exists = self._validate_prior_cache(
             n_prior_samples, prior_cache_file)
+        n_available = n_prior_samples
+
+        if max_likelihood_evals is not None:
+            n_prior_samples = min(n_prior_samples, int(max_likelihood_evals))
 
         if cache_exists:
             with h5py.File(prior_cache_file) as f:
                 prior_units = [u.Unit(uu) for uu in f.attrs['units']]
 
-            result = self._rejection_sample_from_cache(
+            result, n_processed = self._rejection_sample_from_cache(
                 data, n_prior_samples, prior_cache_file, start_idx, seed=seed,
-                return_logprobs=return_logprobs)
+                return_logprobs=return_logprobs, time_budget=time_budget,
+                time0=time0, checkpoint_file=checkpoint_file,
+                likelihood_store=likelihood_store)
 
         else:
+            # only the prior samples that can be evaluated are generated
+            n_available = n_prior_samples
+
             with tempfile.NamedTemporaryFile(mode='r+') as f:
                 prior_cache_file = f.name
 
@@ -327,26 +559,69 @@ class TheJoker(object):
                                                  prior_samples,
                                                  data.rv.unit)
 
-                result = self._rejection_sample_from_cache(
+                result, n_processed = self._rejection_sample_from_cache(
                     data, n_prior_samples, prior_cache_file, start_idx,
-                    seed=seed, return_logprobs=return_logprobs)
+                    seed=seed, return_logprobs=return_logprobs,
+                    time_budget=time_budget, time0=time0,
+                    checkpoint_file=checkpoint_file,
+                    likelihood_store=likelihood_store)
 
-        return self._unpack_full_samples(result, prior_units, t0=data.t0,
-                                         return_logprobs=return_logprobs)
+        out = self._unpack_full_samples(result, prior_units, t0=data.t0,
+                                        instruments=data.instruments,
+                                        return_logprobs=return_logprobs)
+
+        if return_logprobs:
+            samples = out[0]
+        else:
+            samples = out
+
+        samples.meta['n_prior_samples_processed'] = n_processed
+        samples.meta['n_prior_samples'] = n_available
+        samples.meta['time_elapsed'] = time.time() - time0
+
+        return out
 
     def iterative_rejection_sample(self, data, n_requested_samples,
                                    prior_cache_file=None, n_prior_samples=None,
-                                   return_logprobs=False, magic_fudge=128):
-        """TODO: docstring For now: prior_cache_file is required
+                                   return_logprobs=False, magic_fudge=128,
+                                   state=None):
+        """Run The Joker's rejection sampling on prior samples in batches,
+        stopping as soon as ``n_requested_samples`` posterior samples have been
+        found.
+
+        The likelihood is computed over successive batches of the prior samples
+        and the rejection step is done incrementally (see
+        `~thejoker.sampler.multiproc_helpers.RejectionState`), so each prior
+        sample is only processed once. The size of each batch is estimated
+        from the acceptance rate so far, so that the pass over the prior
+        samples stops soon after the requested number of samples is reached.
+        If the prior samples are exhausted before that, all samples that pass
+        the rejection step are returned.
 
         Parameters
         ----------
         data : `~thejoker.RVData`
+            The radial velocity data.
         n_requested_samples : int
-        prior_cache_file : str
+            The number of posterior samples to generate.
+        prior_cache_file : str (optional)
+            A path to an HDF5 cache file containing prior samples.
         n_prior_samples : int (optional)
+            If ``prior_cache_file`` is not specified, this sets the number of
+            prior samples to generate. If ``prior_cache_file`` is specified,
+            this sets the maximum number of prior samples to load from the
+            cache file.
         return_logprobs : bool (optional)
+            Also return the log-probabilities.
         magic_fudge : int (optional)
+            Sets the size of the first batch, ``magic_fudge *
+            n_requested_samples``, used before there is an estimate of the
+            acceptance rate.
+        state : `~thejoker.sampler.multiproc_helpers.RejectionState` (optional)
+            The rejection state of a previous call with the same data and
+            ``prior_cache_file``, e.g., with fewer ``n_prior_samples``. The
+            prior samples it has already processed are skipped, and the state
+            is updated in place. Requires ``prior_cache_file``.
         """
 
         # validate input data
@@ -360,25 +635,17 @@ class TheJoker(object):
         else:
             seed = None
 
-        # HACK: must start from 0
-        start_idx = 0
-
         n_prior_samples, cache_exists = self._validate_prior_cache(
             n_prior_samples, prior_cache_file)
 
-        # There are some magic numbers below used to control how fast the
-        # iterative batches grow in size
-        safety_factor = 2  # MAGIC NUMBER
-        n_process = magic_fudge * n_requested_samples  # MAGIC NUMBER
-
-        if n_process > n_prior_samples:
-            raise ValueError("Prior sample library not big enough! For "
-                             "iterative sampling, you have to have at least "
-                             "magic_fudge * n_requested_samples samples in the "
-                             "prior samples cache file. You have {0}"
-                             .format(n_prior_samples))
+        if state is not None and not cache_exists:
+            raise ValueError("A rejection state can only be continued when "
+                             "reading prior samples from a cache file.")
 
-        all_marg_lls = np.array([])
+        if self.n_batches is None:
+            n_batches = self.pool.size
+        else:
+            n_batches = self.n_batches
 
         # TODO: it's a little...unclean to always make a tempfile
 
@@ -395,74 +662,535 @@ class TheJoker(object):
                 prior_units = save_prior_samples(f.name, prior_samples,
                                                  data.rv.unit)
 
-            maxiter = 128
-            for i in range(maxiter):  # we just need to iterate for a long time
-                logger.log(1, "The Joker iteration {0}, computing {1} "
-                           "likelihoods".format(i, n_process))
+            if state is None:
+                state = RejectionState(seed=seed)
+
+            # continue after the prior samples already processed
+            start_idx = state.n_processed
+            n_process = min(magic_fudge * n_requested_samples,
+                            n_prior_samples - start_idx)
+
+            while n_process > 0:
+                logger.log(1, "The Joker: computing {0} likelihoods starting "
+                           "at index {1}".format(n_process, start_idx))
                 marg_lls = compute_likelihoods(n_process, prior_cache_file,
                                                start_idx, data, self.params,
                                                pool=self.pool,
-                                               n_batches=self.n_batches)
-
-                all_marg_lls = np.concatenate((all_marg_lls, marg_lls))
-
-                good_samples_idx = get_good_sample_indices(all_marg_lls,
-                                                           seed=seed)
-
-                if len(good_samples_idx) == 0:
-                    # self.pool.close()
-                    raise RuntimeError("Failed to find any good samples!")
+                                               n_batches=n_batches)
+                n_good = state.update(marg_lls, start_idx)
+                start_idx += n_process
 
-                n_good = len(good_samples_idx)
                 logger.log(1, "{0} good samples after rejection sampling"
                            .format(n_good))
 
-                if len(good_samples_idx) >= n_requested_samples:
-                    logger.debug("Enough samples found! {0}"
-                                 .format(len(good_samples_idx)))
+                if n_good >= n_requested_samples:
+                    logger.debug("Enough samples found! {0}".format(n_good))
                     break
 
-                start_idx += n_process
-
-                n_ll_evals = len(all_marg_lls)
+                # Estimate the number of likelihood evaluations still needed
+                # from the acceptance rate so far
                 n_need = n_requested_samples - n_good
-                n_process = int(safety_factor * n_need / n_good * n_ll_evals)
+                if n_good > 0:
+                    n_process = int(np.ceil(n_need * state.n_processed /
+                                            n_good))
+                else:
+                    n_process = state.n_processed
+                n_process = max(n_process, n_batches)
+                n_process = min(n_process, n_prior_samples - start_idx)
+
+            else:
+                logger.warning("Prior samples exhausted after {0} likelihood "
+                               "evaluations: only {1} of the {2} requested "
+                               "samples were found."
+                               .format(state.n_processed, len(state),
+                                       n_requested_samples))
 
-                if start_idx + n_process > n_prior_samples:
-                    n_process = n_prior_samples - start_idx
+            if len(state) == 0:
+                raise RuntimeError("Failed to find any good samples!")
 
-                if n_process <= 0:
-                    break
+            result = sample_indices_to_full_samples(
+                state.good_samples_idx, prior_cache_file, data, self.params,
+                pool=self.pool, global_seed=seed,
+                return_logprobs=return_logprobs)
+
+        return self._unpack_full_samples(result, prior_units, t0=data.t0,
+                                         instruments=data.instruments,
+                                         return_logprobs=return_logprobs)
+
+    def reservoir_sample(self, data, n_samples, n_prior_samples=None,
+                         prior_cache_file=None, return_logprobs=False,
+                         start_idx=0):
+        """Generate exactly ``n_samples`` posterior samples for the input data
+        in a single pass over the prior samples.
+
+        Instead of rejection sampling, which returns a random number of
+        samples, this uses weighted reservoir sampling (the Gumbel-max trick
+        applied to the marginal log-likelihood values) to draw ``n_samples``
+        prior samples, without replacement, with probability proportional to
+        their marginal likelihood. Memory use scales with ``n_samples``, not
+        with the number of prior samples. See
+        `~thejoker.sampler.multiproc_helpers.reservoir_sample_indices` for
+        more information.
+
+        You must either specify the number of prior samples to generate and
+        use, ``n_prior_samples``, or the path to a file containing prior
+        samples, ``prior_cache_file``.
+
+        Parameters
+        ----------
+        data : `~thejoker.data.RVData`
+            The radial velocity.
+        n_samples : int
+            The number of posterior samples to return.
+        n_prior_samples : int (optional)
+            If ``prior_cache_file`` is not specified, this sets the number of
+            prior samples to generate and use. If ``prior_cache_file`` is
+            specified, this sets the number of prior samples to load from the
+            cache file.
+        prior_cache_file : str (optional)
+            A path to an HDF5 cache file containing prior samples.
+        return_logprobs : bool (optional)
+            Also return the log-probabilities.
+        start_idx : int (optional)
+            Index to start reading from in the prior cache file.
+
+        """
+
+        # validate input data
+        if not isinstance(data, RVData):
+            raise TypeError("Input data must be an RVData instance, not '{0}'"
+                            .format(type(data)))
+
+        if self._rnd_passed:
+            seed = self.random_state.randint(np.random.randint(2**16))
+        else:
+            seed = None
+
+        n_prior_samples, cache_exists = self._validate_prior_cache(
+            n_prior_samples, prior_cache_file)
+
+        with tempfile.NamedTemporaryFile(mode='r+') as f:
+            if cache_exists:
+                with h5py.File(prior_cache_file, 'r') as g:
+                    prior_units = [u.Unit(uu) for uu in g.attrs['units']]
 
             else:
-                # We should never get here!!
-                raise RuntimeError("Hit maximum number of iterations!")
+                prior_cache_file = f.name
+
+                # first do prior sampling, cache to temporary file
+                prior_samples, ln_prior = self.sample_prior(
+                    size=n_prior_samples, return_logprobs=True)
+                prior_units = save_prior_samples(prior_cache_file,
+                                                 prior_samples,
+                                                 data.rv.unit,
+                                                 ln_prior_probs=ln_prior)
+
+            samples_idx, n_eff = reservoir_sample_indices(
+                n_samples, n_prior_samples, prior_cache_file, start_idx, data,
+                self.params, pool=self.pool, global_seed=seed,
+                n_batches=self.n_batches)
+            logger.debug("Effective number of prior samples: {0:.1f}"
+                         .format(n_eff))
 
             result = sample_indices_to_full_samples(
-                good_samples_idx, prior_cache_file, data, self.params,
+                samples_idx, prior_cache_file, data, self.params,
                 pool=self.pool, global_seed=seed,
                 return_logprobs=return_logprobs)
 
         return self._unpack_full_samples(result, prior_units, t0=data.t0,
+                                         instruments=data.instruments,
                                          return_logprobs=return_logprobs)
 
+    def reweight(self, data, likelihood_store, prior_cache_file,
+                 new_params=None, ln_prior_ratio=None, n_prior_samples=None,
+                 start_idx=0):
+        """Generate posterior samples under a different prior, using
+        marginal likelihood values that were previously computed and saved to
+        a `~thejoker.sampler.io.LikelihoodStore`.
+
+        The prior samples in the cache file are assumed to be drawn from the
+        prior defined by the parameters of this instance, ``self.params``.
+        Each prior sample is weighted by the ratio of the new prior to this
+        prior, and the rejection step is done on the likelihood times this
+        weight, so the Kepler solver is never called for the rejected samples.
+        The new prior must be contained in the support of the original prior.
+
+        Parameters
+        ----------
+        data : `~thejoker.data.RVData`
+            The radial velocity data.
+        likelihood_store : `~thejoker.sampler.io.LikelihoodStore`
+            The store containing the marginal likelihood values. These are
+            saved by running `~thejoker.sampler.TheJoker.rejection_sample` with
+            the same data, prior cache file, and ``likelihood_store``.
+        prior_cache_file : str
+            A path to an HDF5 cache file containing prior samples.
+        new_params : `~thejoker.sampler.params.JokerParams` (optional)
+            The parameter specification that defines the new prior. The
+            period range may be narrower, and the parameters of the jitter
+            prior may be different, but a fixed jitter value must be the same.
+        ln_prior_ratio : callable (optional)
+            A function that accepts a 2D array of prior samples (as stored in
+            the prior cache file) and returns the log of the ratio of the new
+            prior to the original prior for each sample. This can be used for
+            changes to the prior that can't be specified with a
+            `~thejoker.sampler.params.JokerParams` instance, e.g., in
+            eccentricity. Combined with ``new_params`` if both are specified.
+        n_prior_samples : int (optional)
+            The number of prior samples to load from the cache file.
+        start_idx : int (optional)
+            Index to start reading from in the prior cache file.
+
+        Returns
+        -------
+        samples : `~thejoker.sampler.samples.JokerSamples`
+        """
+
+        # validate input data
+        if not isinstance(data, RVData):
+            raise TypeError("Input data must be an RVData instance, not '{0}'"
+                            .format(type(data)))
+
+        if new_params is None and ln_prior_ratio is None:
+            raise ValueError("You must specify either new parameters or a "
+                             "function to compute the ratio of priors.")
+
+        if new_params is not None:
+            if not isinstance(new_params, JokerParams):
+                raise TypeError("Parameter specification must be a "
+                                "JokerParams instance, not a '{0}'"
+                                .format(type(new_params)))
+
+            if (new_params._fixed_jitter != self.params._fixed_jitter or
+                    (new_params._fixed_jitter and
+                     new_params.jitter != self.params.jitter)):
+                raise ValueError("The jitter must either be sampled in both "
+                                 "parameter specifications, or fixed to the "
+                                 "same value: the marginal likelihood depends "
+                                 "on a fixed jitter value.")
+
+            if (new_params.jitter_grid != self.params.jitter_grid or
+                    (self.params.jitter_grid is not None and
+                     tuple(new_params.jitter) != tuple(self.params.jitter))):
+                raise ValueError("The jitter prior can't be changed when the "
+                                 "marginal likelihood is computed on a jitter "
+                                 "grid: it is integrated over the jitter "
+                                 "prior.")
+
+            if (new_params.P_min < self.params.P_min or
+                    new_params.P_max > self.params.P_max):
+                raise ValueError("The new period range must be contained in "
+                                 "the period range of the prior samples.")
+
+        if self._rnd_passed:
+            seed = self.random_state.randint(np.random.randint(2**16))
+        else:
+            seed = None
+
+        n_prior_samples, _ = self._validate_prior_cache(n_prior_samples,
+                                                        prior_cache_file)
+
+        key = likelihood_store.key(data, prior_cache_file, n_prior_samples,
+                                   start_idx, self.params)
+        if key not in likelihood_store:
+            raise ValueError("No marginal likelihood values for these data and "
+                             "prior samples in the likelihood store. Run "
+                             "rejection_sample() with the likelihood store "
+                             "first.")
+
+        with h5py.File(prior_cache_file, 'r') as f:
+            prior_units = [u.Unit(uu) for uu in f.attrs['units']]
+
+        # read the prior samples and likelihood values in batches to limit
+        # the memory usage for large prior caches
+        batch_size = 2**20
+        state = RejectionState(seed=seed)
+        for i1 in range(0, n_prior_samples, batch_size):
+            i2 = min(i1 + batch_size, n_prior_samples)
+
+            with h5py.File(prior_cache_file, 'r') as f:
+                chunk = _pad_prior_samples(
+                    f, f['samples'][start_idx+i1:start_idx+i2])
+            marg_ll = likelihood_store.load(key, i1, i2)
+
+            ln_w = np.zeros(len(chunk))
+            if new_params is not None:
+                P = (chunk[:, 0] * prior_units[0]).to(u.day).value
+                e = chunk[:, 2]
+                s = chunk[:, 4] * prior_units[4]
+
+                ln_w += _ln_prior_nonlinear(
+                    new_params, P, e, s.to(new_params._jitter_unit).value)
+                ln_w -= _ln_prior_nonlinear(
+                    self.params, P, e, s.to(self.params._jitter_unit).value)
+
+                outside = ((P < new_params.P_min.to(u.day).value) |
+                           (P > new_params.P_max.to(u.day).value))
+                ln_w[outside] = -np.inf
+
+            if ln_prior_ratio is not None:
+                ln_w += ln_prior_ratio(chunk)
+
+            state.update(marg_ll + ln_w, start_idx + i1)
+
+        if len(state) == 0:
+            raise RuntimeError("Failed to find any good samples!")
+
+        n_good = len(state)
+        s_or_not = 's' if n_good > 1 else ''
+        logger.info("{0} good sample{1} after rejection sampling"
+                    .format(n_good, s_or_not))
+
+        result = sample_indices_to_full_samples(
+            state.good_samples_idx, prior_cache_file, data, self.params,
+            pool=self.pool, global_seed=seed, n_batches=self.n_batches)
+
+        return self._unpack_full_samples(result, prior_units, t0=data.t0,
+                                         instruments=data.instruments,
+                                         return_logprobs=False)
+
     # ========================================================================
     # MCMC
 
+    def _init_walkers(self, model, samples0, n_walkers, ball_scale,
+                      optimize=False):
+        """Generate initial MCMC walker positions by resampling the input
+        samples. This is meant to be used internally.
+
+        Parameters
+        ----------
+        model : `~thejoker.TheJokerMCMCModel`
+            Or a `~thejoker.TheJokerMarginalMCMCModel`.
+        samples0 : `~thejoker.JokerSamples`
+        n_walkers : int
+        ball_scale : float
+        optimize : bool (optional)
+
+        Returns
+        -------
+        p0 : `numpy.ndarray`
+            The initial walker positions in the MCMC parametrization, with
+            shape ``(n_walkers, n_dim)``.
+        """
+        rnd = self.random_state
+
+        p = np.atleast_2d(model.pack_samples_mcmc(samples0))
+
+        # a sample with zero jitter maps to ln(s^2) = -inf: start these
+        # walkers at a small jitter instead
+        p[~np.isfinite(p)] = np.log(ball_scale**2)
+
+        if optimize:
+            p = np.unique(p, axis=0)
+            for i in range(len(p)):
+                p[i] = self._optimize_mcmc_params(model, p[i])
+
+        idx = rnd.randint(len(p), size=n_walkers)
+        p0 = p[idx] + rnd.normal(0, ball_scale, size=(n_walkers, p.shape[1]))
+
+        return p0
+
+    def _optimize_mcmc_params(self, model, x0):
+        """Maximize the posterior probability starting from the MCMC
+        parameters ``x0``, using the analytic gradient if the model provides
+        it. Returns ``x0`` if the optimization does not improve on it. This is
+        meant to be used internally.
+        """
+        ln_post0 = model.ln_posterior(x0)
+        if not np.isfinite(ln_post0):
+            return x0
+
+        if hasattr(model, 'ln_posterior_and_grad'):
+            def neg_ln_post(x):
+                lnp, grad = model.ln_posterior_and_grad(x)
+                if not np.isfinite(lnp):
+                    return np.inf, np.zeros_like(x)
+                return -lnp, -grad
+
+            res = minimize(neg_ln_post, x0, jac=True, method='L-BFGS-B')
+
+        else:
+            def neg_ln_post(x):
+                lnp = model.ln_posterior(x)
+                return -lnp if np.isfinite(lnp) else np.inf
+
+            res = minimize(neg_ln_post, x0, method='Powell')
+
+        x = np.atleast_1d(res.x)
+        ln_post = model.ln_posterior(x)
+        if not np.isfinite(ln_post) or ln_post < ln_post0:
+            logger.debug('Optimization did not improve the initial MCMC '
+                         'position: {0}'.format(res.message))
+            return x0
+
+        return x
+
+    def _run_emcee_with_store(self, sampler, p0, n_burn, n_steps, store,
+                              state, key):
+        """Run burn-in and sampling with an ``emcee`` ensemble sampler in
+        chunks, saving the state and chains to a
+        `~thejoker.sampler.MCMCChainStore` after each chunk. This is meant to
+        be used internally.
+
+        Returns
+        -------
+        n_sampled : int
+            The number of sampling (not burn-in) steps run in this call.
+        """
+        if state is None:
+            store.initialize(p0.shape[0], p0.shape[1], key=key)
+            n_burned, n_done = 0, 0
+        else:
+            n_burned, n_done = state['n_burn'], state['n_steps']
+
+        pos = p0
+        if n_done == 0 and n_burned < n_burn:
+            logger.debug('Burning in MCMC for {0} steps...'
+                         .format(n_burn - n_burned))
+            time0 = time.time()
+            while n_burned < n_burn:
+                n = min(store.save_interval, n_burn - n_burned)
+                pos, ln_prob, *_ = sampler.run_mcmc(pos, n)
+                n_burned += n
+
+                sampler.reset()
+                store.update(pos, ln_prob, n_burned, 0)
+            logger.debug('...time spent burn-in: {0}'
+                         .format(time.time()-time0))
+
+        n_sampled = 0
+        logger.debug('Running MCMC for {0} steps...'
+                     .format(max(n_steps - n_done, 0)))
+        time0 = time.time()
+        while n_done < n_steps:
+            n = min(store.save_interval, n_steps - n_done)
+            pos, ln_prob, *_ = sampler.run_mcmc(pos, n)
+            n_done += n
+            n_sampled += n
+
+            store.update(pos, ln_prob, n_burned, n_done,
+                         chain=sampler.chain[:, -n:],
+                         chain_ln_prob=sampler.lnprobability[:, -n:])
+        logger.debug('...time spent sampling: {0}'.format(time.time()-time0))
+
+        return n_sampled
+
+    def _run_emcee_to_convergence(self, sampler, p0, n_burn, n_steps,
+                                  target_n_eff, check_interval, max_r_hat):
+        """Run burn-in and sampling with an ``emcee`` ensemble sampler in
+        chunks of ``check_interval`` steps, stopping each phase early once
+        the convergence criteria described in `TheJoker.mcmc_sample` are met.
+        This is meant to be used internally.
+
+        Returns
+        -------
+        chain : `numpy.ndarray`
+            The thinned samples from all walkers, with shape ``(n, n_dim)``.
+        diagnostics : dict
+        """
+        n_walkers = p0.shape[0]
+        check_interval = int(check_interval)
+        if check_interval < 1:
+            raise ValueError("check_interval must be a positive integer.")
+
+        time0 = time.time()
+        pos = p0
+        n_burned = 0
+        burn_converged = n_burn == 0
+        while n_burned < n_burn:
+            n = min(check_interval, n_burn - n_burned)
+            pos, *_ = sampler.run_mcmc(pos, n)
+            n_burned += n
+
+            # only use the second half of the burn-in to assess stationarity
+            half = sampler.chain[:, n_burned//2:]
+            if half.shape[1] < 4:
+                continue
+
+            r_hat = gelman_rubin(half)
+            tau = autocorr_time(half)
+            logger.debug('Burn-in step {0}: max. R-hat = {1:.3f}, max. '
+                         'autocorrelation time = {2:.1f}'
+                         .format(n_burned, np.max(r_hat), np.max(tau)))
+            if np.all(r_hat < max_r_hat) and n_burned > 20 * np.max(tau):
+                burn_converged = True
+                break
+
+        if not burn_converged:
+            logger.warning('MCMC burn-in did not converge within {0} steps.'
+                           .format(n_burn))
+        logger.debug('...time spent burn-in: {0}'.format(time.time()-time0))
+        sampler.reset()
+
+        time0 = time.time()
+        n_done = 0
+        converged = False
+        while n_done < n_steps:
+            n = min(check_interval, n_steps - n_done)
+            pos, *_ = sampler.run_mcmc(pos, n)
+            n_done += n
+
+            tau_max = np.max(autocorr_time(sampler.chain))
+            n_eff = n_walkers * n_done / max(tau_max, 1.)
+            logger.debug('Sampling step {0}: max. autocorrelation time = '
+                         '{1:.1f}, effective sample size = {2:.0f}'
+                         .format(n_done, tau_max, n_eff))
+
+            # the estimate of the autocorrelation time is only reliable for
+            # chains that are much longer than it
+            if n_eff >= target_n_eff and n_done > 20 * tau_max:
+                converged = True
+                break
+
+        if not converged:
+            logger.warning('MCMC did not reach the target effective sample '
+                           'size ({0}) within {1} steps.'
+                           .format(target_n_eff, n_steps))
+        logger.debug('...time spent sampling: {0}'.format(time.time()-time0))
+
+        full_chain = sampler.chain
+        tau = autocorr_time(full_chain)
+        if full_chain.shape[1] >= 4:
+            r_hat = gelman_rubin(full_chain)
+        else:
+            r_hat = np.full(full_chain.shape[2], np.nan)
+
+        # thin by the autocorrelation time, keeping the final positions
+        thin = max(1, int(np.ceil(np.max(tau))))
+        chain = full_chain[:, ::-1][:, ::thin][:, ::-1]
+        chain = chain.reshape(-1, chain.shape[-1])
+
+        diagnostics = dict()
+        diagnostics['n_burn'] = n_burned
+        diagnostics['n_steps'] = n_done
+        diagnostics['burn_in_converged'] = burn_converged
+        diagnostics['converged'] = converged
+        diagnostics['autocorr_time'] = tau
+        diagnostics['r_hat'] = r_hat
+        diagnostics['n_eff'] = n_walkers * n_done / max(np.max(tau), 1.)
+        diagnostics['thin'] = thin
+
+        return chain, diagnostics
+
     def mcmc_sample(self, data, samples0, n_steps=1024,
                     n_walkers=256, n_burn=8192, return_sampler=False,
-                    ball_scale=1E-5):
-        """Run standard MCMC (using `emcee <http://emcee.readthedocs.io/>`_) to
-        generate posterior samples in orbital parameters.
+                    ball_scale=1E-5, vectorize=True, marginal=False,
+                    method='emcee', target_n_eff=None, check_interval=128,
+                    max_r_hat=1.01, optimize=False, chain_store=None,
+                    return_chain=False):
+        """Run standard MCMC (using `emcee <http://emcee.readthedocs.io/>`_, or
+        Hamiltonian Monte Carlo) to generate posterior samples in orbital
+        parameters.
 
         Parameters
         ----------
         data : `~thejoker.RVData`
             The data to fit orbits to.
         samples0 : `~thejoker.JokerSamples`
-            This can either be (a) a single sample to use as initial conditions
-            for the MCMC walkers, or (b) a set of samples, in which case the
-            mean of the samples will be used as initial conditions.
+            The samples used to initialize the MCMC walkers, e.g., the output
+            from rejection sampling. The initial walker positions are drawn
+            from these samples (with replacement), so the walkers start spread
+            over the posterior. This can also be a single sample.
         n_steps : int
             The number of MCMC steps to run for.
         n_walkers : int (optional)
@@ -471,74 +1199,341 @@ class TheJoker(object):
             If specified, the number of steps to burn in for.
         return_sampler : bool (optional)
             Also return the sampler object.
+        ball_scale : float (optional)
+            The standard deviation of the Gaussian scatter added to the initial
+            walker positions (in the MCMC parametrization), which ensures that
+            walkers drawn from the same sample are distinct.
+        vectorize : bool (optional)
+            Evaluate the posterior for all walkers in one call (using
+            ``emcee``'s ``vectorize`` option), which avoids the per-walker
+            Python overhead. The processing pool is not used in this case.
+            Set to False to instead evaluate the walkers one at a time,
+            mapped over the pool.
+        marginal : bool (optional)
+            Only sample over the nonlinear parameters, with the linear
+            parameters marginalized over analytically (see
+            `~thejoker.sampler.TheJokerMarginalMCMCModel`). The linear
+            parameters are then drawn from their conditional posterior for
+            each returned sample. The lower dimensionality means that many
+            fewer burn-in steps are usually needed.
+        method : str (optional)
+            The MCMC engine: ``'emcee'`` for the ``emcee`` ensemble sampler,
+            or ``'hmc'`` for Hamiltonian Monte Carlo (see
+            `~thejoker.sampler.HMCSampler`), which uses the analytic
+            gradient of the posterior. With ``'hmc'``, a single chain is run
+            from the initial conditions and all ``n_steps`` samples after
+            burn-in are returned (``n_walkers`` and ``vectorize`` are
+            ignored). This is not supported with ``marginal=True``.
+        target_n_eff : int (optional)
+            If specified, run until the chains have converged instead of for
+            a fixed number of steps: ``n_burn`` and ``n_steps`` are then the
+            maximum numbers of steps. Every ``check_interval`` steps, the
+            integrated autocorrelation time and the split Gelman-Rubin
+            statistic (R-hat) are computed. Burn-in stops once R-hat of the
+            second half of the burn-in chain is below ``max_r_hat`` for all
+            parameters and the burn-in is longer than 20 autocorrelation
+            times. Sampling stops once the effective sample size reaches
+            ``target_n_eff`` and the chain is longer than 20 autocorrelation
+            times. The returned samples are then the full chain of all
+            walkers, thinned by the autocorrelation time, instead of the
+            final walker positions, and the diagnostics are stored in the
+            ``meta`` dictionary of the samples. Only supported with
+            ``method='emcee'``.
+        check_interval : int (optional)
+            The number of steps between convergence checks, used with
+            ``target_n_eff``.
+        max_r_hat : float (optional)
+            The R-hat threshold for the end of burn-in, used with
+            ``target_n_eff``.
+        optimize : bool (optional)
+            Before initializing the walkers, move each distinct input sample
+            to the nearby maximum of the posterior probability with
+            `scipy.optimize.minimize`. This is useful when rejection sampling
+            returns only one or a few samples, which are then not
+            representative of the (narrow) posterior.
+        chain_store : `~thejoker.sampler.MCMCChainStore` (optional)
+            Save the walker positions, and append the (thinned) chains, to an
+            HDF5 file while sampling. If the store already contains the state
+            of a run with the same data, model, and number of walkers, that
+            run is resumed: the walkers start from the stored positions and
+            only the remaining burn-in and sampling steps (of ``n_burn`` and
+            ``n_steps`` in total) are run. Only supported with
+            ``method='emcee'`` and without ``target_n_eff``.
+        return_chain : bool (optional)
+            Return the samples from every step of every walker (thinned by
+            the ``chain_store``, if specified) instead of only the final walker
+            positions. The chains of all walkers are concatenated.
 
         Returns
         -------
         model : `~thejoker.TheJokerMCMCModel`
+            Or a `~thejoker.TheJokerMarginalMCMCModel` if ``marginal=True``.
         samples : `~thejoker.JokerSamples`
             The posterior samples.
-        sampler : `emcee.EnsembleSampler`
+        sampler : `emcee.EnsembleSampler`, `~thejoker.sampler.HMCSampler`
             If ``return_sampler == True``.
         """
-        import emcee
+        if method not in ['emcee', 'hmc']:
+            raise ValueError("Invalid MCMC method '{0}': must be 'emcee' or "
+                             "'hmc'.".format(method))
 
-        if not isinstance(samples0, JokerSamples):
-            raise TypeError('Input samples initial position must be ')
+        if method == 'hmc' and marginal:
+            raise ValueError("Gradients of the marginal posterior are not "
+                             "implemented: use method='emcee' with "
+                             "marginal=True.")
 
-        model = TheJokerMCMCModel(joker_params=self.params, data=data)
+        if method == 'hmc' and target_n_eff is not None:
+            raise ValueError("Convergence monitoring (target_n_eff) is only "
+                             "supported with method='emcee'.")
 
-        if len(samples0) > 1:
-            samples0 = samples0.mean()
+        if chain_store is not None and (method == 'hmc' or
+                                        target_n_eff is not None):
+            raise ValueError("A chain store is only supported with "
+                             "method='emcee' and without target_n_eff.")
 
-        p0_mean = np.squeeze(model.pack_samples(samples0))
+        if not isinstance(samples0, JokerSamples):
+            raise TypeError('Input samples initial position must be ')
 
-        # P, M0, e, omega, jitter, K, v0
-        p0 = np.zeros((n_walkers, len(p0_mean)))
-        for i in range(p0.shape[1]):
-            if i in [2, 4]: # eccentricity, jitter
-                p0[:, i] = np.abs(np.random.normal(p0_mean[i], ball_scale,
-                                                   size=n_walkers))
+        if marginal:
+            model = TheJokerMarginalMCMCModel(joker_params=self.params,
+                                              data=data)
+        else:
+            model = TheJokerMCMCModel(joker_params=self.params, data=data)
+
+        state = None
+        if chain_store is not None:
+            store_key = '{0}-{1}-{2}'.format(
+                _data_fingerprint(data),
+                _likelihood_params_fingerprint(self.params),
+                model.__class__.__name__)
+            state = chain_store.load_state()
+
+        if state is not None:
+            if (state['key'] != store_key or
+                    state['position'].shape[0] != n_walkers):
+                raise ValueError("The chain store '{0}' contains a run with "
+                                 "different data, parameters, or number of "
+                                 "walkers: use a different file or path to "
+                                 "start a new run."
+                                 .format(chain_store.filename))
+
+            logger.debug('Resuming MCMC after {0} burn-in and {1} steps'
+                         .format(state['n_burn'], state['n_steps']))
+            p0 = state['position']
 
-            else:
-                p0[:, i] = np.random.normal(p0_mean[i], ball_scale,
-                                            size=n_walkers)
+        else:
+            p0 = self._init_walkers(model, samples0, n_walkers,
+                                    ball_scale=ball_scale, optimize=optimize)
+        n_dim = p0.shape[1]
 
-        p0 = model.to_mcmc_params(p0.T).T
+        if method == 'hmc':
+            sampler = HMCSampler(model.ln_posterior_and_grad, n_dim,
+                                 random_state=self.random_state)
 
-        # Because jitter is always carried through in the transform above, now
-        # we have to remove the jitter parameter if it's fixed!
-        if self.params._fixed_jitter:
-            p0 = np.delete(p0, 5, axis=1)
+            logger.debug('Running HMC for {0} burn-in and {1} steps...'
+                         .format(n_burn or 0, n_steps))
+            time0 = time.time()
+            chain = sampler.run(p0[0], n_steps, n_burn=n_burn or 0)
+            logger.debug('...time spent sampling: {0}'
+                         .format(time.time()-time0))
 
-        n_dim = p0.shape[1]
-        sampler = emcee.EnsembleSampler(n_walkers, n_dim, model,
-                                        pool=self.pool)
+            samples = model.unpack_samples_mcmc(chain)
+            samples.t0 = samples0.t0
 
-        if n_burn is not None and n_burn > 0:
-            logger.debug('Burning in MCMC for {0} steps...'.format(n_burn))
-            time0 = time.time()
-            pos, *_ = sampler.run_mcmc(p0, n_burn)
-            logger.debug('...time spent burn-in: {0}'.format(time.time()-time0))
+            if return_sampler:
+                return model, samples, sampler
 
-            p0 = pos
-            sampler.reset()
+            else:
+                return model, samples
 
-        logger.debug('Running MCMC for {0} steps...'.format(n_steps))
-        time0 = time.time()
-        _ = sampler.run_mcmc(p0, n_steps)
-        logger.debug('...time spent sampling: {0}'.format(time.time()-time0))
+        import emcee
 
-        acc_frac = sampler.acceptance_fraction
-        if scoreatpercentile(acc_frac, 10) < 0.1:
-            logger.warning('Walkers have low acceptance fractions: 10/50/90 '
-                           'percentiles = {0:.2f}, {1:.2f}, {2:.2f}'
-                           .format(*scoreatpercentile(acc_frac, [10, 50, 90])))
+        if vectorize:
+            sampler = emcee.EnsembleSampler(n_walkers, n_dim,
+                                            model.batch_ln_posterior,
+                                            vectorize=True)
+        else:
+            sampler = emcee.EnsembleSampler(n_walkers, n_dim, model,
+                                            pool=self.pool)
+
+        n_sampled = n_steps
+        if target_n_eff is not None:
+            chain, diagnostics = self._run_emcee_to_convergence(
+                sampler, p0, n_burn=n_burn or 0, n_steps=n_steps,
+                target_n_eff=target_n_eff, check_interval=check_interval,
+                max_r_hat=max_r_hat)
+
+        elif chain_store is not None:
+            n_sampled = self._run_emcee_with_store(
+                sampler, p0, n_burn=n_burn or 0, n_steps=n_steps,
+                store=chain_store, state=state, key=store_key)
+
+            if return_chain:
+                chain, _ = chain_store.read_chain()
+                chain = chain.reshape(-1, n_dim)
+            else:
+                chain = chain_store.load_state()['position']
 
-        samples = model.unpack_samples_mcmc(sampler.chain[:, -1])
+        else:
+            if n_burn is not None and n_burn > 0:
+                logger.debug('Burning in MCMC for {0} steps...'
+                             .format(n_burn))
+                time0 = time.time()
+                pos, *_ = sampler.run_mcmc(p0, n_burn)
+                logger.debug('...time spent burn-in: {0}'
+                             .format(time.time()-time0))
+
+                p0 = pos
+                sampler.reset()
+
+            logger.debug('Running MCMC for {0} steps...'.format(n_steps))
+            time0 = time.time()
+            _ = sampler.run_mcmc(p0, n_steps)
+            logger.debug('...time spent sampling: {0}'
+                         .format(time.time()-time0))
+
+            if return_chain:
+                chain = sampler.chain.reshape(-1, n_dim)
+            else:
+                # the final walker positions
+                chain = sampler.chain[:, -1]
+
+        # (a resumed run may already be complete)
+        if n_sampled > 0:
+            acc_frac = sampler.acceptance_fraction
+            pcts = scoreatpercentile(acc_frac, [10, 50, 90])
+            if pcts[0] < 0.1:
+                logger.warning('Walkers have low acceptance fractions: '
+                               '10/50/90 percentiles = {0:.2f}, {1:.2f}, '
+                               '{2:.2f}'.format(*pcts))
+
+        if marginal:
+            # draw the linear parameters for each sample
+            pars = model.sample_linear(chain, random_state=self.random_state)
+            samples = self._unpack_full_samples(pars, model.prior_units,
+                                                return_logprobs=False,
+                                                instruments=data.instruments)
+        else:
+            samples = model.unpack_samples_mcmc(chain)
         samples.t0 = samples0.t0
 
+        if target_n_eff is not None:
+            samples.meta.update(diagnostics)
+
         if return_sampler:
             return model, samples, sampler
 
         else:
             return model, samples
+
+    def run(self, data, n_requested_samples, n_prior_samples=2**18,
+            max_prior_samples=2**24, prior_cache_file=None, growth_factor=8,
+            mcmc_kwargs=None):
+        """Generate posterior samples, choosing the cheapest method that
+        delivers the requested number of samples.
+
+        First, `~thejoker.TheJoker.iterative_rejection_sample` is run with
+        ``n_prior_samples`` prior samples. If this yields fewer than
+        ``n_requested_samples`` samples, and the samples are unimodal in
+        period (see `~thejoker.sampler.is_P_unimodal`), the samples are used
+        to initialize `~thejoker.TheJoker.mcmc_sample`, run until the
+        effective sample size reaches ``n_requested_samples``. If the samples
+        are multimodal, rejection sampling is repeated with
+        ``growth_factor`` times as many prior samples, up to
+        ``max_prior_samples``. With a ``prior_cache_file``, each repeat
+        continues from where the previous run stopped, so only the
+        likelihoods of the new prior samples are computed.
+
+        Parameters
+        ----------
+        data : `~thejoker.RVData`
+            The radial velocity data.
+        n_requested_samples : int
+            The number of posterior samples to generate.
+        n_prior_samples : int (optional)
+            The number of prior samples to use in the first rejection
+            sampling run.
+        max_prior_samples : int (optional)
+            The maximum number of prior samples. If ``prior_cache_file`` is
+            specified, this is also limited to the number of samples in the
+            cache file.
+        prior_cache_file : str (optional)
+            A path to an HDF5 cache file containing prior samples.
+        growth_factor : int (optional)
+            The factor by which the number of prior samples is increased
+            between rejection sampling runs.
+        mcmc_kwargs : dict (optional)
+            Keyword arguments passed to `~thejoker.TheJoker.mcmc_sample`. By
+            default, ``target_n_eff`` is set to ``n_requested_samples``.
+
+        Returns
+        -------
+        samples : `~thejoker.JokerSamples`
+            The posterior samples. The method used to generate the samples
+            (``'rejection'`` or ``'mcmc'``) and the number of prior samples
+            used in the last rejection sampling run are stored in the ``meta``
+            dictionary.
+        """
+        if prior_cache_file is not None:
+            with h5py.File(prior_cache_file, 'r') as f:
+                max_prior_samples = min(max_prior_samples, len(f['samples']))
+        n_prior_samples = min(n_prior_samples, max_prior_samples)
+
+        if growth_factor <= 1:
+            raise ValueError("growth_factor must be larger than 1.")
+
+        # the prior samples in a cache file are the same for each repeat, so
+        # the rejection step can continue with the next prior samples
+        if prior_cache_file is not None:
+            state = RejectionState(seed=self.random_state.randint(2**16))
+        else:
+            state = None
+
+        while True:
+            logger.debug("The Joker: rejection sampling with {0} prior "
+                         "samples".format(n_prior_samples))
+            samples = self.iterative_rejection_sample(
+                data, n_requested_samples=n_requested_samples,
+                prior_cache_file=prior_cache_file,
+                n_prior_samples=n_prior_samples, state=state)
+            samples.meta['n_prior_samples'] = n_prior_samples
+
+            if samples.size >= n_requested_samples:
+                samples.meta['method'] = 'rejection'
+                return samples[:n_requested_samples]
+
+            if is_P_unimodal(samples, data):
+                break
+
+            if n_prior_samples >= max_prior_samples:
+                logger.warning("Posterior samples are multimodal, but the "
+                               "maximum number of prior samples ({0}) has "
+                               "been reached: returning {1} samples."
+                               .format(max_prior_samples, samples.size))
+                samples.meta['method'] = 'rejection'
+                return samples
+
+            n_prior_samples = min(growth_factor * n_prior_samples,
+                                  max_prior_samples)
+
+        logger.debug("The Joker: {0} unimodal samples, continuing with MCMC"
+                     .format(samples.size))
+
+        if mcmc_kwargs is None:
+            mcmc_kwargs = dict()
+        mcmc_kwargs = dict(mcmc_kwargs)
+        mcmc_kwargs.setdefault('target_n_eff', n_requested_samples)
+        mcmc_kwargs.pop('return_sampler', None)
+
+        _, mcmc_samples = self.mcmc_sample(data, samples, **mcmc_kwargs)
+        mcmc_samples.meta['method'] = 'mcmc'
+        mcmc_samples.meta['n_prior_samples'] = n_prior_samples
+
+        if mcmc_samples.size > n_requested_samples:
+            idx = self.random_state.choice(mcmc_samples.size,
+                                           size=n_requested_samples,
+                                           replace=False)
+            mcmc_samples = mcmc_samples[np.sort(idx)]
+
+        return mcmc_samples
+
@@ -1,9 +1,11 @@
 # Standard library
 from collections import OrderedDict
 import copy
+import re
 import warnings
 
 # Third-party
+from astropy.constants import G
 import astropy.coordinates as coord
 import astropy.units as u
 from astropy.time import Time
@@ -12,62 +14,171 @@ from twobody import KeplerOrbit, Barycenter
 
 # Package
 from ..utils import quantity_to_hdf5, quantity_from_hdf5
+from .fast_likelihood import batch_kepler_rv
 
-__all__ = ['JokerSamples']
+__all__ = ['JokerSamples', 'LazyJokerSamples']
 
 
-class JokerSamples(OrderedDict):
+class JokerSamples(object):
     _valid_keys = ['P', 'M0', 'e', 'omega', 'jitter', 'K', 'v0']
 
-    def __init__(self, t0=None, **kwargs):
+    # higher-order velocity trend terms (v1, v2, ...), velocity offsets of
+    # instruments relative to the reference instrument (dv0_<label>), and
+    # the jitter of the other instruments (jitter_<label>)
+    _trend_key_pattern = re.compile('^(v[0-9]+|dv0_.+|jitter_.+)$')
+
+    def __init__(self, t0=None, meta=None, **kwargs):
         """A dictionary-like object for storing posterior samples from
         The Joker, with some extra functionality.
 
+        The samples are stored in a single array with one column per
+        parameter, along with the unit of each column. Accessing a parameter
+        returns a `~astropy.units.Quantity` view of its column, and slicing
+        the samples (e.g., ``samples[:10]``) returns a new object that is a
+        view of the same array, so neither copies the sample values.
+
         Parameters
         ----------
         t0 : `astropy.time.Time`, numeric (optional)
             The reference time for the orbital parameters.
+        meta : dict (optional)
+            Any metadata associated with the samples, e.g., information about
+            the sampler run that generated them.
         **kwargs
             These are the orbital element names.
         """
 
-        # initialize empty dictionary
-        super(JokerSamples, self).__init__()
-
         # reference time
         self.t0 = t0
 
-        self._size = None
-        self._shape = None
+        if meta is None:
+            meta = dict()
+        self.meta = meta
+
+        # the sample values, with shape (..., n_params), and an ordered table
+        # of the names and units of the columns
+        self._data = None
+        self._units = OrderedDict()
+
         for key, val in kwargs.items():
             self[key] = val # calls __setitem__ below
 
         self._cache = dict()
 
+    @classmethod
+    def from_array(cls, arr, names, units, t0=None, meta=None):
+        """Create a samples object from an array of sample values, without
+        copying the values if possible.
+
+        Parameters
+        ----------
+        arr : array_like
+            The sample values, with shape ``(n_samples, n_params)``.
+        names : iterable
+            The parameter names of the columns.
+        units : iterable
+            The units of the columns.
+        t0 : `astropy.time.Time`, numeric (optional)
+            The reference time for the orbital parameters.
+        meta : dict (optional)
+            Any metadata associated with the samples.
+
+        Returns
+        -------
+        samples : `~thejoker.JokerSamples`
+        """
+        names = list(names)
+        units = list(units)
+
+        arr = np.asarray(arr, dtype=np.float64)
+        if arr.shape[-1:] != (len(names),) or len(units) != len(names):
+            raise ValueError("The last axis of the sample array must have one "
+                             "column per name and unit.")
+
+        samples = cls(t0=t0, meta=meta)
+        for name, unit in zip(names, units):
+            samples._validate_key(name)
+            samples._units[name] = u.Unit(unit)
+        samples._data = np.ascontiguousarray(arr)
+
+        return samples
+
+    @classmethod
+    def concatenate(cls, samples_list):
+        """Concatenate samples objects with the same parameters.
+
+        Parameters
+        ----------
+        samples_list : iterable
+            The `~thejoker.JokerSamples` objects. The values are converted to
+            the units of the first object.
+
+        Returns
+        -------
+        samples : `~thejoker.JokerSamples`
+            A one-dimensional samples object, with the ``t0`` and a copy of the
+            ``meta`` of the first object.
+        """
+        samples_list = list(samples_list)
+        if len(samples_list) == 0:
+            raise ValueError("No samples to concatenate.")
+
+        first = samples_list[0]
+        names = list(first.keys())
+
+        arrs = []
+        for samples in samples_list:
+            samples = samples.load()
+            if set(samples.keys()) != set(names):
+                raise ValueError("Samples to concatenate must have the same "
+                                 "parameters.")
+
+            if not _t0_equal(samples.t0, first.t0):
+                raise ValueError("Samples to concatenate must have the same "
+                                 "reference time t0.")
+
+            # reorder columns and convert units to match the first object
+            idx = [samples._column(name) for name in names]
+            scale = [samples._units[name].to(first._units[name])
+                     for name in names]
+            arr = samples._data.reshape(-1, samples._data.shape[-1])[:, idx]
+            arrs.append(arr * np.array(scale))
+
+        return cls.from_array(np.concatenate(arrs), names,
+                              [first._units[k] for k in names],
+                              t0=first.t0, meta=dict(first.meta))
+
     def _validate_key(self, key):
-        if key not in self._valid_keys:
+        if (key not in self._valid_keys and
+                self._trend_key_pattern.match(key) is None):
             raise ValueError("Invalid key '{0}'.".format(key))
 
     def _validate_val(self, val):
-        val = u.Quantity(val)
-        if self._shape is not None and val.shape != self.shape:
+        val = u.Quantity(val, dtype=np.float64)
+        if self._data is not None and val.shape != self.shape:
             raise ValueError("Shape of new samples must match those already "
                              "stored! ({0}, expected {1})"
-                             .format(len(val), self.shape))
+                             .format(val.shape, self.shape))
 
         return val
 
+    def _column(self, key):
+        try:
+            return list(self._units.keys()).index(key)
+        except ValueError:
+            raise KeyError(key)
+
     def __getitem__(self, slc):
         if isinstance(slc, str):
-            return super(JokerSamples, self).__getitem__(slc)
+            return u.Quantity(self._data[..., self._column(slc)],
+                              self._units[slc], copy=False)
 
         else:
             new = copy.copy(self)
-            new._size = None # reset number of samples
-            new._shape = None # reset number of samples
-
-            for k in self.keys():
-                new[k] = self[k][slc]
+            new._units = self._units.copy()
+            new._cache = dict()
+            if self._data is not None:
+                new._data = self._data[slc]
 
             return new
 
@@ -75,11 +186,53 @@ class JokerSamples(OrderedDict):
         self._validate_key(key)
         val = self._validate_val(val)
 
-        if self._shape is None:
-            self._shape = val.shape
-            self._size = val.size
+        if self._data is None:
+            self._data = np.array(val.value)[..., None]
+
+        elif key in self._units:
+            # don't modify samples objects that this one is a view of
+            if not self._data.flags.owndata:
+                self._data = self._data.copy()
+            self._data[..., self._column(key)] = val.value
+
+        else:
+            self._data = np.concatenate((self._data, val.value[..., None]),
+                                        axis=-1)
+
+        self._units[key] = val.unit
+
+    def __delitem__(self, key):
+        i = self._column(key)
+        self._data = np.delete(self._data, i, axis=-1)
+        del self._units[key]
+
+        if len(self._units) == 0:
+            self._data = None
+
+    def __contains__(self, key):
+        return key in self._units
+
+    def __iter__(self):
+        return iter(self._units)
 
-        super(JokerSamples, self).__setitem__(key, val)
+    def keys(self):
+        return self._units.keys()
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key):
+        val = self[key].copy()
+        del self[key]
+        return val
 
     @property
     def n_samples(self):
@@ -89,31 +242,47 @@ class JokerSamples(OrderedDict):
 
     @property
     def size(self):
-        if self._size is None:
-            raise ValueError("No samples stored!")
-        return self._size
+        return int(np.prod(self.shape))
 
     @property
     def shape(self):
-        if self._shape is None:
+        if self._data is None:
             raise ValueError("No samples stored!")
-        return self._shape
+        return self._data.shape[:-1]
 
     def __len__(self):
-        return self.n_samples
+        return self.size
 
     def __str__(self):
         return ("<JokerSamples in [{0}], {1} samples>"
                 .format(','.join(self.keys()), len(self)))
 
     @classmethod
-    def from_hdf5(cls, f, n=None, **kwargs):
+    def _hdf5_keys(cls, f):
+        """The parameter names stored in an HDF5 group, in the standard
+        order."""
+        keys = [key for key in cls._valid_keys if key in f]
+
+        trend_keys = [k for k in f.keys() if cls._trend_key_pattern.match(k)
+                      and k not in cls._valid_keys]
+        keys += sorted(trend_keys,
+                       key=lambda k: (k.startswith('jitter_'),
+                                      k.startswith('dv0_'), len(k), k))
+        return keys
+
+    @classmethod
+    def from_hdf5(cls, f, n=None, lazy=False, **kwargs):
         """
         Parameters
         ----------
         f : :class:`h5py.File`, :class:`h5py.Group`
         n : int (optional)
             The number of samples to load.
+        lazy : bool (optional)
+            Don't read the samples now: return a
+            `~thejoker.sampler.samples.LazyJokerSamples` object that reads
+            parameter columns, and only the selected rows, when they are
+            accessed. The file must stay open while the samples are used.
         **kwargs
             All other keyword arguments are passed to the class initializer.
         """
@@ -124,22 +293,50 @@ class JokerSamples(OrderedDict):
         else:
             t0 = None
 
-        samples = cls(t0=t0, **kwargs)
-        for key in cls._valid_keys:
-            if key in f:
-                samples[key] = quantity_from_hdf5(f, key, n=n)
+        # samples appended with append_samples_to_hdf5(): ignore any samples
+        # beyond the last complete write
+        if 'n_committed' in f.attrs:
+            n_committed = int(f.attrs['n_committed'])
+            n = n_committed if n is None else min(n, n_committed)
 
-        return samples
+        if lazy:
+            return LazyJokerSamples(f, n=n, t0=t0, **kwargs)
 
-    def to_hdf5(self, f):
+        keys = cls._hdf5_keys(f)
+        cols = [u.Quantity(quantity_from_hdf5(f, key, n=n)) for key in keys]
+        if len(cols) == 0:
+            return cls(t0=t0, **kwargs)
+
+        arr = np.stack([c.value for c in cols], axis=-1)
+        return cls.from_array(arr.astype(np.float64, copy=False),
+                              keys, [c.unit for c in cols], t0=t0, **kwargs)
+
+    def load(self):
+        """Return a samples object with the values in memory. This object
+        already is, so this returns itself."""
+        return self
+
+    def to_hdf5(self, f, chunks=None, compression=None, compression_opts=None,
+                dtype=None):
         """
         Parameters
         ----------
         f : :class:`h5py.File`, :class:`h5py.Group`
+        chunks : int (optional)
+            The number of samples per chunk of each dataset.
+        compression : str (optional)
+            The compression filter, e.g., ``'gzip'`` or ``'lzf'``.
+        compression_opts : int (optional)
+            Options for the compression filter, e.g., the gzip level.
+        dtype : `numpy.dtype` (optional)
+            The data type to store the samples as on disk. Samples stored as
+            ``np.float32`` are converted back to double precision when read.
         """
 
         for key in self.keys():
-            quantity_to_hdf5(f, key, self[key])
+            quantity_to_hdf5(f, key, self[key], chunks=chunks,
+                             compression=compression,
+                             compression_opts=compression_opts, dtype=dtype)
 
         if self.t0 is not None:
             f.attrs['t0_bmjd'] = self.t0.tcb.mjd
@@ -225,25 +422,340 @@ class JokerSamples(OrderedDict):
         for i in range(len(self)):
             yield self.get_orbit(i)
 
-    # Numpy reduce function
-    def _apply(self, func):
-        cls = self.__class__
+    def rv(self, t, instrument=None, anomaly_tol=1E-10, anomaly_maxiter=128):
+        """Compute the radial velocity curves of all samples at once.
+
+        This evaluates the Keplerian orbits with the compiled Kepler solver
+        used in the likelihood, and adds the velocity trend terms (``v0``,
+        ``v1``, ...) and, if ``instrument`` is specified, the velocity offset
+        of that instrument. This is much faster than looping over
+        `~thejoker.JokerSamples.get_orbit`.
+
+        Parameters
+        ----------
+        t : array_like, `~astropy.time.Time`
+            Array of times. Either in BMJD or as an Astropy time object.
+        instrument : str (optional)
+            The label of the instrument to compute the radial velocities for.
+            No offset is added for the reference instrument, i.e. if the
+            samples have no ``dv0_<instrument>`` parameter.
+        anomaly_tol : float (optional)
+            Tolerance of the eccentric anomaly solver.
+        anomaly_maxiter : int (optional)
+            Maximum number of iterations of the eccentric anomaly solver.
 
-        kw = dict()
-        for k in self.keys():
-            kw[k] = func(self[k])
+        Returns
+        -------
+        rv : `~astropy.units.Quantity`
+            The radial velocities, with shape ``self.shape + (len(t),)``, in
+            the units of the ``K`` samples.
+        """
+        if self.t0 is None:
+            raise ValueError('Samples object has no reference time .t0')
+
+        if isinstance(self.t0, Time):
+            t0 = self.t0.tcb.mjd
+        else:
+            t0 = float(self.t0)
+
+        if isinstance(t, Time):
+            t = t.tcb.mjd
+        t = np.ascontiguousarray(np.atleast_1d(t), dtype=np.float64)
+
+        rv_unit = self['K'].unit
+
+        def col(key, unit):
+            return np.ravel(self[key].to_value(unit))
+
+        nonlinear_p = np.stack([col('P', u.day), col('M0', u.radian),
+                                col('e', u.one), col('omega', u.radian)],
+                               axis=1)
+        rv = batch_kepler_rv(np.ascontiguousarray(nonlinear_p), t, t0,
+                             anomaly_tol, anomaly_maxiter)
+        rv *= col('K', rv_unit)[:, None]
+
+        # velocity trend, in powers of (t - t0)
+        dt = t - t0
+        i = 0
+        while 'v{0}'.format(i) in self:
+            v = col('v{0}'.format(i), rv_unit / u.day**i)
+            rv += v[:, None] * dt[None]**i
+            i += 1
 
-        kw['t0'] = self.t0
-        return cls(**kw)
+        # velocity offset relative to the reference instrument
+        if instrument is not None and 'dv0_{0}'.format(instrument) in self:
+            rv += col('dv0_{0}'.format(instrument), rv_unit)[:, None]
+
+        return rv.reshape(self.shape + (len(t),)) * rv_unit
+
+    ##########################################################################
+    # Derived quantities
+    #
+    # These are computed for all samples at once on the raw arrays, in fixed
+    # units, and the units are attached at the end.
+
+    def _values(self, key, unit):
+        return np.asarray(self[key].to_value(unit))
+
+    def mass_function(self):
+        r"""Compute the binary mass function of all samples,
+
+        .. math::
+
+            f(M) = \frac{P\,K^3\,(1-e^2)^{3/2}}{2\pi\,G}
+
+        Returns
+        -------
+        mf : `~astropy.units.Quantity` [mass]
+            The mass function, in solar masses.
+        """
+        P = self._values('P', u.day)
+        K = self._values('K', u.km/u.s)
+        e = self._values('e', u.one)
+
+        # scale to solar masses for P in days and K in km/s
+        factor = (u.day * (u.km/u.s)**3 / (2*np.pi*G)).to_value(u.Msun)
+        return factor * P * K**3 * (1 - e**2)**1.5 * u.Msun
+
+    def asini(self):
+        r"""Compute the projected semi-major axis of the orbit of the primary,
+        :math:`a_1\sin i = P\,K\,\sqrt{1-e^2} / (2\pi)`, of all
+        samples.
+
+        Returns
+        -------
+        asini : `~astropy.units.Quantity` [length]
+            The projected semi-major axis, in AU.
+        """
+        P = self._values('P', u.day)
+        K = self._values('K', u.km/u.s)
+        e = self._values('e', u.one)
+
+        factor = (u.day * u.km/u.s).to(u.au)
+        return factor * P * K * np.sqrt(1 - e**2) / (2*np.pi) * u.au
+
+    def t_peri(self):
+        """Compute the time of the first pericenter passage at or after the
+        reference time ``t0`` of all samples.
+
+        Returns
+        -------
+        t_peri : `~astropy.time.Time`
+            The times of pericenter, in the TCB scale.
+        """
+        if self.t0 is None:
+            raise ValueError('Samples object has no reference time .t0')
+
+        if isinstance(self.t0, Time):
+            t0 = self.t0.tcb.mjd
+        else:
+            t0 = float(self.t0)
+
+        # the mean anomaly is M = 2*pi*(t - t0)/P - M0
+        P = self._values('P', u.day)
+        M0 = self._values('M0', u.radian)
+        t = t0 + P * (M0 % (2*np.pi)) / (2*np.pi)
+        return Time(t, format='mjd', scale='tcb')
+
+    def m2_min(self, m1, tol=1E-10, maxiter=128):
+        r"""Compute the minimum mass of the companion of all samples, i.e. the
+        companion mass for an edge-on orbit, given the mass of the primary.
+
+        This solves :math:`m_2^3 = f(M)\,(m_1 + m_2)^2` with Newton's method
+        for all samples at once, starting from an upper bound on the root so
+        that the iteration converges monotonically.
+
+        Parameters
+        ----------
+        m1 : `~astropy.units.Quantity` [mass]
+            The mass of the primary. Either a scalar, or an array that
+            broadcasts with the shape of the samples.
+        tol : float (optional)
+            The relative tolerance of the solution.
+        maxiter : int (optional)
+            The maximum number of Newton iterations.
+
+        Returns
+        -------
+        m2_min : `~astropy.units.Quantity` [mass]
+            The minimum companion mass, in solar masses.
+        """
+        mf = np.asarray(self.mass_function().to_value(u.Msun))
+        m1 = np.broadcast_to(u.Quantity(m1).to_value(u.Msun),
+                             np.shape(mf)).astype(np.float64)
+
+        # m2 >= mf, and m2 < 4 mf if m2 >= m1, or m2 < (4 mf m1^2)^(1/3)
+        # otherwise. The function below is convex above mf/3.
+        m2 = np.maximum(4*mf, np.cbrt(4*mf*m1**2))
+        for i in range(maxiter):
+            f = m2**3 - mf * (m1 + m2)**2
+            df = 3*m2**2 - 2*mf * (m1 + m2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = np.where(df > 0, f / df, 0.)
+            m2 = m2 - step
+
+            if np.all(np.abs(step) <= tol * m2):
+                break
+
+        return m2 * u.Msun
+
+    # Numpy reduce function
+    def _apply(self, func):
+        arr = self._data.reshape(-1, self._data.shape[-1])
+        return self.__class__.from_array(func(arr, axis=0), self.keys(),
+                                         self._units.values(), t0=self.t0)
 
     def mean(self):
         """Return a new scalar object by taking the mean across all samples"""
         return self._apply(np.mean)
 
     def median(self):
-        """Return a new scalar object by taking the medin across all samples"""
-        return self._apply(np.mean)
+        """Return a new scalar object by taking the median across all
+        samples"""
+        return self._apply(np.median)
 
     def std(self):
-        """Return a new scalar object by taking the medin across all samples"""
+        """Return a new scalar object by taking the standard deviation across
+        all samples"""
         return self._apply(np.std)
+
+
+class LazyJokerSamples(JokerSamples):
+
+    def __init__(self, f, n=None, t0=None, meta=None):
+        """Posterior samples stored in an HDF5 file, read on demand.
+
+        This holds the `h5py` dataset of each parameter and a selection of
+        rows. Accessing a parameter (e.g., ``samples['P']``) reads only the
+        selected rows of that dataset, and slicing or indexing (e.g.,
+        ``samples[100:200]``) returns a new lazy object without reading
+        anything. Use `~thejoker.sampler.samples.LazyJokerSamples.load` to
+        read all parameters into a `~thejoker.JokerSamples` object. This is
+        usually created with ``JokerSamples.from_hdf5(f, lazy=True)``.
+
+        Parameters
+        ----------
+        f : :class:`h5py.File`, :class:`h5py.Group`
+            The group containing a dataset for each parameter, as written by
+            `~thejoker.JokerSamples.to_hdf5`.
+        n : int (optional)
+            Only use the first ``n`` samples.
+        t0 : `astropy.time.Time`, numeric (optional)
+            The reference time for the orbital parameters.
+        meta : dict (optional)
+            Any metadata associated with the samples.
+        """
+        super(LazyJokerSamples, self).__init__(t0=t0, meta=meta)
+
+        self._datasets = OrderedDict()
+        for key in self._hdf5_keys(f):
+            ds = f[key]
+            unit = ds.attrs.get('unit', None)
+            if isinstance(unit, bytes):
+                unit = unit.decode()
+            self._datasets[key] = ds
+            self._units[key] = u.Unit(unit) if unit is not None else u.one
+
+        if len(self._datasets) == 0:
+            raise ValueError("No samples found in '{0}'.".format(f.name))
+
+        shapes = set(ds.shape for ds in self._datasets.values())
+        if len(shapes) > 1:
+            raise ValueError("Datasets of the samples in '{0}' have different "
+                             "shapes.".format(f.name))
+        self._n_total = shapes.pop()
+
+        if len(self._n_total) == 0: # scalar samples
+            self._rows = ()
+        elif len(self._n_total) == 1:
+            self._n_total = self._n_total[0]
+            self._rows = slice(0, n)
+        else:
+            raise ValueError("Lazy samples must be one-dimensional.")
+
+    def _read(self, ds):
+        rows = self._rows
+        if isinstance(rows, np.ndarray):
+            # h5py only supports increasing, unique indices
+            idx, inv = np.unique(rows, return_inverse=True)
+            vals = ds[idx][inv.reshape(rows.shape)]
+
+        else:
+            vals = ds[rows]
+
+        # samples may be stored in single precision
+        return np.asarray(vals, dtype=np.float64)
+
+    def __getitem__(self, slc):
+        if isinstance(slc, str):
+            return u.Quantity(self._read(self._datasets[slc]),
+                              self._units[slc], copy=False)
+
+        rows = self._rows
+        if isinstance(rows, slice):
+            rows = range(self._n_total)[rows]
+        elif not isinstance(rows, np.ndarray):
+            raise IndexError("Samples are scalar-valued!")
+
+        if isinstance(rows, range) and isinstance(slc, slice):
+            rows = rows[slc]
+            if rows.step > 0:
+                rows = slice(rows.start, rows.stop, rows.step)
+            else:
+                rows = np.asarray(rows)
+
+        elif isinstance(slc, (int, np.integer)):
+            rows = int(rows[slc])
+
+        else:
+            rows = np.asarray(rows)[slc]
+
+        new = copy.copy(self)
+        new._units = self._units.copy()
+        new._cache = dict()
+        new._rows = rows
+        return new
+
+    def __setitem__(self, key, val):
+        raise TypeError("Lazy samples are read-only: use .load() to read the "
+                        "samples into memory first.")
+
+    def __delitem__(self, key):
+        raise TypeError("Lazy samples are read-only: use .load() to read the "
+                        "samples into memory first.")
+
+    @property
+    def shape(self):
+        rows = self._rows
+        if isinstance(rows, slice):
+            return (len(range(self._n_total)[rows]), )
+        elif isinstance(rows, np.ndarray):
+            return rows.shape
+        return ()
+
+    def load(self):
+        """Read the selected rows of all parameters into memory.
+
+        Returns
+        -------
+        samples : `~thejoker.JokerSamples`
+        """
+        arr = np.stack([self._read(ds) for ds in self._datasets.values()],
+                       axis=-1)
+        return JokerSamples.from_array(arr, self.keys(),
+                                       self._units.values(), t0=self.t0,
+                                       meta=self.meta)
+
+    def _apply(self, func):
+        return self.load()._apply(func)
+
+
+def _t0_equal(t1, t2):
+    """Check whether two reference times are the same."""
+    if t1 is None or t2 is None:
+        return t1 is None and t2 is None
+
+    if isinstance(t1, Time) and isinstance(t2, Time):
+        return bool(np.all(t1.tcb.mjd == t2.tcb.mjd))
+
+    return bool(np.all(t1 == t2))
@@ -74,14 +74,13 @@ class FakeData(object):
 
         ######################################################################
         # hierarchical triple - long term velocity trend
-        # TODO: no longer works with TwoBody changes
-        # self.v1 = rnd.uniform(-1, 1) * u.km/u.s/u.day
-        # orbit = RVOrbit(**truth)
-        # rv = orbit.generate_rv_curve(mjd) + self.v0 + self.v1*(mjd-mjd.min())*u.day
-        # err = np.full_like(rv.value, 0.01) * u.km/u.s
-        # data = RVData(mjd, rv, stddev=err, t_offset=mjd.min())
-        # self.data['triple'] = data
-        # self.joker_params['triple'] = JokerParams(P_min=8*u.day,
-        #                                           P_max=1024*u.day)
-        # self.truths['triple'] = truth.copy()
-        # self.truths['triple']['M0'] = self.truths['triple']['M0'] - ((2*np.pi*data.t_offset/P.value))*u.radian
+
+        truth['v1'] = rnd.uniform(-1, 1) * u.km/u.s/u.day
+        rv = (truth['K'] * orbit.unscaled_radial_velocity(t) + truth['v0'] +
+              truth['v1'] * (t - EPOCH).to(u.day))
+        err = np.full_like(rv.value, 0.01) * u.km/u.s
+        data = RVData(t, rv, stddev=err, t0=EPOCH)
+        self.datasets['triple'] = data
+        self.params['triple'] = JokerParams(P_min=8*u.day, P_max=1024*u.day,
+                                            poly_trend=2)
+        self.truths['triple'] = truth.copy()
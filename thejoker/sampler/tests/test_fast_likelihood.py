@@ -1,16 +1,51 @@
 # Third-party
 import astropy.units as u
 import numpy as np
+import pytest
 import time
 
 # Package
 from ...data import RVData
-from ..likelihood import marginal_ln_likelihood
-from ..fast_likelihood import batch_marginal_ln_likelihood
+from ..likelihood import (marginal_ln_likelihood, design_matrix, get_ivar,
+                          tensor_vector_scalar)
+from ..fast_likelihood import (batch_marginal_ln_likelihood,
+                               batch_get_posterior_samples, jitter_grid)
 from .. import JokerParams, TheJoker
 from .helpers import FakeData
 
 
+def _py_marginal_ln_likelihood(chunk, data, joker_params):
+    """Compute the marginal log-likelihood for each prior sample in the chunk
+    with the pure-Python implementation."""
+    py_ll = np.zeros(len(chunk))
+    for i in range(len(chunk)):
+        py_ll[i] = np.squeeze(marginal_ln_likelihood(chunk[i], data,
+                                                     joker_params))
+    return py_ll
+
+
+def _lstsq_marginal_ln_likelihood(chunk, data, joker_params):
+    """Compute the marginal log-likelihood for each prior sample in the chunk
+    from a least-squares solution with column scaling, which stays accurate
+    when the normal equations are badly conditioned."""
+    y = data.rv.value
+    ll = np.zeros(len(chunk))
+    for i in range(len(chunk)):
+        A = design_matrix(chunk[i], data, joker_params)
+        ivar = get_ivar(data, chunk[i, 4])
+        scale = 1 / np.abs(A).max(axis=0)
+        B = np.sqrt(ivar)[:, None] * A * scale
+
+        p, *_ = np.linalg.lstsq(B, np.sqrt(ivar) * y, rcond=None)
+        chi2 = np.sum((B.dot(p) - np.sqrt(ivar) * y)**2)
+        sv = np.linalg.svd(B, compute_uv=False)
+        logdet = (2*np.sum(np.log(sv)) - 2*np.sum(np.log(scale)) -
+                  A.shape[1] * np.log(2*np.pi) +
+                  np.sum(np.log(ivar / (2*np.pi))))
+        ll[i] = 0.5*logdet - 0.5*chi2
+    return ll
+
+
 def test_shit():
     joker_params = JokerParams(P_min=8*u.day, P_max=32768*u.day, jitter=0*u.m/u.s)
     joker = TheJoker(joker_params)
@@ -46,3 +81,213 @@ def test_shit():
     print("Python:", time.time() - t0)
 
     assert np.allclose(np.array(cy_ll), py_ll)
+
+
+def test_marginalize_omega():
+    joker_params = JokerParams(P_min=8*u.day, P_max=32768*u.day,
+                               jitter=0*u.m/u.s, marginalize_omega=True)
+    joker = TheJoker(joker_params)
+
+    t = np.random.uniform(0, 250, 16) + 56831.324
+    t.sort()
+
+    rv = np.cos(t)
+    rv_err = np.random.uniform(0.1, 0.2, t.size)
+
+    data = RVData(t=t, rv=rv*u.km/u.s, stddev=rv_err*u.km/u.s)
+
+    samples = joker.sample_prior(size=1024)
+    assert np.all(samples['omega'].value == 0)
+
+    chunk = []
+    for k in samples:
+        chunk.append(np.array(samples[k]))
+    chunk = np.ascontiguousarray(np.vstack(chunk).T)
+
+    cy_ll = batch_marginal_ln_likelihood(chunk, data, joker_params)
+    py_ll = _py_marginal_ln_likelihood(chunk, data, joker_params)
+    assert np.allclose(np.array(cy_ll), py_ll)
+
+
+def test_jitter_grid():
+    joker_params = JokerParams(P_min=8*u.day, P_max=32768*u.day,
+                               jitter=(np.log(0.1**2), 1.),
+                               jitter_unit=u.km/u.s, jitter_grid=16)
+    joker = TheJoker(joker_params)
+
+    t = np.random.uniform(0, 250, 16) + 56831.324
+    t.sort()
+
+    rv = np.cos(t)
+    rv_err = np.random.uniform(0.1, 0.2, t.size)
+
+    data = RVData(t=t, rv=rv*u.km/u.s, stddev=rv_err*u.km/u.s)
+
+    samples = joker.sample_prior(size=128)
+    assert np.all(samples['jitter'].value == 0)
+
+    chunk = []
+    for k in samples:
+        chunk.append(np.array(samples[k]))
+    chunk = np.ascontiguousarray(np.vstack(chunk).T)
+
+    y, s, ln_w, dy = jitter_grid(joker_params, data.rv.unit)
+    assert np.allclose(np.sum(np.exp(ln_w)), 1.)
+    assert np.allclose(np.diff(y), dy)
+
+    # compare to explicitly summing over the grid
+    py_ll = np.zeros((len(chunk), len(s)))
+    for j in range(len(s)):
+        chunk[:, 4] = s[j]
+        py_ll[:, j] = _py_marginal_ln_likelihood(chunk, data, joker_params)
+    py_ll = np.log(np.sum(np.exp(py_ll + ln_w[None]), axis=1))
+
+    cy_ll = batch_marginal_ln_likelihood(chunk, data, joker_params)
+    assert np.allclose(np.array(cy_ll), py_ll)
+
+    # jitter values are drawn within the grid
+    pars = batch_get_posterior_samples(chunk, data, joker_params,
+                                       np.random.RandomState(42), False)
+    log_s2 = np.log(np.array(pars)[:, 4]**2)
+    assert np.all(log_s2 > y[0] - dy/2.)
+    assert np.all(log_s2 < y[-1] + dy/2.)
+
+
+def test_poly_trend():
+    joker_params = JokerParams(P_min=8*u.day, P_max=32768*u.day,
+                               jitter=(np.log(0.1**2), 1.),
+                               jitter_unit=u.km/u.s, poly_trend=3)
+    joker = TheJoker(joker_params)
+
+    t = np.random.uniform(0, 1000, 16) + 56831.324
+    t.sort()
+
+    rv = np.cos(t) + 1E-3 * (t - t.min())
+    rv_err = np.random.uniform(0.1, 0.2, t.size)
+
+    data = RVData(t=t, rv=rv*u.km/u.s, stddev=rv_err*u.km/u.s)
+
+    samples = joker.sample_prior(size=1024)
+
+    chunk = []
+    for k in samples:
+        chunk.append(np.array(samples[k]))
+    chunk = np.ascontiguousarray(np.vstack(chunk).T)
+
+    cy_ll = np.array(batch_marginal_ln_likelihood(chunk, data, joker_params))
+
+    # For periods much longer than the data baseline, the Keplerian part of
+    # the model is almost a polynomial in time, so the normal equations are
+    # badly conditioned. The Python implementation solves them directly and
+    # is only good to ~1E-3 there, so it is compared for short periods only.
+    short = chunk[:, 0] < 256
+    py_ll = _py_marginal_ln_likelihood(chunk[short], data, joker_params)
+    assert np.allclose(cy_ll[short], py_ll)
+
+    # all periods, compared to a stable least-squares solution
+    ref_ll = _lstsq_marginal_ln_likelihood(chunk, data, joker_params)
+    assert np.allclose(cy_ll, ref_ll, rtol=1E-8)
+
+    pars = batch_get_posterior_samples(chunk[:16], data, joker_params,
+                                       np.random.RandomState(42), True)
+    assert np.array(pars).shape == (16, joker_params.num_params + 1)
+
+
+def test_instrument_offsets():
+    joker_params = JokerParams(P_min=8*u.day, P_max=32768*u.day,
+                               jitter=5*u.m/u.s)
+    joker = TheJoker(joker_params)
+
+    t = np.random.uniform(0, 250, 16) + 56831.324
+    t.sort()
+
+    instrument = np.array(['a'] * 8 + ['b'] * 4 + ['c'] * 4)
+    offsets = np.array([0., 1.5, -2.])
+    rv = np.cos(t) + offsets[np.searchsorted(['a', 'b', 'c'], instrument)]
+    rv_err = np.random.uniform(0.1, 0.2, t.size)
+
+    data = RVData(t=t, rv=rv*u.km/u.s, stddev=rv_err*u.km/u.s,
+                  instrument=instrument)
+
+    samples = joker.sample_prior(size=1024)
+
+    chunk = []
+    for k in samples:
+        chunk.append(np.array(samples[k]))
+    chunk = np.ascontiguousarray(np.vstack(chunk).T)
+
+    # the Python implementation expects the jitter in the units of the data
+    chunk[:, 4] = samples['jitter'].to(data.rv.unit).value
+
+    cy_ll = batch_marginal_ln_likelihood(chunk, data, joker_params)
+    py_ll = _py_marginal_ln_likelihood(chunk, data, joker_params)
+    assert np.allclose(np.array(cy_ll), py_ll)
+
+    # one extra column for each instrument but the first
+    pars = batch_get_posterior_samples(chunk[:16], data, joker_params,
+                                       np.random.RandomState(42), False)
+    assert np.array(pars).shape == (16, joker_params.num_params + 2)
+
+
+def test_per_instrument_jitter():
+    joker_params = JokerParams(P_min=8*u.day, P_max=32768*u.day,
+                               jitter=(np.log(0.1**2), 1.),
+                               jitter_unit=u.km/u.s, jitter_grid=4,
+                               per_instrument_jitter=True)
+    joker = TheJoker(joker_params)
+
+    t = np.random.uniform(0, 250, 16) + 56831.324
+    t.sort()
+
+    instrument = np.array(['a'] * 8 + ['b'] * 4 + ['c'] * 4)
+    rv = np.cos(t)
+    rv_err = np.random.uniform(0.1, 0.2, t.size)
+
+    data = RVData(t=t, rv=rv*u.km/u.s, stddev=rv_err*u.km/u.s,
+                  instrument=instrument)
+
+    samples = joker.sample_prior(size=16)
+
+    chunk = []
+    for k in samples:
+        chunk.append(np.array(samples[k]))
+    chunk = np.ascontiguousarray(np.vstack(chunk).T)
+
+    # compare to explicitly summing over all combinations of the grid values
+    y, s, ln_w, dy = jitter_grid(joker_params, data.rv.unit)
+    idx = np.stack(np.meshgrid(*[np.arange(len(s))]*3, indexing='ij'))
+    idx = idx.reshape(3, -1).T
+
+    py_ll = np.zeros((len(chunk), len(idx)))
+    for i in range(len(chunk)):
+        A = design_matrix(chunk[i], data, joker_params)
+        for j, jdx in enumerate(idx):
+            ivar = get_ivar(data, s[jdx][data._instrument_idx])
+            ATCinvA, p, chi2 = tensor_vector_scalar(A, ivar, data.rv.value)
+            py_ll[i, j] = np.squeeze(marginal_ln_likelihood(
+                chunk[i], data, joker_params, tvsi=(ATCinvA, p, chi2, ivar)))
+            py_ll[i, j] += np.sum(ln_w[jdx])
+    py_ll = np.log(np.sum(np.exp(py_ll), axis=1))
+
+    cy_ll = batch_marginal_ln_likelihood(chunk, data, joker_params)
+    assert np.allclose(np.array(cy_ll), py_ll)
+
+    # two extra columns for the offsets, and two for the other jitters
+    pars = batch_get_posterior_samples(chunk, data, joker_params,
+                                       np.random.RandomState(42), False)
+    pars = np.array(pars)
+    assert pars.shape == (len(chunk), joker_params.num_params + 4)
+
+    log_s2 = np.log(pars[:, [4, -2, -1]]**2)
+    assert np.all(log_s2 > y[0] - dy/2.)
+    assert np.all(log_s2 < y[-1] + dy/2.)
+
+    # too many combinations of jitter values for the grid
+    pars = JokerParams(P_min=8*u.day, P_max=32768*u.day,
+                       jitter=(np.log(0.1**2), 1.), jitter_unit=u.km/u.s,
+                       jitter_grid=64, per_instrument_jitter=True)
+    with pytest.raises(ValueError):
+        batch_marginal_ln_likelihood(chunk, data, pars)
+    with pytest.raises(ValueError):
+        batch_get_posterior_samples(chunk, data, pars,
+                                    np.random.RandomState(42), False)
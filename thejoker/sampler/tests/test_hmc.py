@@ -0,0 +1,22 @@
+# Third-party
+import numpy as np
+
+# Package
+from ..hmc import HMCSampler
+
+
+def test_hmc_gaussian():
+    # a Gaussian with very different scales in each dimension
+    std = np.array([1E-4, 1., 30.])
+
+    def ln_prob_and_grad(x):
+        return -0.5 * np.sum((x / std)**2), -x / std**2
+
+    sampler = HMCSampler(ln_prob_and_grad, n_dim=3,
+                         random_state=np.random.RandomState(42))
+    chain = sampler.run(np.full(3, 1E-3), n_steps=2000, n_burn=500)
+
+    assert chain.shape == (2000, 3)
+    assert sampler.chain.shape == (2000, 3)
+    assert np.allclose(chain.std(axis=0) / std, 1., atol=0.15)
+    assert sampler.acceptance_fraction > 0.5
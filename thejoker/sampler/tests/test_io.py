@@ -1,11 +1,16 @@
 # Third-party
+from astropy.tests.helper import quantity_allclose
+from astropy.time import Time
 import astropy.units as u
 import h5py
 import numpy as np
+import pytest
 
 # Package
 from ...data import RVData
-from ..io import pack_prior_samples, save_prior_samples
+from ..io import (pack_prior_samples, save_prior_samples, MCMCChainStore,
+                  append_samples_to_hdf5, SamplesStore, _pad_prior_samples)
+from ..samples import JokerSamples
 
 
 class TestIO(object):
@@ -51,3 +56,203 @@ class TestIO(object):
 
         with h5py.File(path, 'r') as f:
             assert f['samples'][:].shape == (self.n, 5)
+
+    def test_save_prior_samples_storage(self, tmpdir):
+        path = str(tmpdir.join('io-test3.hdf5'))
+        save_prior_samples(path, self.samples, self.data.rv.unit,
+                           ln_prior_probs=np.zeros(self.n), chunks=32,
+                           compression='gzip', dtype=np.float32)
+        with h5py.File(path, 'r') as f:
+            assert f['samples'].dtype == np.float32
+            assert f['samples'].chunks == (32, 5)
+            assert f['samples'].compression == 'gzip'
+
+            chunk = _pad_prior_samples(f, f['samples'][:])
+            assert chunk.dtype == np.float64
+
+        M, _ = pack_prior_samples(self.samples, self.data.rv.unit)
+        assert np.allclose(chunk, M, rtol=1E-6)
+
+        # a constant jitter column isn't stored
+        samples = self.samples.copy()
+        samples['jitter'] = np.full(self.n, 15.) * u.m/u.s
+        path = str(tmpdir.join('io-test4.hdf5'))
+        units = save_prior_samples(path, samples, self.data.rv.unit)
+        assert len(units) == 5
+        with h5py.File(path, 'r') as f:
+            assert f['samples'].shape == (self.n, 4)
+            assert len(f.attrs['units']) == 5
+            chunk = _pad_prior_samples(f, f['samples'][8:16])
+
+        assert chunk.shape == (8, 5)
+        assert chunk.flags['C_CONTIGUOUS']
+        assert np.allclose(chunk[:, 4], 0.015)
+
+    def test_samples_storage(self, tmpdir):
+        samples = JokerSamples(t0=Time(55555., format='mjd'))
+        for key in ['P', 'M0', 'omega', 'e']:
+            samples[key] = self.samples[key]
+
+        path = str(tmpdir.join('io-test-samples.hdf5'))
+        with h5py.File(path, 'w') as f:
+            samples.to_hdf5(f, chunks=32, compression='gzip',
+                            dtype=np.float32)
+            samples[0].to_hdf5(f.create_group('one'), chunks=32,
+                               compression='gzip', dtype=np.float32)
+
+        with h5py.File(path, 'r') as f:
+            assert f['P'].dtype == np.float32
+            assert f['P'].chunks == (32, )
+
+            samples2 = JokerSamples.from_hdf5(f)
+            assert samples2['P'].dtype == np.float64
+            assert quantity_allclose(samples2['P'], samples['P'], rtol=1E-6)
+
+            lazy = JokerSamples.from_hdf5(f, lazy=True)
+            assert lazy['e'].dtype == np.float64
+
+            one = JokerSamples.from_hdf5(f['one'])
+            assert quantity_allclose(one['P'], samples['P'][0], rtol=1E-6)
+
+    def test_mcmc_chain_store(self, tmpdir):
+        path = str(tmpdir.join('io-test-chain.hdf5'))
+        store = MCMCChainStore(path, thin=2, save_interval=4)
+        assert store.load_state() is None
+
+        chain = np.random.normal(size=(8, 10, 3))
+        ln_prob = np.random.normal(size=(8, 10))
+
+        store.initialize(8, 3, key='test')
+        store.update(chain[:, 0], ln_prob[:, 0], n_burn=16, n_steps=0)
+        for i in range(0, 10, 4):
+            j = min(i+4, 10)
+            store.update(chain[:, j-1], ln_prob[:, j-1], n_burn=16,
+                         n_steps=j, chain=chain[:, i:j],
+                         chain_ln_prob=ln_prob[:, i:j])
+
+        state = store.load_state()
+        assert state['n_burn'] == 16
+        assert state['n_steps'] == 10
+        assert state['key'] == 'test'
+        assert np.allclose(state['position'], chain[:, -1])
+
+        stored_chain, stored_ln_prob = store.read_chain()
+        assert np.allclose(stored_chain, chain[:, 1::2])
+        assert np.allclose(stored_ln_prob, ln_prob[:, 1::2])
+
+    def test_append_samples_to_hdf5(self, tmpdir):
+        path = str(tmpdir.join('io-test-append.hdf5'))
+
+        def make_samples(n):
+            samples = JokerSamples(t0=Time('J2015.5'))
+            samples['P'] = np.random.uniform(10, 100, size=n) * u.day
+            samples['e'] = np.random.uniform(size=n)
+            samples['K'] = np.random.uniform(1, 10, size=n) * u.km/u.s
+            return samples
+
+        samples1 = make_samples(16)
+        samples2 = make_samples(8)
+        samples2['K'] = samples2['K'].to(u.m/u.s)
+
+        assert append_samples_to_hdf5(path, samples1, path='star') == 16
+        assert append_samples_to_hdf5(path, samples2, path='star') == 24
+
+        with h5py.File(path, 'r') as f:
+            assert f['star/P'].maxshape == (None, )
+            samples = JokerSamples.from_hdf5(f['star'])
+
+        assert len(samples) == 24
+        assert samples['K'].unit == u.km/u.s
+        assert quantity_allclose(samples['K'][16:], samples2['K'])
+
+        # an interrupted write: samples beyond the committed number are
+        # ignored, and overwritten by the next append
+        with h5py.File(path, 'a') as f:
+            for key in ['P', 'e', 'K']:
+                f['star'][key].resize(30, axis=0)
+        with h5py.File(path, 'r') as f:
+            assert len(JokerSamples.from_hdf5(f['star'])) == 24
+            assert len(JokerSamples.from_hdf5(f['star'], lazy=True)) == 24
+
+        assert append_samples_to_hdf5(path, samples1[:2], path='star') == 26
+
+        # different parameters or reference time
+        with pytest.raises(ValueError):
+            append_samples_to_hdf5(path, JokerSamples(t0=samples1.t0,
+                                                      P=samples1['P']),
+                                   path='star')
+
+        samples3 = make_samples(4)
+        samples3.t0 = Time('J2000')
+        with pytest.raises(ValueError):
+            append_samples_to_hdf5(path, samples3, path='star')
+
+        # samples written with to_hdf5() are converted on the first append
+        with h5py.File(path, 'a') as f:
+            samples1.to_hdf5(f.create_group('star2'))
+        assert append_samples_to_hdf5(path, samples2, path='star2') == 24
+        with h5py.File(path, 'r') as f:
+            samples = JokerSamples.from_hdf5(f['star2'])
+        assert quantity_allclose(samples['P'][:16], samples1['P'])
+
+    def test_samples_store(self, tmpdir):
+        path = str(tmpdir.join('io-test-catalog.hdf5'))
+        store = SamplesStore(path, chunk_size=16)
+        assert len(store) == 0
+        assert len(store.index) == 0
+
+        all_samples = dict()
+        for i in range(5):
+            samples = JokerSamples(t0=Time(55555. + i, format='mjd'),
+                                   meta=dict(method='rejection',
+                                             n_eff=np.float64(i)))
+            for key in ['P', 'M0', 'omega', 'e']:
+                samples[key] = self.samples[key][:8*(i+1)]
+            all_samples['star{0}'.format(i)] = samples
+
+        store.save('star0', all_samples['star0'])
+        ids = ['star1', 'star2', 'star3']
+        store.save_many(ids, [all_samples[x] for x in ids])
+        assert len(store) == 4
+        assert 'star2' in store
+        assert 'star4' not in store
+        assert list(store.star_ids) == ['star0', 'star1', 'star2', 'star3']
+
+        samples = store.load('star2')
+        assert samples.size == 24
+        assert np.isclose(samples.t0.tcb.mjd, all_samples['star2'].t0.tcb.mjd)
+        assert samples.meta['method'] == 'rejection'
+        assert samples.meta['n_eff'] == 2.
+        assert 'created' in samples.meta
+        for key in ['P', 'M0', 'omega', 'e']:
+            assert quantity_allclose(samples[key], all_samples['star2'][key])
+
+        with pytest.raises(KeyError):
+            store.load('star4')
+
+        with pytest.raises(ValueError):
+            store.save('star4', JokerSamples(P=self.samples['P']))
+
+        # re-running a star replaces its samples; a new store object reading
+        # the same file sees it
+        store.save('star1', all_samples['star4'])
+        store2 = SamplesStore(path)
+        assert len(store2) == 4
+        assert store2.load('star1').size == 40
+
+        samples, index = store2.load_all()
+        assert samples.size == 8 + 40 + 24 + 32
+        assert list(index['star_id']) == ['star0', 'star1', 'star2', 'star3']
+        assert list(index['offset']) == [0, 8, 48, 72]
+        assert np.allclose(index['t0_bmjd'][[0, 2]],
+                           [all_samples['star0'].t0.tcb.mjd,
+                            all_samples['star2'].t0.tcb.mjd])
+        i1, i2 = index['offset'][2], index['offset'][2] + index['n_samples'][2]
+        assert quantity_allclose(samples['P'][i1:i2],
+                                 all_samples['star2']['P'])
+
+        samples, index = store2.load_all(star_ids=['star3', 'star0'],
+                                         names=['P', 'e'])
+        assert list(samples.keys()) == ['P', 'e']
+        assert samples.size == 32 + 8
+        assert quantity_allclose(samples['P'][32:], all_samples['star0']['P'])
@@ -4,6 +4,7 @@ import numpy as np
 
 # Package
 from ..likelihood import design_matrix, tensor_vector_scalar, marginal_ln_likelihood
+from ..params import JokerParams
 
 from .helpers import FakeData
 
@@ -33,12 +34,29 @@ class TestLikelihood(object):
         assert A.shape == (len(data), 2) # K, v0
         assert np.allclose(A[:,1], 1)
 
-        # TODO: triple disabled
-        # nlp = self.truths_to_nlp(self.truths['triple'])
-        # A = design_matrix(nlp, data, self.params['triple'])
-        # assert A.shape == (len(data), 3) # K, v0, v1
-        # assert np.allclose(A[:,1], 1)
-        # assert np.allclose(A[:,2], data._t_bmjd)
+        data = self.datasets['triple']
+        nlp = self.truths_to_nlp(self.truths['triple'])
+        A = design_matrix(nlp, data, self.params['triple'])
+        assert A.shape == (len(data), 3) # K, v0, v1
+        assert np.allclose(A[:,1], 1)
+        assert np.allclose(A[:,2], data._t_bmjd - data._t0_bmjd)
+
+    def test_design_matrix_marginalize_omega(self):
+
+        data = self.datasets['binary']
+        truth = self.truths['binary']
+        nlp = self.truths_to_nlp(truth)
+        A = design_matrix(nlp, data, self.params['binary'])
+
+        params = JokerParams(P_min=8*u.day, P_max=1024*u.day,
+                             marginalize_omega=True)
+        A2 = design_matrix(nlp, data, params)
+        assert A2.shape == (len(data), 3) # K cos(omega), K sin(omega), v0
+        assert np.allclose(A2[:,2], 1)
+
+        omega = truth['omega'].to(u.radian).value
+        assert np.allclose(A2[:,:2].dot([np.cos(omega), np.sin(omega)]),
+                           A[:,0])
 
     def test_tensor_vector_scalar(self):
 
@@ -53,15 +71,16 @@ class TestLikelihood(object):
 
         # --
 
-        # TODO: triple disabled
-        # data = self.data['triple']
-        # nlp = self.truths_to_nlp(self.truths['triple'])
-        # A = design_matrix(nlp, data, self.params['triple'])
-        # ATCinvA, p, chi2 = tensor_vector_scalar(A, data.ivar.value,
-        #                                         data.rv.value)
-        #
-        # true_p = [self.truths['triple']['K'].value, self.fd.v0.value, self.fd.v1.value]
-        # assert np.allclose(p, true_p, rtol=1e-2)
+        data = self.datasets['triple']
+        nlp = self.truths_to_nlp(self.truths['triple'])
+        A = design_matrix(nlp, data, self.params['triple'])
+        ATCinvA, p, chi2 = tensor_vector_scalar(A, data.ivar.value,
+                                                data.rv.value)
+
+        true_p = [self.truths['triple']['K'].value,
+                  self.truths['triple']['v0'].value,
+                  self.truths['triple']['v1'].value]
+        assert np.allclose(p, true_p, rtol=1e-2)
 
     def test_marginal_ln_likelihood_P(self):
         """
@@ -1,9 +1,12 @@
+# Standard library
+import pickle
+
 # Third-party
 import astropy.units as u
 import numpy as np
 
 # Package
-from ..mcmc import TheJokerMCMCModel
+from ..mcmc import TheJokerMCMCModel, TheJokerMarginalMCMCModel
 from ..params import JokerParams
 from .helpers import FakeData
 
@@ -49,3 +52,90 @@ class TestMCMC(object):
 
         assert np.isfinite(lnpost)
         assert np.allclose(lnpost, lp+ll.sum())
+
+    def test_batch(self):
+        data = self.data['binary']
+        truth = self.truths['binary']
+        nlp = self.truths_to_nlp(truth)
+        params = self.joker_params['binary']
+        model = TheJokerMCMCModel(params, data)
+
+        p = np.concatenate((nlp, [truth['K'].value], [truth['v0'].value]))
+        mcmc_p = np.delete(model.to_mcmc_params(p)[:, 0], 5)
+
+        # a ball of walkers, some of which are outside of the prior support
+        rnd = np.random.RandomState(42)
+        walkers = mcmc_p[None] + rnd.normal(0, 1E-2, (32, len(mcmc_p)))
+        walkers[0, 0] = np.log(params.P_max.to(u.day).value) + 1.
+
+        lnpost = model.batch_ln_posterior(walkers)
+        assert lnpost.shape == (len(walkers),)
+        assert np.isneginf(lnpost[0])
+        assert np.all(np.isfinite(lnpost[1:]))
+
+        for i in range(len(walkers)):
+            assert np.allclose(lnpost[i], model.ln_posterior(walkers[i]))
+
+        # compare to the pure-Python implementation
+        p = model.from_mcmc_params(np.insert(walkers, 5, model._y_jitter,
+                                             axis=1).T).T
+        assert np.isneginf(model.ln_prior(p[0]))
+        for i in range(1, len(walkers)):
+            py_lnpost = model.ln_prior(p[i]) + model.ln_likelihood(p[i]).sum()
+            assert np.allclose(lnpost[i], py_lnpost)
+
+        # the model has to be picklable to use with a multiprocessing pool
+        model2 = pickle.loads(pickle.dumps(model))
+        assert np.allclose(model2.batch_ln_posterior(walkers[1:]),
+                           lnpost[1:])
+
+    def test_grad(self):
+        data = self.data['binary']
+        truth = self.truths['binary']
+        nlp = self.truths_to_nlp(truth)
+        params = self.joker_params['binary']
+        model = TheJokerMCMCModel(params, data)
+
+        p = np.concatenate((nlp, [truth['K'].value], [truth['v0'].value]))
+        mcmc_p = np.delete(model.to_mcmc_params(p)[:, 0], 5)
+        mcmc_p += np.random.RandomState(42).normal(0, 1E-3, len(mcmc_p))
+
+        lnpost, grad = model.ln_posterior_and_grad(mcmc_p)
+        assert np.allclose(lnpost, model.ln_posterior(mcmc_p))
+
+        # compare to finite differences
+        fd_grad = np.zeros_like(grad)
+        for i in range(len(mcmc_p)):
+            h = 1E-6 * max(1., abs(mcmc_p[i]))
+            p1 = mcmc_p.copy()
+            p1[i] += h
+            p2 = mcmc_p.copy()
+            p2[i] -= h
+            fd_grad[i] = (model.ln_posterior(p1) -
+                          model.ln_posterior(p2)) / (2*h)
+        assert np.allclose(grad, fd_grad, rtol=1E-4, atol=1E-4)
+
+    def test_marginal(self):
+        data = self.data['binary']
+        truth = self.truths['binary']
+        nlp = self.truths_to_nlp(truth)
+        params = self.joker_params['binary']
+        model = TheJokerMarginalMCMCModel(params, data)
+
+        # fixed jitter: ln P, sqrt(e) cos(omega), sqrt(e) sin(omega), M0
+        mcmc_p = model.to_mcmc_params(nlp)
+        assert mcmc_p.shape == (1, 4)
+        assert np.allclose(model.from_mcmc_params(mcmc_p), nlp)
+
+        walkers = mcmc_p + np.random.normal(0, 1E-3, (16, 4))
+        walkers[0, 0] = np.log(params.P_max.to(u.day).value) + 1.
+
+        lnpost = model.batch_ln_posterior(walkers)
+        assert np.isneginf(lnpost[0])
+        assert np.all(np.isfinite(lnpost[1:]))
+        assert np.allclose(lnpost[1], model.ln_posterior(walkers[1]))
+
+        # K and v0 are drawn for each position
+        pars = model.sample_linear(walkers[1:], np.random.RandomState(42))
+        assert pars.shape == (15, params.num_params)
+        assert np.all(pars[:, 5] > 0)
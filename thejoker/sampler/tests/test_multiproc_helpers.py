@@ -2,11 +2,13 @@
 import astropy.units as u
 import h5py
 import numpy as np
+import pytest
 import schwimmbad
 
 # Package
 from ..multiproc_helpers import (get_good_sample_indices, compute_likelihoods,
-                                 sample_indices_to_full_samples, chunk_tasks)
+                                 sample_indices_to_full_samples, chunk_tasks,
+                                 reservoir_sample_indices, RejectionState)
 from .helpers import FakeData
 
 
@@ -24,6 +26,34 @@ def test_chunk_tasks():
     assert n_tasks == N
 
 
+def test_rejection_state():
+    rnd = np.random.RandomState(42)
+    lls = rnd.normal(0, 2, size=64)
+    lls[11] = np.nan
+
+    # feed the likelihood values in batches, with the maximum in a later batch
+    n_trials = 4096
+    counts = np.zeros(len(lls))
+    for seed in range(n_trials):
+        state = RejectionState(seed=seed)
+        for i1, i2 in [(0, 16), (16, 40), (40, 64)]:
+            n_good = state.update(lls[i1:i2], i1)
+        assert n_good == len(state)
+        assert state.n_processed == len(lls)
+        assert state.max_ll == np.nanmax(lls)
+        assert np.all(np.diff(state.good_samples_idx) > 0)
+        counts[state.good_samples_idx] += 1
+
+    # the max likelihood sample is always accepted, NaN never
+    assert counts[np.nanargmax(lls)] == n_trials
+    assert counts[11] == 0
+
+    # acceptance probability matches one rejection step over all values
+    p_accept = np.exp(lls - np.nanmax(lls))
+    p_accept[11] = 0.
+    assert np.allclose(counts / n_trials, p_accept, atol=0.05)
+
+
 class TestMultiproc(object):
 
     # TODO: this is bad to copy pasta from test_likelihood.py
@@ -77,3 +107,79 @@ class TestMultiproc(object):
         full_samples = sample_indices_to_full_samples(idx, prior_samples_file,
                                                       data, joker_params, pool)
         print(full_samples)
+
+    def _write_prior_samples(self, prior_samples_file):
+        """Write prior samples around the period of the circular binary, and
+        return the number of samples."""
+        nlp = self.truths_to_nlp(self.truths['circ_binary'])
+
+        n = 8192
+        P = np.random.uniform(nlp[0]-2., nlp[0]+2., n)
+        M0 = np.random.uniform(0, 2*np.pi, n)
+        ecc = np.zeros(n)
+        omega = np.zeros(n)
+        jitter = np.zeros(n)
+        samples = np.vstack((P,M0,ecc,omega,jitter)).T
+
+        with h5py.File(prior_samples_file, 'w') as f:
+            f['samples'] = samples
+
+        return n
+
+    def test_reservoir_sample_indices(self, tmpdir):
+        prior_samples_file = str(tmpdir.join('prior-samples.h5'))
+        pool = schwimmbad.SerialPool()
+
+        data = self.data['circ_binary']
+        joker_params = self.joker_params['circ_binary']
+        n = self._write_prior_samples(prior_samples_file)
+
+        # weighted reservoir sampling always returns the requested number
+        for n_batches in [None, 13]:
+            idx, n_eff = reservoir_sample_indices(16, n, prior_samples_file, 0,
+                                                  data, joker_params, pool,
+                                                  global_seed=42,
+                                                  n_batches=n_batches)
+            assert len(idx) == 16
+            assert len(np.unique(idx)) == 16
+            assert np.all(np.diff(idx) > 0)
+            assert n_eff >= 1.
+
+    def test_checkpoint(self, tmpdir):
+        prior_samples_file = str(tmpdir.join('prior-samples.h5'))
+        pool = schwimmbad.SerialPool()
+
+        data = self.data['circ_binary']
+        joker_params = self.joker_params['circ_binary']
+        n = self._write_prior_samples(prior_samples_file)
+
+        lls = compute_likelihoods(n, prior_samples_file, 0, data,
+                                  joker_params, pool, n_batches=13)
+
+        # checkpointed likelihoods match, and resume from incomplete batches
+        checkpoint_file = str(tmpdir.join('checkpoint.h5'))
+        lls2 = compute_likelihoods(n, prior_samples_file, 0, data,
+                                   joker_params, pool, n_batches=13,
+                                   checkpoint_file=checkpoint_file)
+        assert np.allclose(lls, lls2)
+
+        # pretend the run was interrupted after 6 batches; wipe the saved
+        # values to check that completed batches are not re-computed
+        with h5py.File(checkpoint_file, 'a') as f:
+            assert f['done'][:].all()
+            f['marg_ll'][:] = np.nan
+            f['done'][6:] = False
+
+        # pass a different number of batches: should use the checkpoint's
+        lls3 = compute_likelihoods(n, prior_samples_file, 0, data,
+                                   joker_params, pool, n_batches=5,
+                                   checkpoint_file=checkpoint_file)
+        assert np.isnan(lls3).sum() == sum(len(lls[t[0][0]:t[0][1]])
+                                           for t in chunk_tasks(n, 13)[:6])
+        assert np.allclose(lls3[~np.isnan(lls3)], lls[~np.isnan(lls3)])
+
+        # different data: checkpoint file can't be reused
+        with pytest.raises(ValueError):
+            compute_likelihoods(n, prior_samples_file, 0,
+                                self.data['binary'], joker_params, pool,
+                                checkpoint_file=checkpoint_file)
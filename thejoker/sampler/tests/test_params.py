@@ -29,3 +29,35 @@ def test_init():
     with pytest.raises(ValueError):
         pars = JokerParams(P_min=8.*u.day, P_max=8192*u.day,
                            jitter=(0.1, 5., 1.))
+
+    # jitter grid only makes sense if sampling over the jitter
+    with pytest.raises(ValueError):
+        pars = JokerParams(P_min=8.*u.day, P_max=8192*u.day,
+                           jitter=5*u.m/u.s, jitter_grid=32)
+
+    with pytest.raises(ValueError):
+        pars = JokerParams(P_min=8.*u.day, P_max=8192*u.day,
+                           jitter=(0.5, 1.), jitter_unit=u.m/u.s,
+                           jitter_grid=1)
+
+    pars = JokerParams(P_min=8.*u.day, P_max=8192*u.day,
+                       jitter=(0.5, 1.), jitter_unit=u.m/u.s, jitter_grid=32)
+    assert pars.jitter_grid == 32
+
+    # a jitter for each instrument requires the jitter grid
+    with pytest.raises(ValueError):
+        pars = JokerParams(P_min=8.*u.day, P_max=8192*u.day,
+                           jitter=(0.5, 1.), jitter_unit=u.m/u.s,
+                           per_instrument_jitter=True)
+
+    pars = JokerParams(P_min=8.*u.day, P_max=8192*u.day,
+                       jitter=(0.5, 1.), jitter_unit=u.m/u.s, jitter_grid=8,
+                       per_instrument_jitter=True)
+    assert pars.per_instrument_jitter
+
+    # polynomial velocity trend
+    pars = JokerParams(P_min=8.*u.day, P_max=8192*u.day, poly_trend=3)
+    assert pars.default_params[-3:] == ['v0', 'v1', 'v2']
+
+    with pytest.raises(ValueError):
+        pars = JokerParams(P_min=8.*u.day, P_max=8192*u.day, poly_trend=0)
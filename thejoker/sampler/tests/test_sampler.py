@@ -5,8 +5,12 @@ import numpy as np
 import pytest
 
 # Package
+from ...data import RVData
+from ..io import save_prior_samples, LikelihoodStore, MCMCChainStore
+from ..multiproc_helpers import RejectionState
 from ..params import JokerParams
-from ..sampler import TheJoker
+from ..samples import JokerSamples
+from ..sampler import TheJoker, is_P_unimodal
 from .helpers import FakeData
 
 
@@ -27,7 +31,7 @@ class TestSampler(object):
 
     def test_init(self):
         TheJoker(self.joker_params['binary'])
-        # TheJoker(self.joker_params['triple']) # TODO: disabled
+        TheJoker(self.joker_params['triple'])
 
         # invalid pool
         class DummyPool(object):
@@ -66,6 +70,22 @@ class TestSampler(object):
 
         joker.rejection_sample(data, n_prior_samples=128)
 
+        # Data with a long-term velocity trend
+        data = self.data['triple']
+        joker = TheJoker(self.joker_params['triple'], random_state=rnd)
+        samples = joker.rejection_sample(data, n_prior_samples=128)
+        assert samples['v1'].unit == u.km/u.s/u.day
+
+        # Data from more than one instrument
+        data = self.data['binary']
+        data = RVData(t=data.t, rv=data.rv, ivar=data.ivar,
+                      instrument=np.arange(len(data)) % 2)
+        joker = TheJoker(self.joker_params['binary'], random_state=rnd)
+        samples = joker.rejection_sample(data, n_prior_samples=128)
+        assert 'dv0_1' in samples
+
+        data = self.data['binary']
+
         # Now re-run with jitter set, check that it's always the fixed value
         jitter = 5.*u.m/u.s
         params = JokerParams(P_min=8*u.day, P_max=128*u.day, jitter=jitter)
@@ -76,6 +96,102 @@ class TestSampler(object):
 
         full_samples = joker.rejection_sample(data, n_prior_samples=128)
         assert quantity_allclose(full_samples['jitter'], jitter)
+        assert full_samples.meta['n_prior_samples_processed'] == 128
+        assert full_samples.meta['n_prior_samples'] == 128
+
+        # Marginalize over the jitter on a grid
+        params = JokerParams(P_min=8*u.day, P_max=128*u.day,
+                             jitter=(1., 2.), jitter_unit=u.m/u.s,
+                             jitter_grid=8)
+        joker = TheJoker(params, random_state=rnd)
+        full_samples = joker.rejection_sample(data, n_prior_samples=128)
+        assert np.all(full_samples['jitter'].value > 0)
+
+        # ...with a separate jitter for each instrument
+        params = JokerParams(P_min=8*u.day, P_max=128*u.day,
+                             jitter=(1., 2.), jitter_unit=u.m/u.s,
+                             jitter_grid=4, per_instrument_jitter=True)
+        data = RVData(t=data.t, rv=data.rv, ivar=data.ivar,
+                      instrument=np.arange(len(data)) % 2)
+        joker = TheJoker(params, random_state=rnd)
+        full_samples = joker.rejection_sample(data, n_prior_samples=128)
+        assert np.all(full_samples['jitter_1'].value > 0)
+
+    def test_rejection_sample_budget(self):
+        rnd = np.random.RandomState(42)
+
+        data = self.data['binary']
+        joker = TheJoker(self.joker_params['binary'], random_state=rnd)
+
+        samples = joker.rejection_sample(data, n_prior_samples=4096,
+                                         max_likelihood_evals=1000)
+        assert samples.meta['n_prior_samples_processed'] == 1000
+        assert samples.meta['n_prior_samples'] == 1000
+
+        # a budget that runs out after the first batch
+        samples = joker.rejection_sample(data, n_prior_samples=65536,
+                                         time_budget=1E-8)
+        assert 0 < samples.meta['n_prior_samples_processed'] < 65536
+        assert len(samples) > 0
+
+        # a budget large enough to process all of the prior samples
+        samples = joker.rejection_sample(data, n_prior_samples=4096,
+                                         time_budget=1E4)
+        assert samples.meta['n_prior_samples_processed'] == 4096
+
+    def test_reweight(self, tmpdir):
+        rnd = np.random.RandomState(42)
+
+        data = self.data['binary']
+        params = JokerParams(P_min=8*u.day, P_max=1024*u.day,
+                             jitter=(1., 2.), jitter_unit=u.m/u.s)
+        joker = TheJoker(params, random_state=rnd)
+
+        prior_cache_file = str(tmpdir / 'prior-samples.h5')
+        prior_samples = joker.sample_prior(size=16384)
+        save_prior_samples(prior_cache_file, prior_samples, data.rv.unit)
+
+        store = LikelihoodStore(str(tmpdir / 'likelihoods.h5'))
+        samples1 = joker.rejection_sample(data,
+                                          prior_cache_file=prior_cache_file,
+                                          likelihood_store=store)
+        key = store.key(data, prior_cache_file, 16384, 0, params)
+        assert key in store
+        assert len(store.load(key)) == 16384
+
+        # the store is used on a second run
+        samples2 = joker.rejection_sample(data,
+                                          prior_cache_file=prior_cache_file,
+                                          likelihood_store=store)
+        assert len(samples2) > 0
+
+        # narrow the period range and change the jitter prior
+        new_params = JokerParams(P_min=16*u.day, P_max=512*u.day,
+                                 jitter=(2., 1.), jitter_unit=u.m/u.s)
+        samples3 = joker.reweight(data, store, prior_cache_file,
+                                  new_params=new_params)
+        assert len(samples3) > 0
+        assert np.all(samples3['P'] >= 16*u.day)
+        assert np.all(samples3['P'] <= 512*u.day)
+
+        # reweight with a function of the prior samples
+        samples4 = joker.reweight(data, store, prior_cache_file,
+                                  ln_prior_ratio=lambda x: np.zeros(len(x)))
+        assert len(samples4) > 0
+
+        with pytest.raises(ValueError):
+            joker.reweight(data, store, prior_cache_file)
+
+        with pytest.raises(ValueError):  # period range too large
+            joker.reweight(data, store, prior_cache_file,
+                           new_params=JokerParams(P_min=1*u.day,
+                                                  P_max=512*u.day,
+                                                  jitter=(2., 1.),
+                                                  jitter_unit=u.m/u.s))
+
+        with pytest.raises(ValueError):  # no stored likelihood values
+            joker.reweight(self.data['circ_binary'], store, prior_cache_file,
+                           new_params=new_params)
 
     def test_iterative_rejection_sample(self):
 
@@ -90,6 +206,130 @@ class TestSampler(object):
 
         assert quantity_allclose(samples['jitter'], jitter)
 
+    def test_iterative_rejection_sample_continue(self, tmpdir):
+        rnd = np.random.RandomState(42)
+
+        data = self.data['binary']
+        joker = TheJoker(self.joker_params['binary'], random_state=rnd)
+
+        prior_cache_file = str(tmpdir / 'prior-samples.h5')
+        prior_samples = joker.sample_prior(size=8192)
+        save_prior_samples(prior_cache_file, prior_samples, data.rv.unit)
+
+        # continuing with more prior samples only processes the new ones
+        state = RejectionState(seed=42)
+        samples = joker.iterative_rejection_sample(
+            data, n_requested_samples=64, prior_cache_file=prior_cache_file,
+            n_prior_samples=1024, state=state)
+        assert state.n_processed == 1024
+        idx = state.good_samples_idx.copy()
+
+        samples = joker.iterative_rejection_sample(
+            data, n_requested_samples=64, prior_cache_file=prior_cache_file,
+            n_prior_samples=8192, state=state)
+        assert state.n_processed == 8192
+        assert len(samples) == len(state)
+        assert np.all(np.diff(state.good_samples_idx) > 0)
+        assert np.all(np.isin(state.good_samples_idx[state.good_samples_idx
+                                                     < 1024], idx))
+
+        # the prior samples have to come from a cache file
+        with pytest.raises(ValueError):
+            joker.iterative_rejection_sample(data, n_requested_samples=64,
+                                             n_prior_samples=1024,
+                                             state=RejectionState())
+
+    def test_mcmc_chain_store(self, tmpdir):
+        rnd = np.random.RandomState(42)
+
+        data = self.data['binary']
+        joker = TheJoker(self.joker_params['binary'], random_state=rnd)
+        samples = joker.rejection_sample(data, n_prior_samples=16384)
+
+        store = MCMCChainStore(str(tmpdir.join('chain.hdf5')), thin=2,
+                               save_interval=4)
+
+        # an "interrupted" run
+        joker.mcmc_sample(data, samples, n_steps=8, n_burn=8, n_walkers=32,
+                          chain_store=store)
+        assert store.load_state()['n_steps'] == 8
+
+        # resume and run for longer
+        _, samples2 = joker.mcmc_sample(data, samples, n_steps=16, n_burn=8,
+                                        n_walkers=32, chain_store=store,
+                                        return_chain=True)
+        assert store.load_state()['n_steps'] == 16
+        assert samples2['K'].shape == (32 * 16 // 2,)
+
+        with pytest.raises(ValueError):
+            joker.mcmc_sample(data, samples, n_steps=16, n_walkers=64,
+                              chain_store=store)
+
+    def test_run(self):
+        rnd = np.random.RandomState(42)
+
+        data = self.data['binary']
+        joker = TheJoker(self.joker_params['binary'], random_state=rnd)
+
+        samples = joker.run(data, n_requested_samples=4,
+                            n_prior_samples=8192, max_prior_samples=65536,
+                            mcmc_kwargs=dict(n_walkers=32, n_burn=64,
+                                             n_steps=64, check_interval=16))
+        assert samples.meta['method'] in ['rejection', 'mcmc']
+        assert samples.size <= 4
+
+        if samples.meta['method'] == 'mcmc':
+            assert is_P_unimodal(samples, data)
+
+        # the maximum-likelihood prior sample is always accepted, so a single
+        # requested sample must come from rejection sampling
+        joker = TheJoker(self.joker_params['binary'],
+                         random_state=np.random.RandomState(42))
+        samples = joker.run(data, n_requested_samples=1, n_prior_samples=256)
+        assert samples.meta['method'] == 'rejection'
+        assert samples.meta['n_prior_samples'] == 256
+        assert samples.size == 1
+
+        # with so few prior samples, only the (unimodal) maximum-likelihood
+        # sample survives, so the run must hand off to MCMC
+        joker = TheJoker(self.joker_params['binary'],
+                         random_state=np.random.RandomState(42))
+        samples = joker.run(data, n_requested_samples=16, n_prior_samples=256,
+                            max_prior_samples=256,
+                            mcmc_kwargs=dict(n_walkers=32, n_burn=64,
+                                             n_steps=64, check_interval=16))
+        assert samples.meta['method'] == 'mcmc'
+        assert samples.meta['n_prior_samples'] == 256
+        assert samples.size == 16
+
+    def test_is_P_unimodal(self):
+        data = self.data['binary']
+        samples = JokerSamples(P=[10., 10.001, 10.002]*u.day)
+        assert is_P_unimodal(samples, data)
+        assert is_P_unimodal(samples[:1], data)
+
+        samples = JokerSamples(P=[10., 20., 30.]*u.day)
+        assert not is_P_unimodal(samples, data)
+
+    def test_reservoir_sample(self):
+        rnd = np.random.RandomState(42)
+
+        data = self.data['binary']
+        joker = TheJoker(self.joker_params['binary'], random_state=rnd)
+
+        samples = joker.reservoir_sample(data, n_samples=8,
+                                         n_prior_samples=1024)
+        assert len(samples) == 8
+
+        samples, ln_prior = joker.reservoir_sample(data, n_samples=8,
+                                                   n_prior_samples=1024,
+                                                   return_logprobs=True)
+        assert len(samples) == 8
+        assert len(ln_prior) == 8
+
+        with pytest.raises(ValueError):
+            joker.reservoir_sample(data, n_samples=128, n_prior_samples=64)
+
     def test_mcmc_continue(self):
         rnd = np.random.RandomState(42)
 
@@ -102,3 +342,31 @@ class TestSampler(object):
                           n_walkers=128, return_sampler=False)
         joker.mcmc_sample(data, samples, n_steps=8, n_burn=8, n_walkers=128,
                           return_sampler=True)
+
+        # refine the initial samples before initializing the walkers
+        joker.mcmc_sample(data, samples[:4], n_steps=8, n_burn=8,
+                          n_walkers=32, optimize=True)
+
+        # sample only the nonlinear parameters
+        model, samples = joker.mcmc_sample(data, samples, n_steps=8, n_burn=8,
+                                           n_walkers=32, marginal=True)
+        assert samples['K'].shape == (32,)
+
+        # Hamiltonian Monte Carlo
+        model, samples = joker.mcmc_sample(data, samples, n_steps=8, n_burn=8,
+                                           method='hmc')
+        assert samples['K'].shape == (8,)
+
+        with pytest.raises(ValueError):
+            joker.mcmc_sample(data, samples, method='hmc', marginal=True)
+
+        # stop burn-in and sampling once converged
+        model, samples = joker.mcmc_sample(data, samples, n_steps=64,
+                                           n_burn=64, n_walkers=32,
+                                           target_n_eff=128, check_interval=16)
+        for k in ['n_burn', 'n_steps', 'converged', 'autocorr_time', 'r_hat',
+                  'n_eff']:
+            assert k in samples.meta
+        assert samples.meta['n_burn'] <= 64
+        assert samples.meta['n_steps'] <= 64
+        assert len(samples['K']) % 32 == 0  # thinned chains of all walkers
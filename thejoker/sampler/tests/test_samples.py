@@ -1,4 +1,8 @@
+# Standard library
+import warnings
+
 # Third-party
+from astropy.constants import G
 from astropy.time import Time
 import astropy.units as u
 from astropy.tests.helper import quantity_allclose
@@ -7,7 +11,7 @@ import numpy as np
 import pytest
 
 # Project
-from ..samples import JokerSamples
+from ..samples import JokerSamples, LazyJokerSamples
 
 
 def test_joker_samples(tmpdir):
@@ -37,6 +41,7 @@ def test_joker_samples(tmpdir):
     samples['M0'] = 2*np.pi*np.random.random(size=N)*u.radian
     samples['e'] = np.random.random(size=N)
     samples['omega'] = 2*np.pi*np.random.random(size=N)*u.radian
+    samples['v1'] = np.random.random(size=N)*u.km/u.s/u.day # velocity trend
 
     fn = str(tmpdir / 'test.hdf5')
     with h5py.File(fn, 'w') as f:
@@ -97,3 +102,195 @@ def test_apply_methods():
     # try just executing others:
     new_samples = samples.median()
     new_samples = samples.std()
+
+
+def test_columnar():
+    N = 100
+
+    samples = JokerSamples(t0=Time('J2000'))
+    samples['P'] = np.random.uniform(800, 1000, size=N)*u.day
+    samples['e'] = np.random.random(size=N)
+    samples['K'] = np.random.random(size=N)*u.km/u.s
+
+    # slices are views of the same sample array
+    s2 = samples[10:20]
+    assert np.shares_memory(s2['P'].value, samples['P'].value)
+    assert quantity_allclose(s2['K'], samples['K'][10:20])
+
+    # ...but setting values doesn't modify the parent samples
+    s2['K'] = np.zeros(10)*u.km/u.s
+    assert np.all(samples['K'][10:20].value > 0)
+
+    # no deprecation warning from len()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert len(samples) == N
+
+    # create from an array
+    arr = np.random.random(size=(N, 2))
+    s3 = JokerSamples.from_array(arr, ['P', 'K'], [u.day, u.m/u.s])
+    assert quantity_allclose(s3['K'], arr[:, 1]*u.m/u.s)
+
+    with pytest.raises(ValueError):
+        JokerSamples.from_array(arr, ['P', 'K', 'e'], [u.day, u.m/u.s, u.one])
+
+    # concatenate, converting units
+    s4 = samples[:10]
+    s4['K'] = s4['K'].to(u.m/u.s)
+    s5 = JokerSamples.concatenate([samples, s4])
+    assert len(s5) == N + 10
+    assert s5['K'].unit == u.km/u.s
+    assert quantity_allclose(s5['K'][N:], samples['K'][:10])
+
+    with pytest.raises(ValueError):
+        JokerSamples.concatenate([samples, s3])
+
+    # remove a parameter
+    K = samples.pop('K')
+    assert 'K' not in samples
+    assert len(K) == N
+    assert list(samples.keys()) == ['P', 'e']
+
+    assert quantity_allclose(samples.median()['P'], np.median(samples['P']))
+
+
+def test_rv():
+    N = 16
+    t0 = Time('J2000')
+    t = t0 + np.linspace(0, 1000., 128)*u.day
+
+    samples = JokerSamples(t0=t0)
+    samples['P'] = np.random.uniform(10, 100, size=N)*u.day
+    samples['M0'] = 2*np.pi*np.random.random(size=N)*u.radian
+    samples['e'] = np.zeros(N)
+    samples['omega'] = 2*np.pi*np.random.random(size=N)*u.radian
+    samples['K'] = np.random.uniform(1, 10, size=N)*u.km/u.s
+    samples['v0'] = np.random.uniform(-10, 10, size=N)*u.km/u.s
+    samples['v1'] = np.random.uniform(-1, 1, size=N)*u.m/u.s/u.day
+    samples['dv0_b'] = np.random.uniform(-1, 1, size=N)*u.km/u.s
+
+    rv = samples.rv(t)
+    assert rv.shape == (N, len(t))
+    assert rv.unit == u.km/u.s
+
+    # circular orbits
+    dt = t.tcb.mjd - t0.tcb.mjd
+    M = (2*np.pi*dt[None] / samples['P'].value[:, None] -
+         samples['M0'].value[:, None])
+    rv_circ = (samples['K'][:, None] *
+               np.cos(samples['omega'].value[:, None] + M))
+    rv_trend = samples['v0'][:, None] + samples['v1'][:, None] * dt*u.day
+    assert quantity_allclose(rv, rv_circ + rv_trend)
+
+    # times can also be passed in as BMJD
+    assert quantity_allclose(samples.rv(t.tcb.mjd), rv)
+
+    # instrument offsets
+    assert quantity_allclose(samples.rv(t, instrument='b'),
+                             rv + samples['dv0_b'][:, None])
+    assert quantity_allclose(samples.rv(t, instrument='a'), rv)
+
+    # a single sample
+    assert quantity_allclose(samples[3].rv(t), rv[3])
+
+
+def test_derived_quantities():
+    N = 64
+    t0 = Time('J2000')
+
+    samples = JokerSamples(t0=t0)
+    samples['P'] = np.random.uniform(10, 1000, size=N)*u.day
+    samples['M0'] = 2*np.pi*np.random.random(size=N)*u.radian
+    samples['e'] = np.random.uniform(0, 0.9, size=N)*u.one
+    samples['omega'] = 2*np.pi*np.random.random(size=N)*u.radian
+    samples['K'] = np.random.uniform(0.1, 50, size=N)*u.km/u.s
+    samples['v0'] = np.random.uniform(-10, 10, size=N)*u.km/u.s
+
+    P = samples['P']
+    K = samples['K']
+    e = samples['e']
+
+    mf = samples.mass_function()
+    assert mf.unit == u.Msun
+    assert quantity_allclose(
+        mf, (P * K**3 * (1 - e**2)**1.5 / (2*np.pi*G)).to(u.Msun))
+
+    asini = samples.asini()
+    assert asini.unit == u.au
+    assert quantity_allclose(asini,
+                             (P * K * np.sqrt(1 - e**2) / (2*np.pi)).to(u.au))
+
+    # the mean anomaly is zero at pericenter
+    t_peri = samples.t_peri()
+    dt = (t_peri.tcb.mjd - t0.tcb.mjd) * u.day
+    assert np.all((dt >= 0) & (dt < P))
+    M = 2*np.pi*u.radian * (dt / P).decompose() - samples['M0']
+    assert np.allclose(np.cos(M), 1.)
+
+    # the minimum companion mass reproduces the mass function for sin(i) = 1
+    m1 = 1.2 * u.Msun
+    m2 = samples.m2_min(m1)
+    assert m2.unit == u.Msun
+    assert np.all(m2 >= mf)
+    assert quantity_allclose(m2**3 / (m1 + m2)**2, mf, rtol=1E-8)
+
+    # also for an array of primary masses, and a single sample
+    m1 = np.random.uniform(0.5, 2, size=N) * u.Msun
+    m2 = samples.m2_min(m1)
+    assert quantity_allclose(m2**3 / (m1 + m2)**2, mf, rtol=1E-8)
+    assert quantity_allclose(samples[3].m2_min(m1[3]), m2[3])
+    assert samples[3].mass_function().shape == ()
+
+    # and for samples created from scalar values
+    scalar = JokerSamples(P=P[3], e=e[3], K=K[3])
+    assert quantity_allclose(scalar.m2_min(m1[3]), m2[3])
+
+
+def test_lazy_hdf5(tmpdir):
+    N = 100
+
+    samples = JokerSamples(t0=Time('J2000'))
+    samples['P'] = np.random.uniform(800, 1000, size=N)*u.day
+    samples['M0'] = 2*np.pi*np.random.random(size=N)*u.radian
+    samples['e'] = np.random.random(size=N)
+    samples['omega'] = 2*np.pi*np.random.random(size=N)*u.radian
+    samples['K'] = np.random.random(size=N)*u.km/u.s
+    samples['v0'] = np.random.random(size=N)*u.km/u.s
+
+    fn = str(tmpdir / 'test-lazy.hdf5')
+    with h5py.File(fn, 'w') as f:
+        for name in ['star1', 'star2']:
+            samples.to_hdf5(f.create_group(name))
+
+    with h5py.File(fn, 'r') as f:
+        lazy = JokerSamples.from_hdf5(f['star2'], lazy=True)
+        assert len(lazy) == N
+        assert list(lazy.keys()) == list(samples.keys())
+        assert np.isclose(lazy.t0.mjd, samples.t0.mjd)
+
+        assert quantity_allclose(lazy['P'], samples['P'])
+        assert lazy['e'].unit == u.one
+
+        # slicing and indexing don't read anything until a column is accessed
+        for slc in [slice(10, 20), slice(None, None, -3), [5, 2, 2, 90],
+                    samples['P'] > 900*u.day]:
+            sub = lazy[slc]
+            assert sub.shape == samples[slc].shape
+            assert quantity_allclose(sub['K'], samples['K'][slc])
+            assert quantity_allclose(sub[1:3]['K'], samples['K'][slc][1:3])
+
+        assert quantity_allclose(lazy[10:20][3]['P'], samples['P'][13])
+        assert lazy[5].shape == ()
+
+        # only the first n samples
+        assert len(JokerSamples.from_hdf5(f['star1'], n=10, lazy=True)) == 10
+
+        # read into memory
+        mem = lazy[::2].load()
+        assert isinstance(mem, JokerSamples)
+        assert not isinstance(mem, LazyJokerSamples)
+        for k in samples.keys():
+            assert quantity_allclose(mem[k], samples[k][::2])
+
+        with pytest.raises(TypeError):
+            lazy['P'] = np.ones(N)*u.day
@@ -1,8 +1,9 @@
 # Third-party
+import numpy as np
 from numpy import log, pi
 from scipy.special import loggamma
 
-__all__ = ['beta_logpdf']
+__all__ = ['beta_logpdf', 'autocorr_time', 'gelman_rubin']
 
 
 def beta_logpdf(x, a, b):
@@ -13,3 +14,98 @@ def beta_logpdf(x, a, b):
 
 def norm_logpdf(x, mu, sig):
     return -0.5 * (((x-mu) / sig)**2 + log(2*pi*sig**2))
+
+
+def _autocorr_func(x):
+    """Normalized autocorrelation function of each chain along the last axis,
+    computed with an FFT."""
+    n = x.shape[-1]
+    n_fft = 2 ** int(np.ceil(np.log2(2 * n)))
+
+    x = x - np.mean(x, axis=-1, keepdims=True)
+    f = np.fft.rfft(x, n=n_fft, axis=-1)
+    acf = np.fft.irfft(f * np.conjugate(f), axis=-1)[..., :n]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf = acf / acf[..., :1]
+    acf[~np.isfinite(acf)] = 0.
+
+    return acf
+
+
+def autocorr_time(chain, c=5.):
+    """Estimate the integrated autocorrelation time of a set of MCMC chains.
+
+    The autocorrelation function is averaged over the chains (e.g., the
+    walkers of an ensemble sampler) and summed up to the automated window of
+    Sokal (1989): the smallest lag ``M`` with ``M >= c * tau(M)``.
+
+    Parameters
+    ----------
+    chain : array_like
+        The samples, with shape ``(n_chains, n_steps, n_dim)``.
+    c : float (optional)
+        The window scale factor.
+
+    Returns
+    -------
+    tau : `numpy.ndarray`
+        The autocorrelation time, in steps, for each of the ``n_dim``
+        parameters.
+    """
+    chain = np.asarray(chain, dtype=np.float64)
+    if chain.ndim != 3:
+        raise ValueError("chain must have shape (n_chains, n_steps, n_dim)")
+
+    # average over chains: shape (n_dim, n_steps)
+    acf = np.mean(_autocorr_func(np.moveaxis(chain, 1, 2)), axis=0)
+
+    taus = 2 * np.cumsum(acf, axis=-1) - 1
+    lags = np.arange(acf.shape[-1])
+
+    tau = np.zeros(chain.shape[2])
+    for i in range(len(tau)):
+        window = lags >= c * taus[i]
+        if np.any(window):
+            tau[i] = taus[i, np.argmax(window)]
+        else:
+            tau[i] = taus[i, -1]
+
+    return tau
+
+
+def gelman_rubin(chain):
+    """Compute the split Gelman-Rubin statistic, R-hat, for a set of MCMC
+    chains.
+
+    Each chain is split in half, so that a trend within the chains also
+    inflates R-hat. Values close to 1 indicate that the chains have mixed.
+
+    Parameters
+    ----------
+    chain : array_like
+        The samples, with shape ``(n_chains, n_steps, n_dim)``.
+
+    Returns
+    -------
+    r_hat : `numpy.ndarray`
+        The value of R-hat for each of the ``n_dim`` parameters.
+    """
+    chain = np.asarray(chain, dtype=np.float64)
+    if chain.ndim != 3:
+        raise ValueError("chain must have shape (n_chains, n_steps, n_dim)")
+
+    n = chain.shape[1] // 2
+    if n < 2:
+        raise ValueError("At least 4 steps are needed to compute R-hat.")
+    chains = np.concatenate((chain[:, :n], chain[:, -n:]), axis=0)
+
+    W = np.mean(np.var(chains, axis=1, ddof=1), axis=0)
+    B_n = np.var(np.mean(chains, axis=1), axis=0, ddof=1)
+    var_plus = (n - 1) / n * W + B_n
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r_hat = np.sqrt(var_plus / W)
+    r_hat[W == 0] = 1.
+
+    return r_hat
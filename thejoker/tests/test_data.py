@@ -1,4 +1,5 @@
 # Third-party
+from astropy.tests.helper import quantity_allclose
 import astropy.time as atime
 import astropy.units as u
 import numpy as np
@@ -84,6 +85,50 @@ def test_rvdata():
     assert len(data) == (128-16)
 
 
+def test_rvdata_instrument(tmpdir):
+    t = np.random.uniform(55555., 56012., size=128)
+    rv = 100 * np.sin(0.5*t)
+    rv[:16] = np.nan
+    rv = rv * u.km/u.s
+    ivar = 1 / (np.random.normal(0,5,size=t.size)*u.km/u.s)**2
+    instrument = np.random.choice(['HIRES', 'APOGEE'], size=t.size)
+
+    # no labels: a single instrument
+    data = RVData(t=t, rv=rv, ivar=ivar)
+    assert data.instruments is None
+    assert data.n_instruments == 1
+
+    # labels are filtered and sorted along with the data
+    data = RVData(t=t, rv=rv, ivar=ivar, instrument=instrument)
+    assert len(data.instrument) == len(data)
+    idx = np.isfinite(rv)
+    assert np.all(data.instrument == instrument[idx][np.argsort(t[idx])])
+    assert list(data.instruments) == ['APOGEE', 'HIRES']
+    assert data.n_instruments == 2
+    assert np.all(data.instruments[data._instrument_idx] == data.instrument)
+
+    with pytest.raises(ValueError):
+        RVData(t=t, rv=rv, ivar=ivar, instrument=instrument[:-1])
+
+    # copy, slicing, and I/O keep the labels
+    assert np.all(data.copy().instrument == data.instrument)
+    assert np.all(data[:16].instrument == data.instrument[:16])
+
+    fn = str(tmpdir / 'data.hdf5')
+    data.to_hdf5(fn)
+    data2 = RVData.from_hdf5(fn)
+    assert np.all(data2.instrument == data.instrument)
+
+    # compressed, single-precision storage
+    fn = str(tmpdir / 'data-float32.hdf5')
+    data.to_hdf5(fn, chunks=64, compression='gzip', dtype=np.float32)
+    data2 = RVData.from_hdf5(fn)
+    assert data2.rv.dtype == np.float64
+    assert np.allclose(data2.t.tcb.mjd, data.t.tcb.mjd)
+    assert quantity_allclose(data2.rv, data.rv, rtol=1E-6)
+    assert np.all(data2.instrument == data.instrument)
+
+
 @pytest.mark.skipif(not HAS_MPL, reason='matplotlib not installed')
 def test_plotting():
     # check that plotting at least succeeds with allowed arguments
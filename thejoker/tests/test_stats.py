@@ -0,0 +1,28 @@
+# Third-party
+import numpy as np
+
+# Package
+from ..stats import autocorr_time, gelman_rubin
+
+
+def test_autocorr_time():
+    # AR(1) process, with autocorrelation time (1 + phi) / (1 - phi)
+    rnd = np.random.RandomState(42)
+    phi = 0.8
+    chain = rnd.normal(size=(16, 8192, 2))
+    for i in range(1, chain.shape[1]):
+        chain[:, i] += phi * chain[:, i-1]
+
+    tau = autocorr_time(chain)
+    assert tau.shape == (2,)
+    assert np.allclose(tau, (1 + phi) / (1 - phi), rtol=0.1)
+
+
+def test_gelman_rubin():
+    rnd = np.random.RandomState(42)
+    chain = rnd.normal(size=(16, 1024, 3))
+    assert np.all(np.abs(gelman_rubin(chain) - 1) < 0.01)
+
+    # chains that haven't mixed
+    chain[:8] += 2.
+    assert np.all(gelman_rubin(chain) > 1.1)
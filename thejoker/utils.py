@@ -1,5 +1,6 @@
 # Third-party
 import astropy.units as u
+import numpy as np
 
 # Package
 from .log import log as logger
@@ -34,7 +35,7 @@ def quantity_from_hdf5(f, key, n=None):
         if n is not None:
             logger.warning("Dataset '{}' is a scalar.".format(key))
 
-        return f[key].value * unit
+        return f[key][()] * unit
 
     else:
         if n is not None:
@@ -43,7 +44,42 @@ def quantity_from_hdf5(f, key, n=None):
             return f[key][:] * unit
 
 
-def quantity_to_hdf5(f, name, q):
+def _dataset_kwargs(shape, chunks=None, compression=None,
+                    compression_opts=None, dtype=None):
+    """
+    Return keyword arguments for `h5py.Group.create_dataset` that set the
+    chunk shape, compression filter, and on-disk data type of a dataset with
+    the given shape. An integer ``chunks`` is the number of rows per chunk.
+    The shuffle filter is enabled along with compression, which makes
+    floating-point data compress much better. Scalar and empty datasets
+    can't be chunked, so only the data type is set for these. This is meant
+    to be used internally.
+    """
+    kwargs = dict()
+    if dtype is not None:
+        kwargs['dtype'] = dtype
+
+    shape = tuple(shape)
+    if len(shape) == 0 or shape[0] == 0:
+        return kwargs
+
+    if (isinstance(chunks, (int, np.integer)) and
+            not isinstance(chunks, bool)):
+        chunks = (min(int(chunks), shape[0]), ) + shape[1:]
+
+    if chunks is not None:
+        kwargs['chunks'] = chunks
+
+    if compression is not None:
+        kwargs['compression'] = compression
+        kwargs['compression_opts'] = compression_opts
+        kwargs['shuffle'] = True
+
+    return kwargs
+
+
+def quantity_to_hdf5(f, name, q, chunks=None, compression=None,
+                     compression_opts=None, dtype=None):
     """
     Turn an Astropy Quantity object into something we can write out to
     an HDF5 file.
@@ -55,13 +91,27 @@ def quantity_to_hdf5(f, name, q):
         The name.
     q : float, `astropy.units.Quantity`
         The quantity.
+    chunks : int, tuple, bool (optional)
+        The chunk shape of the dataset, or the number of rows per chunk.
+    compression : str (optional)
+        The compression filter, e.g., ``'gzip'`` or ``'lzf'``.
+    compression_opts : int (optional)
+        Options for the compression filter, e.g., the gzip level.
+    dtype : `numpy.dtype` (optional)
+        The data type to store the values as, e.g., ``np.float32`` to halve
+        the size of the file.
 
     """
 
     if hasattr(q, 'unit'):
-        f[name] = q.value
-        f[name].attrs['unit'] = str(q.unit)
+        unit = str(q.unit)
+        q = q.value
 
     else:
-        f[name] = q
-        f[name].attrs['unit'] = ""
+        unit = ""
+
+    kwargs = _dataset_kwargs(np.shape(q), chunks=chunks,
+                             compression=compression,
+                             compression_opts=compression_opts, dtype=dtype)
+    f.create_dataset(name, data=q, **kwargs)
+    f[name].attrs['unit'] = unit